@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark the CF generators end to end, on synthetic binary datasets
+
+Every generator explains the test samples one at a time (after one untimed
+warm-up sample, e.g. for tracing and numba compilation), and the benchmark
+reports its throughput, the p50/p95 latency per sample, the peak RSS, and the
+validity and proximity of the counterfactuals. The generators are the guided
+(`src/_guided.py`), vanilla (`src/_vanilla.py`) and composite (`_composite.py`,
+at the root of the repository) latent CF, each without and with (`-ae`) the
+autoencoder, Native Guide, and the wildboar shapelet forest and kNN.
+`guided-batched` explains all samples in one batched search instead, its
+latencies are the search times of `ModifiedLatentCF.search_time_`.
+
+Each generator runs in its own (spawned) process, so that the peak RSS is its
+own. The keras classifier (FCN) and the 1dCNN autoencoder are trained once per
+dataset and shared by all latent CF generators and Native Guide; as in
+`gc_latentcf_search.py` the series are padded for the autoencoder.
+
+    python benchmarks/bench_generators.py --n-train 100 --n-samples 20 --n-timesteps 64 128 --output bench.json
+    python benchmarks/bench_generators.py --generators guided native-guide --baseline bench.json
+"""
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+sys.path.insert(0, SRC_DIR)
+# `_composite.py` is at the root of the repository, after `src` so that it shadows nothing there
+sys.path.append(ROOT_DIR)
+
+RANDOM_STATE = 39
+
+GENERATORS = [
+    "guided",
+    "guided-ae",
+    "guided-batched",
+    "vanilla",
+    "vanilla-ae",
+    "composite",
+    "composite-ae",
+    "native-guide",
+    "shapelet-forest",
+    "knn",
+]
+
+
+def synthetic_dataset(n_samples, n_timesteps, random_state=RANDOM_STATE):
+    """Noisy sines of random phase, class 1 with a bump around the middle
+
+    A counterfactual only has to add or remove the bump, i.e. change a segment.
+    """
+    rng = np.random.RandomState(random_state)
+    t = np.linspace(0, 4 * np.pi, n_timesteps)
+    X = np.sin(t + rng.uniform(0, 2 * np.pi, (n_samples, 1)))
+    X += 0.3 * rng.randn(n_samples, n_timesteps)
+    y = rng.permutation(np.arange(n_samples) % 2)
+
+    width = max(n_timesteps / 10, 1)
+    center = n_timesteps // 2 + rng.randint(-n_timesteps // 8, n_timesteps // 8 + 1, n_samples)
+    bump = 2 * np.exp(-((np.arange(n_timesteps) - center[:, np.newaxis]) ** 2) / (2 * width**2))
+    X[y == 1] += bump[y == 1]
+    return X[:, :, np.newaxis], y
+
+
+def prepare_data(n_train, n_samples, n_timesteps):
+    """Normalized, padded train and test arrays of a synthetic dataset"""
+    from help_functions import conditional_pad, time_series_normalize
+
+    X, y = synthetic_dataset(n_train + n_samples, n_timesteps)
+    X_train, scaler = time_series_normalize(X[:n_train], n_timesteps)
+    X_test, _ = time_series_normalize(X[n_train:], n_timesteps, scaler=scaler)
+    X_train_padded, padding_size = conditional_pad(X_train)
+    X_test_padded, _ = conditional_pad(X_test)
+    return dict(
+        X_train=X_train_padded.astype(np.float32),
+        y_train=y[:n_train],
+        X_test=X_test_padded.astype(np.float32),
+        y_test=y[n_train:],
+        padding_size=padding_size,
+    )
+
+
+def train_models(data, model_dir, epochs):
+    """Train the FCN classifier and the autoencoder, saved to `model_dir`; returns the test accuracy"""
+    from tensorflow import keras
+    from tensorflow.keras.utils import to_categorical
+
+    from help_functions import reset_seeds
+    from keras_models import Autoencoder, Classifier_FCN
+
+    reset_seeds()
+    classifier = Classifier_FCN(data["X_train"].shape[1:], 2)
+    classifier.compile(
+        loss="categorical_crossentropy", optimizer=keras.optimizers.Adam(), metrics=["accuracy"]
+    )
+    classifier.fit(
+        data["X_train"], to_categorical(data["y_train"], 2), batch_size=16, epochs=epochs, verbose=False
+    )
+    classifier.save(os.path.join(model_dir, "classifier.h5"))
+
+    reset_seeds()
+    autoencoder = Autoencoder(data["X_train"].shape[1], 1)
+    autoencoder.compile(optimizer=keras.optimizers.Adam(learning_rate=0.0005), loss="mse")
+    autoencoder.fit(
+        data["X_train"], data["X_train"], batch_size=32, epochs=epochs, verbose=False
+    )
+    autoencoder.save(os.path.join(model_dir, "autoencoder.h5"))
+
+    y_pred = np.argmax(classifier.predict(data["X_test"], verbose=0), axis=1)
+    return float(np.mean(y_pred == data["y_test"]))
+
+
+def _latent_cf(name, data, classifier, autoencoder, A):
+    """`explain(x, pred_labels)` of the latent CF generators"""
+    import tensorflow as tf
+
+    if name.startswith("vanilla"):
+        from _vanilla import LatentCF
+
+        cf_model = LatentCF(probability=A.target_prob, autoencoder=autoencoder).fit(classifier)
+        return lambda x, pred_labels: cf_model.transform(x)[0]
+
+    from _guided import ModifiedLatentCF, get_global_weights
+
+    if A.w_type == "global":
+        step_weights = get_global_weights(
+            data["X_train"], data["y_train"], classifier, random_state=RANDOM_STATE, n_intervals=10
+        )
+    elif A.w_type == "local":
+        step_weights = "local"
+    else:
+        step_weights = np.ones((1,) + data["X_train"].shape[1:])
+    cf_model = ModifiedLatentCF(
+        probability=A.target_prob,
+        autoencoder=autoencoder,
+        optimizer=tf.keras.optimizers.legacy.Adam(learning_rate=A.learning_rate),
+        pred_margin_weight=A.pred_margin_weight,
+        step_weights=step_weights,
+        random_state=RANDOM_STATE,
+        batch_size=data["X_test"].shape[0] if name == "guided-batched" else None,
+    ).fit(classifier)
+
+    def explain(x, pred_labels):
+        return cf_model.transform(x, pred_labels)[0]
+
+    # for the search times of `guided-batched`
+    explain.cf_model = cf_model
+    return explain
+
+
+def _composite_cf(classifier, autoencoder, A):
+    """`explain(x, pred_labels)` of `_composite.ModifiedLatentCF`
+
+    It searches until the single output of its model reaches `probability`, so
+    each desired label gets a model of the classifier's probability of that label.
+    """
+    import tensorflow as tf
+    from tensorflow import keras
+
+    from _composite import ModifiedLatentCF as CompositeLatentCF
+
+    cf_models = [
+        CompositeLatentCF(
+            probability=A.target_prob,
+            optimizer=tf.keras.optimizers.legacy.Adam(learning_rate=A.learning_rate),
+            autoencoder=autoencoder,
+        ).fit(
+            keras.Model(
+                inputs=classifier.input, outputs=classifier.output[:, label : label + 1]
+            )
+        )
+        for label in (0, 1)
+    ]
+
+    def explain(x, pred_labels):
+        cf_samples = np.empty(x.shape)
+        for i, pred_label in enumerate(pred_labels):
+            # for binary classification
+            cf_samples[i] = cf_models[1 - pred_label].transform(x[i : i + 1])[0][0]
+        return cf_samples
+
+    return explain
+
+
+def _native_guide(data, classifier):
+    from generate_cfs_baseline import (
+        counterfactual_generator_swap,
+        get_training_weights,
+        native_guide_retrieval,
+    )
+
+    training_weights = get_training_weights(data["X_train"], model=classifier)
+
+    def explain(x, pred_labels):
+        cf_samples = []
+        for sample, pred_label in zip(x, pred_labels):
+            nun_idx = native_guide_retrieval(
+                sample, pred_label, "euclidean", 1, data["X_train"], data["y_train"]
+            )[1][0]
+            cf_samples.append(
+                counterfactual_generator_swap(
+                    sample,
+                    nun_idx,
+                    1,
+                    model=classifier,
+                    target_label=1 - pred_label,  # for binary classification
+                    training_weights=training_weights,
+                    X_train=data["X_train"],
+                )
+            )
+        return np.array(cf_samples)
+
+    return explain
+
+
+def _wildboar(name, data):
+    """`explain(x, pred_labels)` and `predict_proba(x)` of the wildboar generators"""
+    from sklearn.neighbors import KNeighborsClassifier
+    from wildboar.ensemble import ShapeletForestClassifier
+    from wildboar.explain.counterfactual import counterfactuals
+
+    # as `generate_cfs_baseline.py`
+    if name == "shapelet-forest":
+        estimator = ShapeletForestClassifier(
+            n_shapelets=10,
+            metric="euclidean",
+            random_state=RANDOM_STATE,
+            n_estimators=50,
+            max_depth=5,
+        )
+    else:
+        estimator = KNeighborsClassifier(n_neighbors=5, metric="euclidean")
+    estimator.fit(data["X_train"][:, :, 0], data["y_train"])
+
+    def explain(x, pred_labels):
+        cf_samples, _, _ = counterfactuals(
+            estimator,
+            x[:, :, 0],
+            1 - pred_labels,  # for binary classification
+            scoring="euclidean",
+            random_state=RANDOM_STATE,
+        )
+        return cf_samples[:, :, np.newaxis]
+
+    return explain, lambda x: estimator.predict_proba(x[:, :, 0])
+
+
+def _peak_rss_mb():
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def run_generator(name, data, model_dir, A):
+    """Run one generator, in a worker process; returns its metrics"""
+    import warnings
+
+    from tensorflow import keras
+
+    from help_functions import evaluate_samples, remove_paddings, reset_seeds
+
+    # the LIMESegment and wildboar warnings, see `ModifiedLatentCF._get_step_weights`
+    warnings.simplefilter("ignore")
+    reset_seeds()
+
+    start_time = time.perf_counter()
+    classifier = keras.models.load_model(os.path.join(model_dir, "classifier.h5"), compile=False)
+    if name in ("shapelet-forest", "knn"):
+        explain, predict_proba = _wildboar(name, data)
+    else:
+        predict_proba = lambda x: classifier.predict(x, verbose=0)
+        if name == "native-guide":
+            explain = _native_guide(data, classifier)
+        else:
+            autoencoder = None
+            if name.endswith("-ae"):
+                autoencoder = keras.models.load_model(
+                    os.path.join(model_dir, "autoencoder.h5"), compile=False
+                )
+            if name.startswith("composite"):
+                explain = _composite_cf(classifier, autoencoder, A)
+            else:
+                explain = _latent_cf(name, data, classifier, autoencoder, A)
+    setup_seconds = time.perf_counter() - start_time
+
+    X_test = data["X_test"]
+    pred_labels = np.argmax(predict_proba(X_test), axis=1)
+    explain(X_test[:1], pred_labels[:1])
+    setup_rss = _peak_rss_mb()
+
+    start_time = time.perf_counter()
+    if name == "guided-batched":
+        cf_samples = explain(X_test, pred_labels)
+        latencies = explain.cf_model.search_time_
+    else:
+        cf_samples, latencies = np.empty(X_test.shape), np.empty(X_test.shape[0])
+        for i in range(X_test.shape[0]):
+            sample_start = time.perf_counter()
+            cf_samples[i] = explain(X_test[i : i + 1], pred_labels[i : i + 1])[0]
+            latencies[i] = time.perf_counter() - sample_start
+    total_seconds = time.perf_counter() - start_time
+
+    sample_res = evaluate_samples(
+        remove_paddings(X_test, data["padding_size"]),
+        remove_paddings(cf_samples, data["padding_size"]),
+        pred_labels,
+        predict_proba(cf_samples.astype(np.float32)),
+    )
+    return dict(
+        generator=name,
+        setup_seconds=setup_seconds,
+        total_seconds=total_seconds,
+        samples_per_second=X_test.shape[0] / total_seconds,
+        latency_p50=float(np.percentile(latencies, 50)),
+        latency_p95=float(np.percentile(latencies, 95)),
+        peak_rss_setup_mb=setup_rss,
+        peak_rss_mb=_peak_rss_mb(),
+        validity=float(np.mean(sample_res["validity"])),
+        proximity=float(np.mean(sample_res["proximity"])),
+    )
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=SRC_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print the change of throughput and latency relative to a baseline JSON file"""
+    with open(baseline_path) as f:
+        baseline = {
+            (row["generator"], row["n_timesteps"], row["n_samples"]): row
+            for row in json.load(f)["results"]
+        }
+    for row in results:
+        base = baseline.get((row["generator"], row["n_timesteps"], row["n_samples"]))
+        if base is None:
+            continue
+        print(
+            f"{row['generator']:>16} T={row['n_timesteps']:<5}: "
+            f"{row['samples_per_second'] / base['samples_per_second']:.2f}x samples/s, "
+            f"{row['latency_p95'] / base['latency_p95']:.2f}x p95 latency, "
+            f"validity {base['validity']:.2f} -> {row['validity']:.2f}"
+        )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--generators", nargs="+", choices=GENERATORS, default=GENERATORS)
+    parser.add_argument("--n-timesteps", nargs="+", type=int, default=[64, 128])
+    parser.add_argument("--n-train", type=int, default=100)
+    parser.add_argument("--n-samples", type=int, default=20, help="Number of test samples explained.")
+    parser.add_argument("--epochs", type=int, default=20, help="Training epochs of the classifier and autoencoder.")
+    parser.add_argument("--w-type", type=str, default="uniform", choices=["uniform", "global", "local"])
+    parser.add_argument("--learning-rate", type=float, default=0.001)
+    parser.add_argument("--pred-margin-weight", type=float, default=0.7)
+    parser.add_argument("--target-prob", type=float, default=0.5)
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON.")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results of an earlier run to compare to.")
+    A = parser.parse_args()
+
+    results = []
+    for n_timesteps in A.n_timesteps:
+        data = prepare_data(A.n_train, A.n_samples, n_timesteps)
+        model_dir = tempfile.mkdtemp(prefix="bench-generators-")
+        try:
+            # trained in a worker too, so that TensorFlow is never initialized in the main process
+            ctx = multiprocessing.get_context("spawn")
+            with ctx.Pool(1) as pool:
+                accuracy = pool.apply(train_models, (data, model_dir, A.epochs))
+            for name in A.generators:
+                # a fresh process per generator, for its own peak RSS
+                with ctx.Pool(1, maxtasksperchild=1) as pool:
+                    row = pool.apply(run_generator, (name, data, model_dir, A))
+                row.update(n_timesteps=n_timesteps, n_train=A.n_train, n_samples=A.n_samples, classifier_accuracy=accuracy)
+                results.append(row)
+                print(
+                    f"{name:>16} T={n_timesteps:<5}: {row['samples_per_second']:.2f} samples/s, "
+                    f"p50 {row['latency_p50']:.4f}s, p95 {row['latency_p95']:.4f}s, "
+                    f"peak RSS {row['peak_rss_mb']:.0f}MB, "
+                    f"validity {row['validity']:.2f}, proximity {row['proximity']:.3f}"
+                )
+        finally:
+            shutil.rmtree(model_dir, ignore_errors=True)
+
+    if A.baseline is not None:
+        compare(results, A.baseline)
+
+    if A.output is not None:
+        with open(A.output, "w") as f:
+            json.dump(
+                dict(
+                    commit=_git_commit(),
+                    python=platform.python_version(),
+                    numpy=np.__version__,
+                    args=vars(A),
+                    results=results,
+                ),
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
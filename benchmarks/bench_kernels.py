@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Microbenchmark the kernels of the explanations and baselines, swept over series length and sample count
+
+Every kernel runs on `n` samples of length `T`, after an untimed warm-up call on
+a few samples (e.g. for numba compilation and keras tracing), with the caches of
+the matrix profile and the background signals cleared before each repeat. Reports
+the seconds per call and per sample, and for every (T, n) the kernel that
+dominates, e.g. short series as ItalyPowerDemand (24) vs. long ones as
+HandOutlines (2709).
+
+The keras kernels use an untrained FCN classifier, i.e. their time, not their
+results, is representative. `rbp` includes the background identification.
+
+    python benchmarks/bench_kernels.py --lengths 24 128 512 2709 --n-samples 10 100
+    python benchmarks/bench_kernels.py --kernels nnsegment dtw_weighting --dataset HandOutlines --n-samples 10
+"""
+import json
+import os
+import sys
+import time
+import warnings
+from argparse import ArgumentParser
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from bench_generators import RANDOM_STATE, synthetic_dataset  # noqa: E402
+from LIMESegment.Utils.dtw import dtw_distances  # noqa: E402
+from LIMESegment.Utils.explanations import (  # noqa: E402
+    NNSegment,
+    RBP,
+    backgroundIdentification,
+    matrix_profile_cache,
+)
+from LIMESegment.Utils.perturbations import background_cache  # noqa: E402
+
+KERNELS = [
+    "nnsegment",
+    "background",
+    "rbp",
+    "dtw_weighting",
+    "local_weights",
+    "global_weights",
+    "find_subarray",
+    "cam_weights",
+    "relative_proximity",
+    "calculate_lof",
+]
+
+
+def dataset_samples(name, n_samples):
+    from wildboar.datasets import load_dataset
+
+    X, y = load_dataset(name, repository="wildboar/ucr")
+    labels = np.unique(y)
+    # binary labels, as the CF search: the first label vs. the rest
+    return X[:n_samples, :, np.newaxis].astype(np.float64), (y[:n_samples] != labels[0]).astype(int)
+
+
+def make_kernel(name, X, y, model, A):
+    """The call of kernel `name` on all samples, its inputs prepared beforehand"""
+    n_samples, n_timesteps, _ = X.shape
+    # the defaults of LIMESegment
+    window_size, n_perturbations = int(n_timesteps / 5), 100
+
+    if name == "nnsegment":
+        return lambda: [NNSegment(x, window_size, 3) for x in X]
+
+    if name == "background":
+        # with its default segment length, as called by `RBP`
+        return lambda: [backgroundIdentification(x) for x in X]
+
+    if name in ("rbp", "dtw_weighting"):
+        rng = np.random.RandomState(RANDOM_STATE)
+        perturbations = []
+        for x in X:
+            segment_indexes = [0] + NNSegment(x, window_size, 3) + [-1]
+            interpretable = rng.binomial(1, 0.5, (n_perturbations, len(segment_indexes) - 1))
+            perturbations.append(
+                (segment_indexes, interpretable, RBP(interpretable, x, segment_indexes))
+            )
+        if name == "rbp":
+            return lambda: [
+                RBP(interpretable, x, segment_indexes)
+                for x, (segment_indexes, interpretable, _) in zip(X, perturbations)
+            ]
+        # the weights of the perturbations of `LIMESegment`, by their DTW distance
+        return lambda: [
+            dtw_distances(x, samples_raw) for x, (_, _, samples_raw) in zip(X, perturbations)
+        ]
+
+    if name == "local_weights":
+        from _guided import get_local_weights
+
+        return lambda: [
+            get_local_weights(x, model, random_state=RANDOM_STATE, pred_label=label)
+            for x, label in zip(X, y)
+        ]
+
+    if name == "global_weights":
+        from _guided import get_global_weights
+
+        return lambda: get_global_weights(
+            X, y, model, random_state=RANDOM_STATE, n_intervals=A.n_intervals
+        )
+
+    if name in ("find_subarray", "cam_weights"):
+        from generate_cfs_baseline import findSubarray, get_training_weights
+
+        if name == "cam_weights":
+            return lambda: get_training_weights(X, model)
+        training_weights = get_training_weights(X, model)
+        # the subarray length of Native Guide grows until the CF is valid, take 10% of the series
+        subarray_length = max(n_timesteps // 10, 1)
+        return lambda: [findSubarray(w, subarray_length) for w in training_weights]
+
+    if name in ("relative_proximity", "calculate_lof"):
+        from help_functions import calculate_lof, fit_evaluation_models, relative_proximity
+
+        X_2d = X[:, :, 0]
+        cf_samples = X_2d + 0.1 * np.random.RandomState(RANDOM_STATE).randn(*X_2d.shape)
+        n_neighbors_lof = int(np.cbrt(n_samples))
+        lof_pos, nn_pos = fit_evaluation_models(n_neighbors_lof, 1, X_2d[y == 1])
+        lof_neg, nn_neg = fit_evaluation_models(n_neighbors_lof, 1, X_2d[y == 0])
+        if name == "relative_proximity":
+            return lambda: relative_proximity(X_2d, cf_samples, y, nn_pos, nn_neg)
+        return lambda: calculate_lof(cf_samples, y, lof_pos, lof_neg)
+
+    raise ValueError(f"Unknown kernel '{name}', choose one of {KERNELS}.")
+
+
+def timed(kernel, repeats):
+    seconds = []
+    for _ in range(repeats):
+        matrix_profile_cache.clear()
+        background_cache.clear()
+        start = time.perf_counter()
+        kernel()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def run(name, X, y, model, A):
+    # warm up on a few samples of each label, e.g. the numba kernels of stumpy and the DTW
+    warmup = np.concatenate([np.flatnonzero(y == label)[:4] for label in (0, 1)])
+    make_kernel(name, X[warmup], y[warmup], model, A)()
+    kernel = make_kernel(name, X, y, model, A)
+    seconds = timed(kernel, A.repeats)
+    return dict(
+        kernel=name,
+        seconds=float(np.median(seconds)),
+        seconds_min=float(np.min(seconds)),
+        seconds_per_sample=float(np.median(seconds)) / X.shape[0],
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--kernels", nargs="+", choices=KERNELS, default=KERNELS)
+    parser.add_argument("--lengths", nargs="+", type=int, default=[24, 128, 512, 2709])
+    parser.add_argument("--n-samples", nargs="+", type=int, default=[10, 100])
+    parser.add_argument("--dataset", type=str, default=None, help="UCR dataset instead of synthetic series.")
+    parser.add_argument("--n-intervals", type=int, default=None, help="Of `get_global_weights`, default to one per timestep.")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON.")
+    A = parser.parse_args()
+
+    from help_functions import reset_seeds
+    from keras_models import Classifier_FCN
+
+    # the LIMESegment and LOF warnings, see `ModifiedLatentCF._get_step_weights`
+    warnings.simplefilter("ignore")
+
+    if A.dataset is not None:
+        datasets = {A.dataset: lambda n: dataset_samples(A.dataset, n)}
+    else:
+        datasets = {
+            f"synthetic-{length}": (lambda n, length=length: synthetic_dataset(n, length))
+            for length in A.lengths
+        }
+
+    results = []
+    for dataset_name, load in datasets.items():
+        for n_samples in A.n_samples:
+            X, y = load(n_samples)
+            reset_seeds()
+            model = Classifier_FCN(X.shape[1:], 2)
+
+            rows = []
+            for name in A.kernels:
+                row = run(name, X, y, model, A)
+                row.update(series=dataset_name, length=X.shape[1], n_samples=X.shape[0])
+                rows.append(row)
+                print(
+                    f"{dataset_name:>18} n={X.shape[0]:<5} {name:>18}: {row['seconds']:.4f}s, "
+                    f"{row['seconds_per_sample']:.5f}s per sample"
+                )
+            dominant = max(rows, key=lambda row: row["seconds"])
+            print(
+                f"{dataset_name:>18} n={X.shape[0]:<5} dominated by {dominant['kernel']} "
+                f"({dominant['seconds'] / sum(row['seconds'] for row in rows):.0%} of the time)"
+            )
+            results.extend(rows)
+
+    if A.output is not None:
+        with open(A.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
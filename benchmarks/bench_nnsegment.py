@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark the matrix profile of `NNSegment`: exact vs. approximate (`scrump`), cold vs. cached
+
+Reports the time per series and how many of the exact change points are recovered
+by the approximate mode, within the tolerance of `NNSegment` (half the window size).
+
+    python benchmarks/bench_nnsegment.py --lengths 500 2709 --percentages 0.01 0.05 0.1
+    python benchmarks/bench_nnsegment.py --dataset HandOutlines --n-series 5
+"""
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from LIMESegment.Utils.explanations import NNSegment, matrix_profile_cache  # noqa: E402
+
+
+def synthetic_series(n_series, length, random_state=39):
+    # random walks with a few level shifts, i.e. with change points to find
+    rng = np.random.RandomState(random_state)
+    series = np.cumsum(rng.randn(n_series, length), axis=1)
+    for s in series:
+        for cp in rng.choice(np.arange(length // 10, length - length // 10), 3, replace=False):
+            s[cp:] += rng.choice([-1, 1]) * 5 * s.std()
+    return series[:, :, np.newaxis]
+
+
+def dataset_series(name, n_series):
+    from wildboar.datasets import load_dataset
+
+    X, _ = load_dataset(name, repository="wildboar/ucr")
+    return X[:n_series, :, np.newaxis].astype(np.float64)
+
+
+def recovered_fraction(exact_cp, approx_cp, tolerance):
+    if not exact_cp:
+        return 1.0
+    approx_cp = np.asarray(approx_cp)
+    return float(
+        np.mean([approx_cp.size > 0 and np.abs(approx_cp - cp).min() <= tolerance for cp in exact_cp])
+    )
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def run(series, window_size, change_points, percentages):
+    # compile the numba kernels of stumpy before timing
+    warmup = synthetic_series(1, 4 * window_size)[0]
+    NNSegment(warmup, window_size, change_points)
+    for p in percentages:
+        NNSegment(warmup, window_size, change_points, p)
+
+    exact_cps = [NNSegment(t, window_size, change_points) for t in series]
+
+    rows = []
+    for mode in [None] + list(percentages):
+        matrix_profile_cache.clear()
+        cold, cached, recovered = [], [], []
+        for t, exact_cp in zip(series, exact_cps):
+            cp, t_cold = timed(lambda: NNSegment(t, window_size, change_points, mode))
+            _, t_cached = timed(lambda: NNSegment(t, window_size, change_points, mode))
+            cold.append(t_cold)
+            cached.append(t_cached)
+            if mode is not None:
+                recovered.append(recovered_fraction(exact_cp, cp, int(window_size / 2)))
+        rows.append(
+            dict(
+                mode="exact" if mode is None else f"scrump-{mode}",
+                seconds_cold=float(np.mean(cold)),
+                seconds_cached=float(np.mean(cached)),
+                recovered_change_points=float(np.mean(recovered)) if recovered else 1.0,
+            )
+        )
+    return rows
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--lengths", nargs="+", type=int, default=[500, 1000, 2709])
+    parser.add_argument("--dataset", type=str, default=None, help="UCR dataset instead of synthetic series.")
+    parser.add_argument("--n-series", type=int, default=5)
+    parser.add_argument("--window-size", type=int, default=None, help="Default to 1/5 of the length, as LIMESegment.")
+    parser.add_argument("--change-points", type=int, default=3)
+    parser.add_argument("--percentages", nargs="+", type=float, default=[0.01, 0.05, 0.1, 0.25])
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON.")
+    A = parser.parse_args()
+
+    if A.dataset is not None:
+        datasets = {A.dataset: dataset_series(A.dataset, A.n_series)}
+    else:
+        datasets = {f"synthetic-{n}": synthetic_series(A.n_series, n) for n in A.lengths}
+
+    results = []
+    for name, series in datasets.items():
+        window_size = A.window_size or int(series.shape[1] / 5)
+        for row in run(series, window_size, A.change_points, A.percentages):
+            row.update(series=name, length=series.shape[1], window_size=window_size)
+            results.append(row)
+            print(
+                f"{name:>18} {row['mode']:>14}: {row['seconds_cold']:.4f}s cold, "
+                f"{row['seconds_cached']:.5f}s cached, "
+                f"{row['recovered_change_points']:.2f} of the exact change points recovered"
+            )
+
+    if A.output is not None:
+        with open(A.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import numpy as np
+from numba import njit, prange
+
+
+@njit(nogil=True, cache=True)
+def _dtw(query, candidate, window, max_dist):
+    n, m = query.shape[0], candidate.shape[0]
+    prev = np.full(m + 1, np.inf)
+    curr = np.full(m + 1, np.inf)
+    prev[0] = 0.0
+
+    for i in range(1, n + 1):
+        curr[:] = np.inf
+        row_min = np.inf
+        for j in range(max(1, i - window), min(m, i + window) + 1):
+            # L1 distance between the timesteps, as the default of `fastdtw`
+            cost = 0.0
+            for k in range(query.shape[1]):
+                cost += abs(query[i - 1, k] - candidate[j - 1, k])
+            curr[j] = cost + min(prev[j - 1], prev[j], curr[j - 1])
+            if curr[j] < row_min:
+                row_min = curr[j]
+        # early abandoning: the cost of any path only grows from here
+        if row_min > max_dist:
+            return np.inf
+        prev, curr = curr, prev
+
+    # the last row may have cells within `max_dist`, but not the end of the path
+    return prev[m] if prev[m] <= max_dist else np.inf
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def _dtw_many(query, candidates, window, max_dist):
+    distances = np.empty(candidates.shape[0])
+    for c in prange(candidates.shape[0]):
+        distances[c] = _dtw(query, candidates[c], window, max_dist)
+    return distances
+
+
+def dtw_distances(query, candidates, window=None, max_dist=np.inf):
+    """
+    DTW distances between one query and many candidates, in parallel and without the GIL.
+
+    query : array of shape [T] or [T, D]
+    candidates : array of shape [n, T'] or [n, T', D]
+    window : int, optional
+        Sakoe-Chiba band radius in timesteps, if None the full (exact) DTW is computed.
+        The band is widened to at least |T - T'| so that a warping path exists.
+    max_dist : float, optional
+        Early abandoning threshold, candidates whose distance exceeds it get `inf`.
+    """
+    query = np.asarray(query, dtype=np.float64)
+    candidates = np.asarray(candidates, dtype=np.float64)
+    if query.ndim == 1:
+        query = query[:, np.newaxis]
+        candidates = candidates[..., np.newaxis]
+
+    n, m = query.shape[0], candidates.shape[1]
+    window = max(n, m) if window is None else max(int(window), abs(n - m))
+    return _dtw_many(
+        np.ascontiguousarray(query), np.ascontiguousarray(candidates), window, float(max_dist)
+    )
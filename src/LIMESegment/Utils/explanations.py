@@ -1,150 +1,247 @@
 
-from scipy import signal
 import numpy as np
 import stumpy
 from sklearn.linear_model import Ridge
 from sklearn.utils import check_random_state
 from fastdtw import fastdtw
 import random
+import threading
 
-def NNSegment(t, window_size, change_points):
+from .cache import ArrayLRUCache
+from .dtw import dtw_distances
+from .perturbations import backgroundIdentification_batch, segment_mask
+
+# nearest neighbor indexes of the matrix profile, keyed on the series, window size and mode.
+# The same sample is segmented once per learning rate and autoencoder, the matrix profile only depends on the series.
+matrix_profile_cache = ArrayLRUCache(maxsize=256)
+# held while `scrump` runs on the reseeded global numpy RNG
+_scrump_lock = threading.Lock()
+
+
+def matrix_profile_index(t, window_size, percentage=None):
+    """
+    Nearest neighbor index of every subsequence of the first dimension of `t`, of shape [n_timesteps, n_features].
+    percentage : float, optional
+        If given, approximate the matrix profile with `stumpy.scrump`, computing this fraction of the distances.
+        Only for univariate series, multivariate series always use the exact `mstump`.
+    """
+    if t.shape[1] > 1:
+        percentage = None
+
+    key = matrix_profile_cache.key(t, window_size, percentage)
+    nn_idx = matrix_profile_cache.get(key)
+    if nn_idx is not None:
+        return nn_idx
+
+    if percentage is None:
+        # Use matrix profile for multivariate time series, `mstump` expects the dimensions along the rows
+        _, mp_idx = stumpy.mstump(t.T, m=window_size)
+        # Here, we consider the first dimension for the nearest neighbor change detection
+        nn_idx = mp_idx[0]
+    else:
+        # `scrump` draws its diagonals from the global numpy RNG and takes no seed, fix it so that cached and
+        # fresh results agree; the lock keeps concurrent calls, e.g. of a prefetch thread, from interleaving
+        with _scrump_lock:
+            rng_state = np.random.get_state()
+            np.random.seed(0)
+            try:
+                approx = stumpy.scrump(t[:, 0].astype(np.float64), m=window_size, percentage=percentage, pre_scrump=True)
+                approx.update()
+            finally:
+                np.random.set_state(rng_state)
+        nn_idx = approx.I_
+
+    nn_idx = np.asarray(nn_idx, dtype=np.int64)
+    matrix_profile_cache.put(key, nn_idx)
+    return nn_idx
+
+
+def NNSegment(t, window_size, change_points, mp_percentage=None):
     
     n_timesteps, n_features = t.shape
     
-    # Use matrix profile for multivariate time series
-    mp = stumpy.mstump(t, m=window_size)
-    
-    # Here, we consider the first dimension for the nearest neighbor change detection
-    proposed_cp = [i for i in range(0, mp.shape[0]-1) if mp[i+1, 0, 1] != mp[i, 0, 1] + 1]
+    nn_idx = matrix_profile_index(t, window_size, mp_percentage)
+    proposed_cp = np.flatnonzero(nn_idx[1:] != nn_idx[:-1] + 1)
     
     tolerance = int(window_size/2)
-    variances = []
-
-    for idx in proposed_cp:
-        mean_change = np.abs(np.mean(t[idx-tolerance:idx, :], axis=0) - np.mean(t[idx:idx+tolerance, :], axis=0))
-        std_change = np.abs(np.std(t[idx-tolerance:idx, :], axis=0) - np.std(t[idx:idx+tolerance, :], axis=0))
-        
-        # We aggregate the mean and std changes across features using their L2 norm (Euclidean distance)
-        mean_change_norm = np.linalg.norm(mean_change)
-        std_change_norm = np.linalg.norm(std_change)
-        
-        std_mean = np.mean([np.linalg.norm(np.std(t[idx-tolerance:idx, :], axis=0)), np.linalg.norm(np.std(t[idx:idx+tolerance, :], axis=0))])
-        
-        variances.append(mean_change_norm * std_change_norm / std_mean)
+    variances = _change_scores(t, proposed_cp, tolerance)
     
-    sorted_idx = np.flip(np.array(variances).argsort())
-    sorted_cp = [proposed_cp[idx] for idx in sorted_idx]
+    # the scores equal those of a loop over the change points, so ties are broken the same way
+    sorted_cp = proposed_cp[np.flip(variances.argsort())]
     
     selected_cp = []
-    covered = list(np.arange(0, tolerance))
-    ic, i = 0, 0
-    while ic < change_points:
-        if i == len(sorted_cp):
+    covered = np.zeros(n_timesteps + tolerance, dtype=bool)
+    covered[:tolerance] = True
+    for cp in sorted_cp:
+        if len(selected_cp) >= change_points:
             break
-        if sorted_cp[i] not in covered:
-            ic += 1
-            selected_cp.append(sorted_cp[i])
-            covered = covered + list(np.arange(sorted_cp[i], sorted_cp[i]+tolerance))
-            covered = covered + list(np.arange(sorted_cp[i]-tolerance, sorted_cp[i]))
-        i += 1
+        if not covered[cp]:
+            selected_cp.append(cp)
+            covered[max(cp-tolerance, 0):cp+tolerance] = True
     selected_cp = np.sort(np.asarray(selected_cp))
     
     return list(selected_cp)
 
 
 
-def backgroundIdentification(original_signal, f=40):
+def _change_scores(t, proposed_cp, tolerance):
     """
-    Adjusted for multivariate time series.
+    Change in mean and std between the `tolerance` timesteps before and after each proposed change point,
+    aggregated across features by their L2 norm. All windows are reduced in one call.
     """
+    n_timesteps, n_features = t.shape
+    if tolerance == 0 or len(proposed_cp) == 0:
+        # empty windows, as `np.mean` of an empty slice
+        return np.full(len(proposed_cp), np.nan)
 
-    n_timesteps, n_features = original_signal.shape
-    xrec_all_features = []
-
-    for feature_idx in range(n_features):
-        feature_signal = original_signal[:, feature_idx]
-
-        # Calculating the Short-Time Fourier Transform (STFT) for the current feature
-        f, t, Zxx = signal.stft(feature_signal, 1, nperseg=f)
-        frequency_composition_abs = np.abs(Zxx)
-        measures = []
+    offsets = np.arange(tolerance)
+    # proposed change points end a window of the matrix profile, the windows after them are always complete
+    before = t[np.clip(proposed_cp[:, np.newaxis] - tolerance + offsets, 0, None)]
+    after = t[np.minimum(proposed_cp[:, np.newaxis] + offsets, n_timesteps - 1)]
 
-        for freq, freq_composition in zip(f, frequency_composition_abs):
-            measures.append(np.mean(freq_composition) / np.std(freq_composition))
+    mean_before, mean_after = before.mean(axis=1), after.mean(axis=1)
+    std_before, std_after = before.std(axis=1), after.std(axis=1)
+    # the window before the first `tolerance` timesteps is an empty slice, i.e. NaN
+    empty = proposed_cp < tolerance
+    mean_before[empty] = np.nan
+    std_before[empty] = np.nan
 
-        max_value = max(measures)
-        selected_frequency = measures.index(max_value)
-        weights = 1 - (measures / sum(measures))
-        dummymatrix = np.zeros((len(f), len(t)))
-        dummymatrix[selected_frequency, :] = 1
+    def norm(a):
+        # row-wise L2 norm
+        return np.sqrt(np.einsum('ij,ij->i', a, a))
 
-        background_frequency = Zxx * dummymatrix
+    mean_change_norm = norm(np.abs(mean_before - mean_after))
+    std_change_norm = norm(np.abs(std_before - std_after))
+    std_mean = (norm(std_before) + norm(std_after)) / 2
 
-        # Using the Inverse Short-Time Fourier Transform (ISTFT) to reconstruct the background signal
-        _, xrec = signal.istft(background_frequency, 1)
-        xrec = xrec[:n_timesteps]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return mean_change_norm * std_change_norm / std_mean
 
-        xrec_all_features.append(xrec)
 
-    xrec_all_features = np.stack(xrec_all_features, axis=-1)
-    return xrec_all_features
+def backgroundIdentification(original_signal, f=40):
+    """
+    Adjusted for multivariate time series, the background of each feature is identified on its own.
+    `f` is the segment length of the STFT, all features are transformed in one batched (and cached) call.
+    """
+    return backgroundIdentification_batch(original_signal[np.newaxis], nperseg=f)[0]
 
-def RBP(generated_samples_interpretable, original_signal, segment_indexes, f):
+def RBP(generated_samples_interpretable, original_signal, segment_indexes, out=None):
     """
     Adjusted for multivariate time series.
     """
 
     n_timesteps, n_features = original_signal.shape
-    generated_samples_raw = []
 
     # Assuming each feature of the original signal has its own distinct background
     # Thus, extracting background for each feature separately
-    xrec = np.stack([backgroundIdentification(original_signal[:, feature_idx]) for feature_idx in range(n_features)], axis=-1)
-
-    for sample_interpretable in generated_samples_interpretable:
-        raw_signal = original_signal.copy()
+    xrec = backgroundIdentification(original_signal)
 
-        for index in range(len(sample_interpretable) - 1):
-            if sample_interpretable[index] == 0:
-                index0 = segment_indexes[index]
-                index1 = segment_indexes[index+1]
-                raw_signal[index0:index1, :] = xrec[index0:index1, :]
-        
-        generated_samples_raw.append(np.asarray(raw_signal))
+    # All perturbed samples at once: the background where a segment is switched off, else the original
+    mask = segment_mask(generated_samples_interpretable, segment_indexes, n_timesteps)
+    if out is None:
+        out = np.empty((len(mask), n_timesteps, n_features), dtype=original_signal.dtype)
+    np.copyto(out, original_signal)
+    np.copyto(out, xrec, where=mask[:, :, np.newaxis], casting='unsafe')
 
-    return np.asarray(generated_samples_raw)
+    return out
     
-def LIMESegment(example, model, model_type='class', distance='dtw', n=100, window_size=None, cp=None, f=None, random_state=None):
+def LIMESegment(example, model, model_type='class', distance='dtw', n=100, window_size=None, cp=None, f=None, random_state=None, dtw_backend='numba', dtw_window=None, mp_percentage=None):
+    """
+    `dtw_backend='numba'` computes the exact DTW distances (within a Sakoe-Chiba band of
+    `dtw_window` timesteps, if given) in one parallel call; 'fastdtw' reproduces the original
+    approximate distances.
+    `mp_percentage` segments univariate examples with the approximate matrix profile of `stumpy.scrump`.
+    `f` is not used, as in the original: the backgrounds use the STFT segment length of `backgroundIdentification`.
+    """
     random_state = check_random_state(random_state)
+
+    cp_indexes, segment_indexes, generated_samples_interpretable, generated_samples_raw = _perturb(
+        example, n, window_size, cp, random_state, mp_percentage
+    )
+    sample_predictions = model.predict(generated_samples_raw)
+
+    coef = _fit_surrogate(
+        example, generated_samples_interpretable, generated_samples_raw, sample_predictions,
+        cp_indexes, segment_indexes, model_type, distance, n, random_state, dtw_backend, dtw_window
+    )
+    return coef, segment_indexes
+
+
+def LIMESegment_batch(examples, model, model_type='class', distance='dtw', n=100, window_size=None, cp=None, f=None, random_state=None, dtw_backend='numba', dtw_window=None, mp_percentage=None, chunk_size=4096):
+    """
+    LIMESegment for many examples, with one classifier pass over the perturbations of all examples.
+
+    `model_type` is either shared by all examples or given per example. Returns the list of
+    `(coef, segment_indexes)` of `LIMESegment`, with the same results as one call per example.
+    """
+    if isinstance(model_type, (str, int, np.integer)):
+        model_type = [model_type] * len(examples)
+
+    # One random state per example, as if `LIMESegment` was called for each of them
+    random_states = [check_random_state(random_state) for _ in range(len(examples))]
+    # the backgrounds of all examples in one STFT, `RBP` reads them from the cache
+    backgroundIdentification_batch(examples)
+    perturbations = [
+        _perturb(example, n, window_size, cp, rs, mp_percentage) for example, rs in zip(examples, random_states)
+    ]
+
+    sample_predictions = _predict_in_chunks(
+        model, np.concatenate([p[3] for p in perturbations], axis=0), chunk_size
+    )
+
+    explanations = []
+    for i, (example, (cp_indexes, segment_indexes, interpretable, raw)) in enumerate(zip(examples, perturbations)):
+        coef = _fit_surrogate(
+            example, interpretable, raw, sample_predictions[i*n:(i+1)*n],
+            cp_indexes, segment_indexes, model_type[i], distance, n, random_states[i], dtw_backend, dtw_window
+        )
+        explanations.append((coef, segment_indexes))
+    return explanations
+
+
+def _perturb(example, n, window_size, cp, random_state, mp_percentage=None):
     n_timesteps, n_features = example.shape
 
     if window_size is None:
         window_size = int(n_timesteps/5)
     if cp is None:
         cp = 3
-    if f is None: 
-        f = int(n_timesteps/10)
     
     # Adjusting to keep the multivariate structure
-    cp_indexes = NNSegment(example, window_size, cp, n_features) 
+    cp_indexes = NNSegment(example, window_size, cp, mp_percentage)
     segment_indexes = [0] + cp_indexes + [-1]
     
     # Adjusting random samples generation for multivariate series
     generated_samples_interpretable = [random_state.binomial(1, 0.5, len(cp_indexes) + 1) for _ in range(0, n)]
-    generated_samples_raw = RBP(generated_samples_interpretable, example, segment_indexes, f, n_features) 
-    
-    sample_predictions = model.predict(generated_samples_raw)
-    
+    generated_samples_raw = RBP(generated_samples_interpretable, example, segment_indexes) 
+
+    return cp_indexes, segment_indexes, generated_samples_interpretable, generated_samples_raw
+
+
+def _predict_in_chunks(model, samples, chunk_size):
+    # `predict_on_batch` skips the per-call overhead of keras `predict`
+    predict = model.predict_on_batch if hasattr(model, 'predict_on_batch') else model.predict
+    return np.concatenate(
+        [np.asarray(predict(samples[i:i+chunk_size])) for i in range(0, len(samples), chunk_size)], axis=0
+    )
+
+
+def _fit_surrogate(example, generated_samples_interpretable, generated_samples_raw, sample_predictions, cp_indexes, segment_indexes, model_type, distance, n, random_state, dtw_backend='numba', dtw_window=None):
+    n_timesteps, n_features = example.shape
+
     if model_type == 'proba':
         y_labels = np.argmax(sample_predictions, axis=1)
-    elif isinstance(model_type, int):
+    elif isinstance(model_type, (int, np.integer)):
         y_labels = sample_predictions[:, model_type]
     else:
         y_labels = sample_predictions
     
-    if distance == 'dtw':
+    if distance == 'dtw' and dtw_backend == 'fastdtw':
         distances = np.asarray([fastdtw(example, sample)[0] for sample in generated_samples_raw])
         weights = np.exp(-(np.abs((distances - np.mean(distances))/np.std(distances)).reshape(n,)))
+    elif distance == 'dtw':
+        distances = dtw_distances(example, generated_samples_raw, window=dtw_window)
+        weights = np.exp(-(np.abs((distances - np.mean(distances))/np.std(distances)).reshape(n,)))
     elif distance == 'euclidean':
         distances = np.asarray([np.linalg.norm(np.ones((len(cp_indexes) + 1, n_features)) - x, axis=1) for x in generated_samples_interpretable])
         weights = np.exp(-(np.abs(distances**2/0.75*(len(segment_indexes)**2)).reshape(n,)))
@@ -152,8 +249,7 @@ def LIMESegment(example, model, model_type='class', distance='dtw', n=100, windo
     clf = Ridge(random_state=random_state)
     clf.fit(generated_samples_interpretable, y_labels, weights)
     
-    return clf.coef_, segment_indexes
-
+    return clf.coef_
 
 
 
@@ -1,5 +1,7 @@
 import numpy as np
 
+from .perturbations import backgroundIdentification_batch
+
 
 def add_noise(ts):
     mu, sigma = 0, 0.1 # mean and standard deviation
@@ -22,13 +24,30 @@ def reverse_segment(ts, index0, index1):
     perturbed_ts[index0:index1] = np.flip(ts[index0:index1])
     return perturbed_ts
 
-def faithfulness(explanations, x_test, y_test, original_predictions, model, model_type):
+def background_segment(ts, background, index0, index1):
+    perturbed_ts = ts.copy()
+    perturbed_ts[index0:index1] = background[index0:index1]
+    return perturbed_ts
+
+def faithfulness(explanations, x_test, y_test, original_predictions, model, model_type, perturbation='reverse'):
+    """
+    perturbation : 'reverse' flips the most important segment, 'background' replaces it by the background
+    signal (`backgroundIdentification`), identified for all samples in one batched and cached call
+    """
+    if perturbation == 'background':
+        backgrounds = backgroundIdentification_batch(np.asarray(x_test))
+    elif perturbation != 'reverse':
+        raise ValueError(f"perturbation must be 'reverse' or 'background', got {perturbation!r}")
+
     perturbed_samples = []
     for i in range(0,len(explanations)):
         top_index = np.argmax(np.abs(explanations[i][0]))
         segment_indices = explanations[i][1]+[-1]
         example_ts = x_test[i].copy()
-        reversed_sample = reverse_segment(example_ts,segment_indices[top_index],segment_indices[top_index+1])
+        if perturbation == 'background':
+            reversed_sample = background_segment(example_ts,backgrounds[i],segment_indices[top_index],segment_indices[top_index+1])
+        else:
+            reversed_sample = reverse_segment(example_ts,segment_indices[top_index],segment_indices[top_index+1])
         perturbed_samples.append(reversed_sample)
 
     if model_type == 'proba':
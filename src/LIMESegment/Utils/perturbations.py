@@ -3,42 +3,89 @@ from scipy import signal
 import numpy as np
 from scipy.ndimage.filters import gaussian_filter
 
+from .cache import ArrayLRUCache
+
+# background signal of each sample, keyed on the sample and `nperseg`
+background_cache = ArrayLRUCache(maxsize=1024)
+
 
 def backgroundIdentification(original_signal):
-    f, t, Zxx = signal.stft(original_signal,1,nperseg=40)
+    """
+    Background signal of one sample, the reconstruction from its STFT frequency band with the
+    highest mean/std ratio. A single-sample call of `backgroundIdentification_batch`.
+    """
+    return backgroundIdentification_batch(np.asarray(original_signal)[np.newaxis])[0]
+
+def _backgrounds(signals, nperseg):
+    # one STFT over all rows of `signals`, of shape [n, T]
+    f, t, Zxx = signal.stft(signals, 1, nperseg=nperseg, axis=-1)
     frequency_composition_abs = np.abs(Zxx)
-    measures = []
-    for freq,freq_composition in zip(f,frequency_composition_abs):
-        measures.append(np.mean(freq_composition)/np.std(freq_composition))
-    max_value = max(measures)
-    selected_frequency = measures.index(max_value)
-    weights = 1-(measures/sum(measures))
-    dummymatrix = np.zeros((len(f),len(t)))
-    dummymatrix[selected_frequency,:] = 1  
-    #Option to admit information from other frequency bands
-    """dummymatrix = np.ones((len(f),len(t)))
-    for i in range(0,len(weights)):
-        dummymatrix[i,:] = dummymatrix[i,:] * weights[i]"""
-    
-    background_frequency = Zxx * dummymatrix
+    measures = np.mean(frequency_composition_abs, axis=-1) / np.std(frequency_composition_abs, axis=-1)
+    # the first maximum, as `measures.index(max(measures))`: NaN measures are skipped, unless the first one is NaN
+    selected_frequency = np.argmax(np.where(np.isnan(measures), -np.inf, measures), axis=-1)
+    selected_frequency[np.isnan(measures[:, 0])] = 0
+    dummymatrix = np.zeros(measures.shape)
+    dummymatrix[np.arange(len(signals)), selected_frequency] = 1
+
+    background_frequency = Zxx * dummymatrix[:, :, np.newaxis]
     _, xrec = signal.istft(background_frequency, 1)
-    return xrec
-
-def RBP(generated_samples_interpretable, original_signal, segment_indexes):
-    generated_samples_raw = []
-    xrec = backgroundIdentification(original_signal)
-    for sample_interpretable in generated_samples_interpretable:
-        raw_signal = original_signal.copy()
-        for index in range(0,len(sample_interpretable)-1):
-            if sample_interpretable[index] == 0:
-                index0 = segment_indexes[index]
-                index1 = segment_indexes[index+1]
-                raw_signal[index0:index1] = xrec[index0:index1]
-        generated_samples_raw.append(np.asarray(raw_signal))
-    return np.asarray(generated_samples_raw)
+    return xrec[:, :signals.shape[1]]
+
+def backgroundIdentification_batch(signals, nperseg=40, use_cache=True):
+    """
+    Background signals of many samples of shape [n, T] or [n, T, D], each feature on its own as in
+    `backgroundIdentification`. The STFT runs once over all samples and features, cached samples are skipped.
+    Returns an array of the shape of `signals`.
+    """
+    signals = np.asarray(signals)
+    backgrounds = np.empty(signals.shape)
+    keys = [background_cache.key(x, nperseg) for x in signals] if use_cache else [None] * len(signals)
+    missing = []
+    for i, key in enumerate(keys):
+        cached = background_cache.get(key) if use_cache else None
+        if cached is None:
+            missing.append(i)
+        else:
+            backgrounds[i] = cached
+
+    if missing:
+        # features along the rows, next to the samples: [n, T, D] -> [n*D, T]
+        rows = np.moveaxis(signals[missing].reshape(len(missing), signals.shape[1], -1), 1, -1)
+        xrec = _backgrounds(rows.reshape(-1, signals.shape[1]), nperseg)
+        xrec = np.moveaxis(xrec.reshape(rows.shape), -1, 1).reshape((len(missing),) + signals.shape[1:])
+        for i, background in zip(missing, xrec):
+            backgrounds[i] = background
+            if use_cache:
+                background_cache.put(keys[i], background)
+
+    return backgrounds
+
+def segment_mask(generated_samples_interpretable, segment_indexes, n_timesteps):
+    """
+    Boolean [n, T] mask of the perturbed timesteps, `True` where a switched-off segment
+    (a 0 in the interpretable vector) is replaced by the background. As in the original
+    loop, the last segment of the interpretable vectors is never perturbed.
+    """
+    interpretable = np.asarray(generated_samples_interpretable)
+    n_segments = interpretable.shape[1] - 1
+    membership = np.zeros((n_segments, n_timesteps), dtype=np.int32)
+    for index in range(0, n_segments):
+        membership[index, segment_indexes[index]:segment_indexes[index+1]] = 1
+    return np.dot((interpretable[:, :n_segments] == 0).astype(np.int32), membership) > 0
+
+def RBP(generated_samples_interpretable, original_signal, segment_indexes, out=None):
+    xrec = backgroundIdentification_batch(original_signal[np.newaxis])[0]
+    mask = segment_mask(generated_samples_interpretable, segment_indexes, len(original_signal))
+    if out is None:
+        out = np.empty((len(mask),) + original_signal.shape, dtype=original_signal.dtype)
+    # broadcast the [n, T] mask over the remaining axes of the signal
+    mask = mask.reshape(mask.shape + (1,) * (original_signal.ndim - 1))
+    np.copyto(out, original_signal)
+    np.copyto(out, xrec, where=mask, casting='unsafe')
+    return out
 
 def RBPIndividual(original_signal, index0, index1):
-    xrec = backgroundIdentification(original_signal)
+    xrec = backgroundIdentification_batch(original_signal[np.newaxis])[0]
     raw_signal = original_signal.copy()
     raw_signal[index0:index1] = xrec[index0:index1]
     return raw_signal
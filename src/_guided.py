@@ -1,11 +1,20 @@
+import functools
+import os
+import queue
+import tempfile
+import threading
+import time
 import warnings
+from contextlib import contextmanager, nullcontext
 
 import numpy as np
 import tensorflow as tf
+from sklearn.neighbors import NearestNeighbors
+from sklearn.utils import check_random_state
 from tensorflow import keras
 
-from wildboar.explain import IntervalImportance
-from LIMESegment.Utils.explanations import LIMESegment
+from LIMESegment.Utils.explanations import LIMESegment, LIMESegment_batch
+from profiling import get_profiler
 
 
 class ModifiedLatentCF:
@@ -30,6 +39,19 @@ class ModifiedLatentCF:
         pred_margin_weight=1.0,  # weighted_steps_weight = 1 - pred_margin_weight
         step_weights="local",
         random_state=None,
+        batch_size=None,
+        compile_search=False,
+        jit_compile=False,
+        step_weights_cache=None,
+        local_weights_executor=None,
+        prefetch=0,
+        plateau_tol=None,
+        plateau_patience=10,
+        refine_iter=None,
+        max_total_iter=None,
+        warm_start=None,
+        nun_index=None,
+        mp_percentage=None,
     ):
         """
         Parameters
@@ -52,6 +74,71 @@ class ModifiedLatentCF:
             - if None the sample is generated in the original space
             - if given, the autoencoder is expected to have `k` decoder layer and `k`
               encoding layers.
+
+        batch_size : int, optional
+            The number of samples searched jointly in one variable
+
+            - if None each sample is searched on its own, one after another
+            - if given, blocks of `batch_size` samples are optimised together and
+              each sample is frozen as soon as it meets the stopping criterion
+
+        compile_search : bool, optional
+            Run the whole search loop of a sample in one `tf.function`, requires
+            an optimizer from `tf.keras.optimizers.legacy`
+
+        jit_compile : bool, optional
+            Compile the search loop with XLA, only used if `compile_search=True`
+
+        step_weights_cache : StepWeightCache, optional
+            Cache of the "local" step weights, used if `random_state` is an int
+
+        local_weights_executor : LocalWeightsExecutor, optional
+            Compute the "local" step weights in worker processes, all samples are
+            submitted up front and the search runs while the workers compute
+
+        prefetch : int, optional
+            Compute the step weights of up to `prefetch` samples (or batches)
+            ahead in a background thread, while the current one is searched;
+            0 computes them one after another
+
+        plateau_tol : float, optional
+            Stop a sample when its loss decreased by less than `plateau_tol`,
+            relative to the loss `plateau_patience` iterations before
+
+        plateau_patience : int, optional
+            The number of iterations of the plateau test
+
+        refine_iter : int, optional
+            Stop a sample `refine_iter` iterations after it first became valid,
+            i.e. spend at most `refine_iter` iterations on its proximity; a
+            sample that turns invalid again is restored to its previous state
+            and stopped. 0 stops the samples as soon as they are valid
+
+        max_total_iter : int, optional
+            The maximum number of iterations of all samples searched together,
+            i.e. of a block of `batch_size` samples or of all samples of a call
+            of `transform` searched one after another; the remaining samples are
+            stopped once the budget is spent
+
+        The iterations saved by each policy, i.e. `max_iter` minus the iterations
+        of the samples it stopped, are reported by `transform` as `n_iter_saved_`.
+        The policies are not supported with `compile_search`.
+
+        warm_start : float, optional
+            Start the search of a sample from `(1 - warm_start) * z + warm_start * z_nun`,
+            where `z` is its latent code and `z_nun` the code of its nearest unlike
+            neighbour, i.e. the nearest training sample of the desired label; if
+            None the search starts from `z`
+
+        nun_index : LatentNUNIndex, optional
+            The index of the latent codes of the training samples, in the latent
+            space of `autoencoder`; if None and `warm_start` is given, it is built
+            by `fit`
+
+        mp_percentage : float, optional
+            Segment the samples of the "local" step weights with the approximate
+            matrix profile of `stumpy.scrump`, computing this fraction of the
+            distances; if None the exact matrix profile
         """
         self.optimizer_ = (
             tf.optimizers.Adam(learning_rate=1e-4) if optimizer is None else optimizer
@@ -68,8 +155,26 @@ class ModifiedLatentCF:
 
         self.step_weights = step_weights
         self.random_state = random_state
-
-    def fit(self, model):
+        self.batch_size = batch_size
+        self.compile_search = compile_search
+        self.jit_compile = jit_compile
+        self.search_kernel_ = None
+        self.step_weights_cache = step_weights_cache
+        self.local_weights_executor = local_weights_executor
+        self.prefetch = prefetch
+        self.plateau_tol = plateau_tol
+        self.plateau_patience = plateau_patience
+        self.refine_iter = refine_iter
+        self.max_total_iter = max_total_iter
+        self.warm_start = warm_start
+        self.nun_index = nun_index
+        if mp_percentage is not None:
+            # the default parameters (and cache keys) are left unchanged
+            self.local_weights_params = dict(self.local_weights_params, mp_percentage=mp_percentage)
+        # held by the gradient search while the step weights are prefetched, see `_explained_model`
+        self._model_lock = threading.Lock()
+
+    def fit(self, model, X=None, y=None):
         """Fit a new counterfactual explainer to the model
 
         Paramaters
@@ -77,7 +182,18 @@ class ModifiedLatentCF:
 
         model : keras.Model
             The model
+
+        X : array-like of shape [n_samples, n_timestep, n_dims], optional
+            The training samples, indexed for `warm_start` if `nun_index` is None
+
+        y : array-like of shape [n_samples], optional
+            The labels of `X`, if None the labels predicted by `model`
         """
+        if self.compile_search and self._has_convergence_policy():
+            raise ValueError(
+                "compile_search only supports the default stopping criterion, "
+                "set plateau_tol, refine_iter and max_total_iter to None."
+            )
         if self.autoencoder:
             (
                 encode_input,
@@ -91,8 +207,33 @@ class ModifiedLatentCF:
             self.decoder_ = None
             self.encoder_ = None
         self.model_ = model
+
+        self.nun_index_ = self.nun_index
+        if self.warm_start is not None and self.nun_index_ is None:
+            if X is None:
+                raise ValueError("warm_start requires either a nun_index or the training samples X.")
+            if y is None:
+                y = np.argmax(model.predict(X), axis=1)
+            codes = X if self.encoder_ is None else self.encoder_.predict(X)
+            self.nun_index_ = LatentNUNIndex().fit(codes, y)
         return self
 
+    def _initial_z(self, x, pred_labels):
+        """The starting point of the search, the latent code of `x` or, with
+        `warm_start`, its interpolation towards the nearest unlike neighbour"""
+        if self.autoencoder is not None:
+            get_profiler().count("encoder_calls")
+            z = self.encoder_(x)
+        else:
+            z = tf.convert_to_tensor(x, dtype=tf.float32)
+        if self.warm_start is None:
+            return z
+
+        z_nun = self.nun_index_.query(z.numpy(), 1 - np.asarray(pred_labels))  # for binary classification
+        return (1 - self.warm_start) * z + self.warm_start * tf.convert_to_tensor(
+            z_nun, dtype=tf.float32
+        )
+
     def predict(self, x):
         """Compute the difference between the desired and actual probability
 
@@ -101,6 +242,7 @@ class ModifiedLatentCF:
         x : Variable
             Variable of the sample
         """
+        self._count_forward()
         if self.autoencoder is None:
             z = x
         else:
@@ -108,6 +250,20 @@ class ModifiedLatentCF:
 
         return self.model_(z)
 
+    def _count_forward(self, n=1):
+        # only counted when run eagerly, the compiled search counts its passes once done
+        profiler = get_profiler()
+        if profiler.enabled and tf.executing_eagerly():
+            profiler.count("classifier_calls", n)
+            if self.autoencoder is not None:
+                profiler.count("decoder_calls", n)
+
+    def _decode(self, z):
+        if self.autoencoder is None:
+            return z.numpy()
+        get_profiler().count("decoder_calls")
+        return self.decoder_(z).numpy()
+
     # The "pred_margin_loss" is designed to measure the prediction probability to the desired decision boundary
     def pred_margin_mse(self, prediction):
         return self.mse_loss_(self.probability_, prediction)
@@ -134,6 +290,7 @@ class ModifiedLatentCF:
 
     # additional input of step_weights
     def compute_loss(self, original_sample, z_search, step_weights, target_label):
+        self._count_forward()
         loss = tf.zeros(shape=())
         decoded = self.decoder_(z_search) if self.autoencoder is not None else z_search
         pred = self.model_(decoded)[:, target_label]
@@ -155,6 +312,214 @@ class ModifiedLatentCF:
 
         return loss, pred_margin_loss, weighted_steps_loss
 
+    # Per-sample version of `compute_loss`, used by the batched search;
+    # `probability` and `pred_margin_weight` may be given per sample
+    def compute_sample_losses(
+        self,
+        original_sample,
+        z_search,
+        step_weights,
+        target_labels,
+        probability=None,
+        pred_margin_weight=None,
+    ):
+        probability = self.probability_ if probability is None else probability
+        if pred_margin_weight is None:
+            pred_margin_weight = self.pred_margin_weight
+        weighted_steps_weight = 1 - pred_margin_weight
+
+        self._count_forward()
+        decoded = self.decoder_(z_search) if self.autoencoder is not None else z_search
+        pred = tf.gather(self.model_(decoded), target_labels, axis=1, batch_dims=1)
+
+        pred_margin_loss = tf.math.square(probability - pred)
+        weighted_steps_loss = tf.math.reduce_mean(
+            tf.math.multiply(
+                tf.math.abs(
+                    tf.cast(original_sample, tf.float32) - tf.cast(decoded, tf.float32)
+                ),
+                tf.cast(step_weights, tf.float32),
+            ),
+            axis=[1, 2],
+        )
+        loss = (
+            pred_margin_weight * pred_margin_loss
+            + weighted_steps_weight * weighted_steps_loss
+        )
+
+        return loss, pred_margin_loss, weighted_steps_loss, pred
+
+    # Parameters of LIMESegment for the "local" step weights
+    local_weights_params = dict(cp=10, window_size=10, dtw_backend="numba")
+
+    def _get_step_weights(self, x_sample, pred_label):
+        # if self.step_weights == "global" OR "uniform"
+        if isinstance(self.step_weights, np.ndarray):  #  "global" OR "uniform"
+            return self.step_weights
+        elif self.step_weights == "local":
+            # ignore warning of matrix multiplication, from LIMESegment: `https://stackoverflow.com/questions/29688168/mean-nanmean-and-warning-mean-of-empty-slice`
+            # ignore warning of scipy package warning, from LIMESegment: `https://github.com/paulvangentcom/heartrate_analysis_python/issues/31`
+            with get_profiler().phase("step_weights"), _ignore_lime_warnings():
+                compute = functools.partial(
+                    get_local_weights,
+                    x_sample,
+                    self._explained_model(),
+                    random_state=self.random_state,
+                    pred_label=pred_label,
+                    **self.local_weights_params,
+                )
+                if not self._caches_step_weights():
+                    return compute()
+                return self.step_weights_cache.get_or_compute(
+                    x_sample, self.model_, compute, **self._cache_params(pred_label)
+                )
+        else:
+            raise NotImplementedError(
+                "step_weights not implemented, please choose 'local', 'global' or 'uniform'."
+            )
+
+    def _get_step_weights_batch(self, x, pred_labels):
+        """Step weights of all samples, with one LIMESegment pass for the "local" ones
+
+        Returns an array of shape [n_samples, 1, n_timestep, n_dims]
+        """
+        if not (isinstance(self.step_weights, str) and self.step_weights == "local"):
+            return np.stack(
+                [self._get_step_weights(x[i], pred_labels[i]) for i in range(x.shape[0])]
+            )
+        with get_profiler().phase("step_weights"):
+            return self._get_local_weights_batch(x, pred_labels)
+
+    def _get_local_weights_batch(self, x, pred_labels):
+        weights_all = np.empty((x.shape[0], 1, x.shape[1], x.shape[2]))
+        keys = [None] * x.shape[0]
+        missing = list(range(x.shape[0]))
+        if self._caches_step_weights():
+            keys = [
+                self.step_weights_cache.key(
+                    x[i], self.model_, **self._cache_params(pred_labels[i])
+                )
+                for i in range(x.shape[0])
+            ]
+            missing = []
+            for i, key in enumerate(keys):
+                weights = self.step_weights_cache.get(key)
+                if weights is None:
+                    missing.append(i)
+                else:
+                    weights_all[i] = weights
+
+        if missing and self.local_weights_executor is not None:
+            weights_missing = self.local_weights_executor.map(
+                x[missing],
+                np.asarray(pred_labels)[missing],
+                random_state=self.random_state,
+                **self.local_weights_params,
+            )
+        elif missing:
+            # see `_get_step_weights` for the ignored warnings
+            with _ignore_lime_warnings():
+                weights_missing = get_local_weights_batch(
+                    x[missing],
+                    self._explained_model(),
+                    random_state=self.random_state,
+                    pred_labels=np.asarray(pred_labels)[missing],
+                    **self.local_weights_params,
+                )
+        if missing:
+            for i, weights in zip(missing, weights_missing):
+                weights_all[i] = weights
+                if self._caches_step_weights():
+                    self.step_weights_cache.put(keys[i], weights)
+
+        return weights_all
+
+    def _prefetch(self, step_weights_iter):
+        if not self.prefetch:
+            return step_weights_iter
+        return self._prefetched(step_weights_iter)
+
+    def _prefetched(self, step_weights_iter):
+        # `warnings.catch_warnings` is not thread-safe, the filters of the
+        # prefetch thread are set here, see `_ignore_lime_warnings`
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            warnings.simplefilter("ignore", category=UserWarning)
+            yield from _prefetch(step_weights_iter, self.prefetch)
+
+    def _explained_model(self):
+        """The classifier explained by LIMESegment
+
+        With `prefetch`, its predictions in the prefetch thread wait for the
+        gradient search of the current sample, see `_searching`, as keras
+        models are not safe to call from several threads at once.
+        """
+        if not self.prefetch:
+            return self.model_
+        return _LockedModel(self.model_, self._model_lock)
+
+    def _searching(self):
+        return self._model_lock if self.prefetch else nullcontext()
+
+    def _submit_step_weights(self, x, pred_labels):
+        """Submit the "local" step weights of all samples to the executor
+
+        Returns one `(cache_key, weights_or_future)` pair per sample, cached
+        weights are not submitted again.
+        """
+        pending = []
+        for i in range(x.shape[0]):
+            key, weights = None, None
+            if self._caches_step_weights():
+                key = self.step_weights_cache.key(
+                    x[i], self.model_, **self._cache_params(pred_labels[i])
+                )
+                weights = self.step_weights_cache.get(key)
+            if weights is None:
+                (weights,) = self.local_weights_executor.submit(
+                    x[np.newaxis, i],
+                    [pred_labels[i]],
+                    random_state=self.random_state,
+                    **self.local_weights_params,
+                )
+            pending.append((key, weights))
+        return pending
+
+    def _collect_step_weights(self, key, weights):
+        if isinstance(weights, np.ndarray):
+            return weights
+        # the time spent waiting for the executor
+        with get_profiler().phase("step_weights"):
+            weights = weights.result()
+        if key is not None:
+            self.step_weights_cache.put(key, weights)
+        return weights
+
+    def _caches_step_weights(self):
+        # only deterministic weights can be reused
+        return self.step_weights_cache is not None and isinstance(
+            self.random_state, (int, np.integer)
+        )
+
+    def _cache_params(self, pred_label):
+        return dict(
+            pred_label=int(pred_label),
+            random_state=int(self.random_state),
+            **self.local_weights_params,
+        )
+
+    def _has_convergence_policy(self):
+        return (
+            self.plateau_tol is not None
+            or self.refine_iter is not None
+            or self.max_total_iter is not None
+        )
+
+    def _convergence_tracker(self, n_samples):
+        if not self._has_convergence_policy():
+            return None
+        return _ConvergenceTracker(self, n_samples, self.n_iter_saved_)
+
     # TODO: compatible with the counterfactuals of wildboar
     #       i.e., define the desired output target per label
     def transform(self, x, pred_labels):
@@ -162,74 +527,199 @@ class ModifiedLatentCF:
 
         x : array-like of shape [n_samples, n_timestep, n_dims]
             The samples
+
+        Sets `n_iter_` and `search_time_`, the number of iterations and the
+        seconds of the search of every sample, and `n_iter_saved_`.
         """
+        self.n_iter_saved_ = dict(plateau=0, refine=0, budget=0)
+        if self.batch_size:
+            return self._transform_batched(x, pred_labels)
 
         result_samples = np.empty(x.shape)
         losses = np.empty(x.shape[0])
+        self.n_iter_ = np.empty(x.shape[0], dtype=int)
+        self.search_time_ = np.empty(x.shape[0])
         # `weights_all` needed for debugging
         weights_all = np.empty((x.shape[0], 1, x.shape[1], x.shape[2]))
+        # the budget of `max_total_iter` is shared by all samples
+        tracker = self._convergence_tracker(1)
+
+        if self.local_weights_executor is not None and (
+            isinstance(self.step_weights, str) and self.step_weights == "local"
+        ):
+            pending = self._submit_step_weights(x, pred_labels)
+            step_weights_iter = (self._collect_step_weights(*p) for p in pending)
+        else:
+            step_weights_iter = self._prefetch(
+                self._get_step_weights(x[i], pred_labels[i]) for i in range(x.shape[0])
+            )
 
-        for i in range(x.shape[0]):
+        for i, step_weights in enumerate(step_weights_iter):
             if i % 25 == 0:
                 print(f"{i+1} samples been transformed.")
 
-            # if self.step_weights == "global" OR "uniform"
-            if isinstance(self.step_weights, np.ndarray):  #  "global" OR "uniform"
-                step_weights = self.step_weights
-            elif self.step_weights == "local":
-                # ignore warning of matrix multiplication, from LIMESegment: `https://stackoverflow.com/questions/29688168/mean-nanmean-and-warning-mean-of-empty-slice`
-                # ignore warning of scipy package warning, from LIMESegment: `https://github.com/paulvangentcom/heartrate_analysis_python/issues/31`
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    warnings.simplefilter("ignore", category=UserWarning)
-                    step_weights = get_local_weights(
-                        x[i],
-                        self.model_,
-                        random_state=self.random_state,
-                        pred_label=pred_labels[i],
-                    )
-            else:
-                raise NotImplementedError(
-                    "step_weights not implemented, please choose 'local', 'global' or 'uniform'."
-                )
-
             # print(step_weights.reshape(-1))
-            x_sample, loss = self._transform_sample(
-                x[np.newaxis, i], step_weights, pred_labels[i]
-            )
+            start_time = time.perf_counter()
+            with get_profiler().phase("gradient_search"), self._searching():
+                x_sample, loss, self.n_iter_[i] = self._transform_sample(
+                    x[np.newaxis, i], step_weights, pred_labels[i], tracker
+                )
+            self.search_time_[i] = time.perf_counter() - start_time
 
             result_samples[i] = x_sample
             losses[i] = loss
             weights_all[i] = step_weights
 
         print(f"{i+1} samples been transformed, in total.")
+        get_profiler().observe("gradient_steps", self.n_iter_)
+
+        return result_samples, losses, weights_all
+
+    def _transform_batched(self, x, pred_labels):
+        """Generate counterfactual explanations, `batch_size` samples at a time
+
+        x : array-like of shape [n_samples, n_timestep, n_dims]
+            The samples
+        """
+        result_samples = np.empty(x.shape)
+        losses = np.empty(x.shape[0])
+        self.n_iter_ = np.empty(x.shape[0], dtype=int)
+        self.search_time_ = np.empty(x.shape[0])
+        # `weights_all` needed for debugging
+        weights_all = np.empty((x.shape[0], 1, x.shape[1], x.shape[2]))
+
+        starts = range(0, x.shape[0], self.batch_size)
+        step_weights_iter = self._prefetch(
+            self._get_step_weights_batch(
+                x[start : start + self.batch_size], pred_labels[start : start + self.batch_size]
+            )
+            for start in starts
+        )
+
+        for start, step_weights in zip(starts, step_weights_iter):
+            end = min(start + self.batch_size, x.shape[0])
+            print(f"{start+1} samples been transformed.")
+
+            weights_all[start:end] = step_weights
+
+            with get_profiler().phase("gradient_search"), self._searching():
+                (
+                    result_samples[start:end],
+                    losses[start:end],
+                    self.n_iter_[start:end],
+                    self.search_time_[start:end],
+                ) = self._transform_batch(
+                    x[start:end],
+                    weights_all[start:end, 0],
+                    np.asarray(pred_labels[start:end]),
+                )
+
+        print(f"{x.shape[0]} samples been transformed, in total.")
+        get_profiler().observe("gradient_steps", self.n_iter_)
 
         return result_samples, losses, weights_all
 
-    def _transform_sample(self, x, step_weights, pred_label):
+    def transform_grid(self, x, pred_labels, configs):
+        """Generate counterfactual explanations for several search configurations
+
+        All (sample, configuration) pairs are searched jointly, in blocks of
+        `batch_size` pairs (all at once if `batch_size` is None). The step
+        weights are computed once per sample and shared by all configurations.
+
+        The learning rate of a configuration scales the step of the optimizer,
+        relative to its own learning rate. This is exact for optimizers whose
+        update is linear in the learning rate, e.g., Adam, RMSprop or SGD.
+
+        x : array-like of shape [n_samples, n_timestep, n_dims]
+            The samples
+
+        configs : list of tuple
+            The `(learning_rate, pred_margin_weight, probability)` of each search
+
+        Returns
+        -------
+        result_samples : ndarray of shape [n_configs, n_samples, n_timestep, n_dims]
+        losses : ndarray of shape [n_configs, n_samples]
+            Also sets `n_iter_` and `search_time_`, of the same shape, and `n_iter_saved_`
+        weights_all : ndarray of shape [n_samples, 1, n_timestep, n_dims]
+        """
+        n_samples, n_configs = x.shape[0], len(configs)
+        self.n_iter_saved_ = dict(plateau=0, refine=0, budget=0)
+        base_lr = float(tf.keras.backend.get_value(self.optimizer_.learning_rate))
+        learning_rates, pred_margin_weights, probabilities = (
+            np.repeat(np.asarray(values, dtype=np.float32), n_samples)
+            for values in zip(*configs)
+        )
+
+        # `weights_all` needed for debugging
+        weights_all = self._get_step_weights_batch(x, pred_labels)
+
+        x_rows = np.tile(x, (n_configs, 1, 1))
+        weights_rows = np.tile(weights_all[:, 0], (n_configs, 1, 1))
+        pred_labels_rows = np.tile(np.asarray(pred_labels), n_configs)
+
+        n_rows = x_rows.shape[0]
+        batch_size = self.batch_size if self.batch_size else n_rows
+        result_samples = np.empty(x_rows.shape)
+        losses = np.empty(n_rows)
+        n_iter = np.empty(n_rows, dtype=int)
+        search_time = np.empty(n_rows)
+        for start in range(0, n_rows, batch_size):
+            rows = slice(start, min(start + batch_size, n_rows))
+            print(f"{start+1} (sample, config) pairs been transformed.")
+            with get_profiler().phase("gradient_search"):
+                (
+                    result_samples[rows],
+                    losses[rows],
+                    n_iter[rows],
+                    search_time[rows],
+                ) = self._transform_batch(
+                    x_rows[rows],
+                    weights_rows[rows],
+                    pred_labels_rows[rows],
+                    step_scale=learning_rates[rows] / base_lr,
+                    probability=probabilities[rows],
+                    pred_margin_weight=pred_margin_weights[rows],
+                )
+        print(f"{n_rows} (sample, config) pairs been transformed, in total.")
+        get_profiler().observe("gradient_steps", n_iter)
+
+        self.n_iter_ = n_iter.reshape(n_configs, n_samples)
+        self.search_time_ = search_time.reshape(n_configs, n_samples)
+        return (
+            result_samples.reshape((n_configs,) + x.shape),
+            losses.reshape(n_configs, n_samples),
+            weights_all,
+        )
+
+    def _transform_sample(self, x, step_weights, pred_label, tracker=None):
         """Generate counterfactual explanations
 
         x : array-like of shape [n_samples, n_timestep, n_dims]
             The samples
+
+        tracker : _ConvergenceTracker, optional
+            The convergence policies, shared by the samples of a `transform`
         """
         # TODO: check_is_fitted(self)
-        if self.autoencoder is not None:
-            z = tf.Variable(self.encoder_(x))
-        else:
-            z = tf.Variable(x, dtype=tf.float32)
+        if self.compile_search:
+            return self._transform_sample_compiled(x, step_weights, pred_label)
+
+        z = tf.Variable(self._initial_z(x, [pred_label]))
 
         it = 0
         target_label = 1 - pred_label  # for binary classification
+        if tracker is not None:
+            tracker.reset(1)
+        # the state before the last update, restored by the "refine" policy
+        z_previous, loss_previous = None, None
 
         with tf.GradientTape() as tape:
             loss, pred_margin_loss, weighted_steps_loss = self.compute_loss(
                 x, z, step_weights, target_label
             )
 
-        if self.autoencoder is not None:
-            pred = self.model_(self.decoder_(z))
-        else:
-            pred = self.model_(z)
+        pred = self.predict(z)
 
         # # uncomment for debug
         # print(
@@ -244,6 +734,20 @@ class ModifiedLatentCF:
             pred_margin_loss > self.tolerance_
             or pred[:, target_label] < self.probability_
         ) and (it < self.max_iter if self.max_iter else True):
+            if tracker is not None:
+                stop, restore = tracker.check(
+                    it,
+                    np.array([float(loss)]),
+                    np.array([bool(pred[0, target_label] >= self.probability_[0])]),
+                    np.ones(1, dtype=bool),
+                )
+                if restore[0]:
+                    z.assign(z_previous)
+                    loss = loss_previous
+                if stop[0]:
+                    break
+                z_previous, loss_previous = tf.identity(z), loss
+
             # Get gradients of loss wrt the sample
             grads = tape.gradient(loss, z)
             # Update the weights of the sample
@@ -255,18 +759,358 @@ class ModifiedLatentCF:
                 )
             it += 1
 
-            if self.autoencoder is not None:
-                pred = self.model_(self.decoder_(z))
-            else:
-                pred = self.model_(z)
+            pred = self.predict(z)
 
         # # uncomment for debug
         # print(
         #     f"current loss: {loss}, pred_margin_loss: {pred_margin_loss}, weighted_steps_loss: {weighted_steps_loss}, pred prob:{pred}, iter: {it}. \n"
         # )
 
-        res = z.numpy() if self.autoencoder is None else self.decoder_(z).numpy()
-        return res, float(loss)
+        res = self._decode(z)
+        return res, float(loss), it
+
+    def _transform_sample_compiled(self, x, step_weights, pred_label):
+        """Generate counterfactual explanations with the compiled search kernel
+
+        x : array-like of shape [1, n_timestep, n_dims]
+            The sample
+        """
+        z_init = self._initial_z(x, [pred_label])
+
+        if self.search_kernel_ is None or self.search_kernel_[0] != z_init.shape:
+            self.search_kernel_ = (z_init.shape, self._build_search_kernel(z_init.shape))
+
+        z, loss, it = self.search_kernel_[1](
+            tf.cast(x, tf.float32),
+            z_init,
+            tf.cast(step_weights, tf.float32),
+            tf.constant(1 - pred_label, dtype=tf.int32),  # for binary classification
+        )
+        # one pass per iteration and the final stopping test, then the decoding
+        self._count_forward(int(it) + 1)
+        if self.autoencoder is not None:
+            get_profiler().count("decoder_calls")
+        return z.numpy(), float(loss), int(it)
+
+    def _build_search_kernel(self, shape):
+        """Build the search loop for samples of (latent) `shape` as one `tf.function`
+
+        Each iteration runs a single forward pass, which is used both for the
+        gradient step and for the stopping test of `_transform_sample`.
+        """
+        if not hasattr(self.optimizer_, "get_slot_names"):
+            raise ValueError(
+                "compile_search requires an optimizer from `tf.keras.optimizers.legacy`."
+            )
+
+        # The search variable is shared by all samples of the same shape, create it
+        # and its optimizer slots once, outside of the compiled loop
+        z = tf.Variable(tf.zeros(shape, dtype=tf.float32))
+        self.optimizer_.apply_gradients([(tf.zeros_like(z), z)])
+        self.optimizer_.iterations.assign_sub(1)
+        slots = [
+            self.optimizer_.get_slot(z, slot_name)
+            for slot_name in self.optimizer_.get_slot_names()
+        ]
+        max_iter = self.max_iter if self.max_iter else np.iinfo(np.int32).max
+
+        def search(x, z_init, step_weights, target_label):
+            # restart from a fresh optimizer state, as for a new `tf.Variable`
+            z.assign(z_init)
+            for slot in slots:
+                slot.assign(tf.zeros_like(slot))
+
+            def step(it, loss, searching):
+                with tf.GradientTape() as tape:
+                    loss, pred_margin_loss, _, pred = self.compute_sample_losses(
+                        x, z, step_weights, target_label[tf.newaxis]
+                    )
+                searching = tf.math.logical_and(
+                    tf.math.logical_or(
+                        pred_margin_loss[0] > self.tolerance_,
+                        pred[0] < self.probability_[0],
+                    ),
+                    it < max_iter,
+                )
+
+                def update():
+                    # Get gradients of loss wrt the sample
+                    grads = tape.gradient(loss, z)
+                    # Update the weights of the sample
+                    self.optimizer_.apply_gradients([(grads, z)])
+                    return it + 1
+
+                it = tf.cond(searching, update, lambda: it)
+                return it, loss[0], searching
+
+            it, loss, _ = tf.while_loop(
+                lambda it, loss, searching: searching,
+                step,
+                (tf.constant(0), tf.constant(0.0), tf.constant(True)),
+            )
+            res = z if self.autoencoder is None else self.decoder_(z)
+            return res, loss, it
+
+        return tf.function(search, jit_compile=self.jit_compile)
+
+    def _transform_batch(
+        self,
+        x,
+        step_weights,
+        pred_labels,
+        step_scale=None,
+        probability=None,
+        pred_margin_weight=None,
+    ):
+        """Generate counterfactual explanations for a block of samples at once
+
+        Every sample follows the stopping rule of `_transform_sample`: it keeps
+        being updated while `pred_margin_loss > tolerance_` or its target
+        probability is below `probability_`, for at most `max_iter` iterations,
+        and until a convergence policy stops it. Samples that stop are frozen,
+        i.e. later steps no longer change them.
+
+        x : array-like of shape [n_samples, n_timestep, n_dims]
+            The samples
+
+        step_weights : array-like of shape [n_samples, n_timestep, n_dims]
+            The step weights of each sample
+
+        step_scale : array-like of shape [n_samples], optional
+            Factor applied to the optimizer step of each sample
+
+        probability, pred_margin_weight : array-like of shape [n_samples], optional
+            Per-sample values overriding `probability_` and `pred_margin_weight`
+
+        Returns the samples, their losses, number of iterations and search time,
+        i.e. the seconds from the start of the block until the sample stopped.
+        """
+        z = tf.Variable(self._initial_z(x, pred_labels))
+
+        n_samples = x.shape[0]
+        target_labels = tf.constant(1 - pred_labels, dtype=tf.int32)  # for binary classification
+        # broadcast mask over all but the sample axis of `z`
+        mask_shape = (n_samples,) + (1,) * (len(z.shape) - 1)
+        if probability is None:
+            probability = self.probability_.numpy()
+        else:
+            probability = np.asarray(probability, dtype=np.float32)
+        if pred_margin_weight is not None:
+            pred_margin_weight = np.asarray(pred_margin_weight, dtype=np.float32)
+
+        losses = np.empty(n_samples)
+        n_iter = np.empty(n_samples, dtype=int)
+        search_time = np.empty(n_samples)
+        active = np.ones(n_samples, dtype=bool)
+        it = 0
+        start_time = time.perf_counter()
+        tracker = self._convergence_tracker(n_samples)
+        # the state before the last update, restored by the "refine" policy
+        z_previous, previous_loss_values = None, None
+
+        while True:
+            with tf.GradientTape() as tape:
+                loss, pred_margin_loss, _, pred = self.compute_sample_losses(
+                    x,
+                    z,
+                    step_weights,
+                    target_labels,
+                    probability=probability,
+                    pred_margin_weight=pred_margin_weight,
+                )
+                # frozen samples do not contribute to the gradients
+                total_loss = tf.math.reduce_sum(loss * active.astype(np.float32))
+
+            # freeze the samples that meet the stopping criterion
+            converged = np.logical_not(
+                np.logical_or(
+                    pred_margin_loss.numpy() > self.tolerance_.numpy(),
+                    pred.numpy() < probability,
+                )
+            )
+            if self.max_iter and it >= self.max_iter:
+                converged[:] = True
+            loss_values = loss.numpy()
+            if tracker is not None:
+                policy_stopping, restore = tracker.check(
+                    it,
+                    loss_values,
+                    pred.numpy() >= probability,
+                    np.logical_and(active, np.logical_not(converged)),
+                )
+                if restore.any():
+                    z.assign(tf.where(restore.reshape(mask_shape), z_previous, z))
+                    loss_values[restore] = previous_loss_values[restore]
+                converged = np.logical_or(converged, policy_stopping)
+            stopping = np.logical_and(active, converged)
+            losses[stopping] = loss_values[stopping]
+            n_iter[stopping] = it
+            search_time[stopping] = time.perf_counter() - start_time
+            active = np.logical_and(active, np.logical_not(converged))
+            if not active.any():
+                break
+            previous_loss_values = loss_values
+
+            # Get gradients of loss wrt the samples
+            grads = tape.gradient(total_loss, z)
+            z_previous = tf.identity(z)
+            # Update the weights of the samples, then restore the frozen ones
+            self.optimizer_.apply_gradients([(grads, z)])
+            if step_scale is None:
+                z.assign(tf.where(active.reshape(mask_shape), z, z_previous))
+            else:
+                scale = (step_scale * active).astype(np.float32).reshape(mask_shape)
+                z.assign(z_previous + scale * (z - z_previous))
+            it += 1
+
+        res = self._decode(z)
+        return res, losses, n_iter, search_time
+
+
+class _ConvergenceTracker:
+    """The convergence policies of `ModifiedLatentCF`, for the samples searched together
+
+    `check` is called once per iteration, before the update step, with the
+    state of every sample. It returns the samples that a policy stops, and of
+    these the ones to restore to their state before the last update.
+    """
+
+    def __init__(self, cf_model, n_samples, n_iter_saved):
+        self.cf_model = cf_model
+        self.budget = cf_model.max_total_iter
+        self.n_iter_saved = n_iter_saved
+        self.reset(n_samples)
+
+    def reset(self, n_samples):
+        """Start a new block of samples, the remaining budget is kept"""
+        self.loss_history = []
+        self.first_valid = np.full(n_samples, -1)
+
+    def check(self, it, losses, valid, active):
+        """
+        it : int
+            The number of updates so far
+
+        losses, valid : ndarray of shape [n_samples]
+            The current loss and validity of every sample
+
+        active : ndarray of shape [n_samples]
+            The samples that are still searched after the default criterion
+        """
+        cf_model = self.cf_model
+        stop = np.zeros(active.shape, dtype=bool)
+        restore = np.zeros(active.shape, dtype=bool)
+
+        if cf_model.plateau_tol is not None:
+            self.loss_history.append(np.array(losses, dtype=np.float64))
+            if len(self.loss_history) > cf_model.plateau_patience:
+                previous = self.loss_history.pop(0)
+                improvement = (previous - losses) / np.maximum(np.abs(previous), 1e-12)
+                self._stop(stop, active & (improvement < cf_model.plateau_tol), it, "plateau")
+
+        if cf_model.refine_iter is not None:
+            self.first_valid[active & valid & (self.first_valid < 0)] = it
+            refining = active & ~stop & (self.first_valid >= 0)
+            restore = refining & ~valid
+            self._stop(
+                stop,
+                restore | (refining & (it - self.first_valid >= cf_model.refine_iter)),
+                it,
+                "refine",
+            )
+
+        if self.budget is not None:
+            remaining = active & ~stop
+            # the next update costs one iteration per remaining sample
+            if self.budget < remaining.sum():
+                self._stop(stop, remaining, it, "budget")
+            else:
+                self.budget -= remaining.sum()
+
+        return stop, restore
+
+    def _stop(self, stop, mask, it, policy):
+        mask = mask & ~stop
+        stop |= mask
+        if self.cf_model.max_iter:
+            self.n_iter_saved[policy] += int(mask.sum()) * max(self.cf_model.max_iter - it, 0)
+
+
+class LatentNUNIndex:
+    """Nearest unlike neighbours in the latent space, one nearest-neighbour index per class
+
+    The indexes use `sklearn.neighbors.NearestNeighbors`, i.e. a KD-tree,
+    ball-tree or brute force search, chosen by `algorithm`.
+    """
+
+    def __init__(self, algorithm="auto"):
+        self.algorithm = algorithm
+
+    def fit(self, codes, labels):
+        """
+        codes : array-like of shape [n_samples, ...]
+            The latent codes of the training samples
+
+        labels : array-like of shape [n_samples]
+            The labels of the training samples
+        """
+        self.codes_ = np.asarray(codes, dtype=np.float32)
+        self.labels_ = np.asarray(labels)
+        self.classes_ = np.unique(self.labels_)
+        flat_codes = self.codes_.reshape(self.codes_.shape[0], -1)
+        self.neighbors_ = {}
+        for label in self.classes_:
+            members = np.flatnonzero(self.labels_ == label)
+            self.neighbors_[label] = (
+                members,
+                NearestNeighbors(n_neighbors=1, algorithm=self.algorithm).fit(
+                    flat_codes[members]
+                ),
+            )
+        return self
+
+    def query(self, codes, target_labels):
+        """The code of the nearest training sample of `target_labels`, for every code"""
+        codes = np.asarray(codes, dtype=np.float32)
+        target_labels = np.broadcast_to(target_labels, codes.shape[:1])
+        flat_codes = codes.reshape(codes.shape[0], -1)
+        nun_idx = np.empty(codes.shape[0], dtype=int)
+        for label in np.unique(target_labels):
+            if label not in self.neighbors_:
+                raise ValueError(f"No training sample of label {label} in the index.")
+            members, neighbors = self.neighbors_[label]
+            queries = target_labels == label
+            nun_idx[queries] = members[
+                neighbors.kneighbors(flat_codes[queries], return_distance=False)[:, 0]
+            ]
+        return self.codes_[nun_idx]
+
+    def save(self, path):
+        """Save the codes and labels to a `.npz` file, the indexes are rebuilt by `load`"""
+        # write to a temporary file first, so that concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, codes=self.codes_, labels=self.labels_)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, algorithm="auto"):
+        with np.load(path) as data:
+            return cls(algorithm=algorithm).fit(data["codes"], data["labels"])
+
+
+def fit_nun_index(autoencoder, X, y, algorithm="auto"):
+    """Index the latent codes of the training samples `X` for the `warm_start` of `ModifiedLatentCF`
+
+    autoencoder : keras.Model
+        The autoencoder of the CF search, if None the samples themselves are indexed
+    """
+    if autoencoder is None:
+        codes = X
+    else:
+        encode_input, encode_output, _, _ = extract_encoder_decoder(autoencoder)
+        codes = keras.Model(inputs=encode_input, outputs=encode_output).predict(X)
+    return LatentNUNIndex(algorithm=algorithm).fit(codes, y)
 
 
 def extract_encoder_decoder(autoencoder):
@@ -288,21 +1132,154 @@ def extract_encoder_decoder(autoencoder):
     return autoencoder.input, encoder, encode_input, decoder
 
 
+class _LockedModel:
+    """The prediction methods of `model`, each called while holding `lock`"""
+
+    def __init__(self, model, lock):
+        self.model = model
+        self.lock = lock
+
+    def predict(self, *args, **kwargs):
+        with self.lock:
+            return self.model.predict(*args, **kwargs)
+
+    def predict_on_batch(self, *args, **kwargs):
+        with self.lock:
+            return self.model.predict_on_batch(*args, **kwargs)
+
+
+# set in the producer thread of `_prefetch`
+_producer = threading.local()
+
+
+@contextmanager
+def _ignore_lime_warnings():
+    """Ignore the RuntimeWarning and UserWarning of LIMESegment
+
+    In the producer thread of `_prefetch` the filters are left unchanged, as
+    `warnings.catch_warnings` is not thread-safe; the consumer sets them.
+    """
+    if getattr(_producer, "active", False):
+        yield
+        return
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        warnings.simplefilter("ignore", category=UserWarning)
+        yield
+
+
+def _prefetch(iterable, depth):
+    """Iterate over `iterable` in a background thread, at most `depth` items ahead
+
+    Items are yielded in order; an exception of the producer is raised in the consumer.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # give up if the consumer stopped iterating, instead of blocking forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        _producer.active = True
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 def get_local_weights(
-    input_sample, classifier_model, random_state=None, pred_label=None
+    input_sample,
+    classifier_model,
+    random_state=None,
+    pred_label=None,
+    cp=10,
+    window_size=10,
+    dtw_backend="numba",
+    mp_percentage=None,
 ):
-    n_timesteps, n_dims = input_sample.shape  # n_dims=1
     # for binary classification, default to 1
     desired_label = int(1 - pred_label) if pred_label is not None else 1
-    seg_imp, seg_idx = LIMESegment(
-        input_sample,
-        classifier_model,
-        model_type=desired_label,
-        cp=10,
-        window_size=10,
-        random_state=random_state,
+    get_profiler().count("local_weights_samples")
+    with get_profiler().phase("local_weights"):
+        seg_imp, seg_idx = LIMESegment(
+            input_sample,
+            classifier_model,
+            model_type=desired_label,
+            cp=cp,
+            window_size=window_size,
+            random_state=random_state,
+            dtw_backend=dtw_backend,
+            mp_percentage=mp_percentage,
+        )
+    return _mask_segments(seg_imp, seg_idx, desired_label, *input_sample.shape)
+
+
+def get_local_weights_batch(
+    input_samples,
+    classifier_model,
+    random_state=None,
+    pred_labels=None,
+    cp=10,
+    window_size=10,
+    dtw_backend="numba",
+    mp_percentage=None,
+):
+    """Local weights of several samples, with one classifier pass for all of them
+
+    Returns an array of shape [n_samples, 1, n_timesteps, n_dims], equal to
+    calling `get_local_weights` for each sample.
+    """
+    n_samples, n_timesteps, n_dims = input_samples.shape
+    # for binary classification, default to 1
+    if pred_labels is None:
+        desired_labels = [1] * n_samples
+    else:
+        desired_labels = [int(1 - pred_label) for pred_label in pred_labels]
+    get_profiler().count("local_weights_samples", n_samples)
+    with get_profiler().phase("local_weights"):
+        explanations = LIMESegment_batch(
+            input_samples,
+            classifier_model,
+            model_type=desired_labels,
+            cp=cp,
+            window_size=window_size,
+            random_state=random_state,
+            dtw_backend=dtw_backend,
+            mp_percentage=mp_percentage,
+        )
+    return np.stack(
+        [
+            _mask_segments(seg_imp, seg_idx, desired_label, n_timesteps, n_dims)
+            for (seg_imp, seg_idx), desired_label in zip(explanations, desired_labels)
+        ]
     )
 
+
+def _mask_segments(seg_imp, seg_idx, desired_label, n_timesteps, n_dims):
     if desired_label == 1:
         # calculate the threshold of masking, lower 25 percentile (neg contribution for pos class)
         masking_threshold = np.percentile(seg_imp, 25)
@@ -311,7 +1288,7 @@ def get_local_weights(
         # calculate the threshold of masking, upper 25 percentile (pos contribution for neg class)
         masking_threshold = np.percentile(seg_imp, 75)
         masking_idx = np.where(seg_imp >= masking_threshold)
-    weighted_steps = np.ones((n_timesteps, n_features))
+    weighted_steps = np.ones((n_timesteps, n_dims))
     for start_idx in masking_idx[0]:
         weighted_steps[seg_idx[start_idx] : seg_idx[start_idx + 1]] = 0
 
@@ -320,41 +1297,120 @@ def get_local_weights(
     return weighted_steps
 
 
-def get_global_weights(
-    input_samples, input_labels, classifier_model, n_timesteps, n_features, random_state=None,
+def _intervals(n_timesteps, n_intervals):
+    # the intervals of `wildboar.explain.IntervalImportance`, the first `n % n_intervals` one step longer
+    length, n_longer = divmod(n_timesteps, n_intervals)
+    for i in range(n_intervals):
+        start = i * length + min(i, n_longer)
+        yield start, start + length + (1 if i < n_longer else 0)
+
+
+def interval_importance(
+    input_samples,
+    input_labels,
+    classifier_model,
+    n_intervals=None,
+    n_repeat=5,
+    random_state=None,
+    max_batch_samples=2**16,
+    batch_size=1024,
 ):
-    n_samples, _, _ = input_samples.shape
+    """Permutation importance of time intervals, as `wildboar.explain.IntervalImportance`
 
-    class ModelWrapper:
-        def __init__(self, model, n_timesteps, n_features):
-            self.model = model
-            self.fitted_ = False
-            self.n_timesteps_in_ = n_timesteps
-            self.n_features_in_ = n_features
+    Every interval is permuted across the samples `n_repeat` times, for all
+    features at once, and scored by the drop of the accuracy. The permuted
+    copies are built in chunks of up to `max_batch_samples` samples and each
+    chunk is scored with one classifier call. The permutations are drawn in the
+    order of `IntervalImportance`, which gives the same importances.
 
-        def predict(self, X):
-            p = self.model.predict(X.reshape(n_samples, n_timesteps, n_features))
-            return np.argmax(p, axis=1)
+    Parameters
+    ----------
+    input_samples : array-like of shape [n_samples, n_timesteps, n_features]
 
-        def fit(self, X, y):
-            self.fitted_ = True
-            return self.model.fit(X, y)
+    n_intervals : int, optional
+        The number of intervals, if None one per timestep
 
-    clf = ModelWrapper(classifier_model, n_timesteps, n_features)
+    Returns
+    -------
+    importances : ndarray of shape [n_intervals]
+        The mean decrease of the accuracy
 
-    # Flattening the multivariate series
-    i = IntervalImportance(scoring="accuracy", n_intervals=n_timesteps, random_state=random_state)
-    i.fit(clf, input_samples.reshape(n_samples, n_timesteps * n_features), input_labels)
+    components : ndarray of shape [n_intervals, 2]
+        The start and end timestep of the intervals
+    """
+    input_samples = np.asarray(input_samples, dtype=np.float32)
+    n_samples, n_timesteps, _ = input_samples.shape
+    components = np.array(list(_intervals(n_timesteps, n_intervals or n_timesteps)))
+    random_state = check_random_state(random_state)
+
+    def accuracy(samples):
+        pred = classifier_model.predict(samples, batch_size=batch_size, verbose=0)
+        return np.mean(
+            np.argmax(pred, axis=1).reshape(-1, n_samples) == input_labels, axis=1
+        )
+
+    # one job per (interval, repeat), with the permutation of the samples
+    jobs = [
+        (start, end, random_state.permutation(n_samples))
+        for start, end in components
+        for _ in range(n_repeat)
+    ]
+    scores = np.empty(len(jobs))
+    jobs_per_chunk = max(1, max_batch_samples // n_samples)
+    for chunk_start in range(0, len(jobs), jobs_per_chunk):
+        chunk = jobs[chunk_start : chunk_start + jobs_per_chunk]
+        permuted = np.repeat(input_samples[np.newaxis], len(chunk), axis=0)
+        for j, (start, end, permutation) in enumerate(chunk):
+            permuted[j, :, start:end] = input_samples[permutation, start:end]
+        scores[chunk_start : chunk_start + len(chunk)] = accuracy(
+            permuted.reshape((-1,) + input_samples.shape[1:])
+        )
+
+    baseline_score = accuracy(input_samples)[0]
+    importances = baseline_score - scores.reshape(len(components), n_repeat)
+    return importances.mean(axis=1), components
+
+
+def get_global_weights(
+    input_samples,
+    input_labels,
+    classifier_model,
+    n_timesteps=None,
+    n_features=None,
+    random_state=None,
+    n_intervals=None,
+):
+    """Global step weights, masking the 25% most important intervals of the classifier
+
+    input_samples : array-like of shape [n_samples, n_timesteps, n_features]
+
+    n_timesteps, n_features : int, optional
+        Inferred from `input_samples` if None
+
+    n_intervals : int, optional
+        The number of intervals, if None one per timestep; fewer intervals
+        need proportionally fewer classifier passes
+    """
+    _, inferred_timesteps, inferred_features = input_samples.shape
+    n_timesteps = n_timesteps or inferred_timesteps
+    n_features = n_features or inferred_features
+
+    importances, seg_idx = interval_importance(
+        input_samples,
+        input_labels,
+        classifier_model,
+        n_intervals=n_intervals,
+        random_state=random_state,
+    )
 
     # Calculate the threshold of masking, 75 percentile
-    masking_threshold = np.percentile(i.importances_.mean, 75)
-    masking_idx = np.where(i.importances_.mean >= masking_threshold)
+    masking_threshold = np.percentile(importances, 75)
+    masking_idx = np.where(importances >= masking_threshold)
 
     # Initialize the weights to ones for all timesteps and features
     weighted_steps = np.ones((n_timesteps, n_features))
 
     # Mask across all features for identified timesteps
-    seg_idx = i.components_
     for start_idx in masking_idx[0]:
         weighted_steps[seg_idx[start_idx][0]:seg_idx[start_idx][1], :] = 0
 
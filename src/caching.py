@@ -0,0 +1,461 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+from profiling import get_profiler
+
+
+def array_fingerprint(a):
+    """Content hash of an array, including its shape and dtype"""
+    a = np.ascontiguousarray(a)
+    h = hashlib.sha1(f"{a.dtype.str}{a.shape}".encode())
+    h.update(a.tobytes())
+    return h.hexdigest()
+
+
+def model_fingerprint(model):
+    """Content hash of the weights of a keras model"""
+    h = hashlib.sha1()
+    for w in model.get_weights():
+        h.update(array_fingerprint(w).encode())
+    return h.hexdigest()
+
+
+def _atomic_save(path, arr):
+    # write to a temporary file first, so that concurrent readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npy")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class StepWeightCache:
+    """Cache of the local step weights, shared by all CF searches of a classifier
+
+    The weights are keyed by the content of the sample, the weights of the
+    classifier and the LIMESegment parameters. Entries are kept in an
+    in-memory LRU and, if `cache_dir` is given, as `.npy` files that are
+    memory-mapped when read back, so they survive across invocations. Weights
+    read back from disk are read-only `np.memmap` arrays.
+
+    The fingerprint of a classifier is computed once per cache, i.e. the
+    classifier is expected not to be retrained while the cache is in use.
+    """
+
+    def __init__(self, cache_dir=None, maxsize=4096):
+        """
+        Parameters
+        ----------
+        cache_dir : str, optional
+            Directory of the on-disk layer, if None only the in-memory LRU is used
+
+        maxsize : int, optional
+            The maximum number of entries of the in-memory LRU
+        """
+        self.cache_dir = cache_dir
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._model_fingerprints = weakref.WeakKeyDictionary()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, sample, model, **params):
+        if model not in self._model_fingerprints:
+            self._model_fingerprints[model] = model_fingerprint(model)
+        h = hashlib.sha1(array_fingerprint(sample).encode())
+        h.update(self._model_fingerprints[model].encode())
+        h.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """Return the cached weights of `key`, or None on a miss"""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            get_profiler().count("cache.step_weights.hits")
+            return self._memory[key]
+
+        path = self._path(key)
+        if path is not None and os.path.isfile(path):
+            self.hits += 1
+            get_profiler().count("cache.step_weights.hits")
+            weights = np.load(path, mmap_mode="r")
+            self._remember(key, weights)
+            return weights
+
+        self.misses += 1
+        get_profiler().count("cache.step_weights.misses")
+        return None
+
+    def put(self, key, weights):
+        path = self._path(key)
+        if path is not None:
+            _atomic_save(path, weights)
+        self._remember(key, weights)
+
+    def get_or_compute(self, sample, model, compute, **params):
+        """Return the cached weights of `sample`, or compute and store them
+
+        compute : callable
+            Called without arguments to compute the weights on a cache miss
+
+        **params
+            The parameters that the weights depend on, part of the key
+        """
+        key = self.key(sample, model, **params)
+        weights = self.get(key)
+        if weights is None:
+            weights = compute()
+            self.put(key, weights)
+        return weights
+
+    def _path(self, key):
+        return None if self.cache_dir is None else os.path.join(self.cache_dir, f"{key}.npy")
+
+    def _remember(self, key, weights):
+        self._memory[key] = weights
+        if len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class ModelCache:
+    """Trained keras models on disk, keyed by everything their training depends on
+
+    The key is a hash of a JSON spec, e.g. the dataset, fold, seed, the
+    arguments of the architecture and the training config. The weights are
+    stored next to a JSON file with the spec and the metadata returned by the
+    training function (e.g. the validation loss), so that a reloaded model
+    reports the same numbers as a freshly trained one.
+    """
+
+    def __init__(self, cache_dir=None, rebuild=False):
+        """
+        Parameters
+        ----------
+        cache_dir : str, optional
+            Directory of the cached models, if None models are always trained
+
+        rebuild : bool, optional
+            Retrain and overwrite cached models
+        """
+        self.cache_dir = cache_dir
+        self.rebuild = rebuild
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(spec):
+        return hashlib.sha1(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+    def fit_or_load(self, model, spec, fit):
+        """Load the weights of `model` from the cache, or train it and store them
+
+        model : keras.Model
+            The built (untrained) model, with the architecture of `spec`
+
+        spec : dict
+            JSON-serializable description of the model and its training
+
+        fit : callable
+            Called without arguments to train `model` on a cache miss, returns a
+            dict of JSON-serializable metadata
+
+        Returns the metadata of the trained model
+        """
+        if self.cache_dir is None:
+            return fit()
+
+        weights_path, meta_path = self._paths(self.key(spec))
+        if not self.rebuild and os.path.isfile(weights_path) and os.path.isfile(meta_path):
+            get_profiler().count("cache.models.hits")
+            model.load_weights(weights_path)
+            with open(meta_path) as f:
+                return json.load(f)["metadata"]
+
+        get_profiler().count("cache.models.misses")
+        metadata = fit()
+        # write to temporary files first, so that concurrent runs never load a partial model
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".h5")
+        os.close(fd)
+        model.save_weights(tmp_path)
+        os.replace(tmp_path, weights_path)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(dict(spec=spec, metadata=metadata), f, indent=2, default=str)
+        os.replace(tmp_path, meta_path)
+        return metadata
+
+    def artifact_path(self, spec, suffix):
+        """Path of a file stored next to the model of `spec`, e.g. an index built
+        from it, or None without a cache dir"""
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f"{self.key(spec)}.{suffix}")
+
+    def _paths(self, key):
+        return (
+            os.path.join(self.cache_dir, f"{key}.h5"),
+            os.path.join(self.cache_dir, f"{key}.json"),
+        )
+
+
+class DatasetStore:
+    """Raw datasets and preprocessed fold arrays on disk, memory-mapped when read
+
+    The arrays are `.npy` files opened with `mmap_mode="r"`, so repeated runs
+    start without downloading or preprocessing and concurrent workers share the
+    same pages. A fold is stored as one directory per key, with a `meta.json`,
+    written to a temporary directory that replaces it once all arrays are complete.
+    """
+
+    def __init__(self, cache_dir=None):
+        """
+        Parameters
+        ----------
+        cache_dir : str, optional
+            Directory of the stored arrays, if None nothing is stored
+        """
+        self.cache_dir = cache_dir
+
+    def load_dataset(self, name, repository="wildboar/ucr"):
+        """Load a dataset of `wildboar.datasets`, from the store if available"""
+        if self.cache_dir is None:
+            from wildboar.datasets import load_dataset
+
+            return load_dataset(name, repository=repository)
+
+        def download():
+            from wildboar.datasets import load_dataset
+
+            X, y = load_dataset(name, repository=repository)
+            return dict(X=X, y=y)
+
+        arrays = self._load_or_compute(
+            os.path.join("raw", repository.replace("/", "_"), name),
+            dict(name=name, repository=repository),
+            download,
+        )
+        return arrays["X"], arrays["y"]
+
+    def fold_arrays(self, spec, compute):
+        """Return the arrays of a fold from the store, or compute and store them
+
+        spec : dict
+            JSON-serializable description of everything the arrays depend on,
+            e.g. the dataset, labels, seed, fold and preprocessing rules
+
+        compute : callable
+            Called without arguments on a miss, returns a dict of arrays
+        """
+        if self.cache_dir is None:
+            return compute()
+        key = hashlib.sha1(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+        return self._load_or_compute(os.path.join("folds", key), spec, compute)
+
+    def _load_or_compute(self, name, spec, compute):
+        path = os.path.join(self.cache_dir, name)
+        if os.path.isfile(os.path.join(path, "meta.json")):
+            get_profiler().count("cache.datasets.hits")
+            return _load_arrays(path)[0]
+
+        get_profiler().count("cache.datasets.misses")
+        arrays = compute()
+        _save_arrays(path, arrays, dict(spec=spec))
+        return _load_arrays(path)[0]
+
+
+def _save_arrays(path, arrays, meta):
+    # the arrays are written to a temporary directory, which then replaces `path`
+    # as a whole, i.e. a reader never mixes the arrays and `meta.json` of two writes
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        for k, arr in arrays.items():
+            np.save(os.path.join(tmp_path, f"{k}.npy"), np.asarray(arr))
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(dict(meta, arrays=sorted(arrays)), f, indent=2, default=str)
+
+        old_path = None
+        if os.path.isdir(path):
+            # a directory is only replaced by a rename if it is empty, move the old one away first
+            old_path = tempfile.mkdtemp(dir=parent, prefix=".old-")
+            try:
+                os.replace(path, old_path)
+            except FileNotFoundError:
+                pass
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # a concurrent writer replaced it first, keep theirs
+            if not os.path.isfile(os.path.join(path, "meta.json")):
+                raise
+        if old_path is not None:
+            shutil.rmtree(old_path, ignore_errors=True)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _load_arrays(path):
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    arrays = {
+        k: np.load(os.path.join(path, f"{k}.npy"), mmap_mode="r") for k in meta["arrays"]
+    }
+    return arrays, meta
+
+
+class CFArtifactStore:
+    """The counterfactuals of the CF searches on disk, memory-mapped when read
+
+    Every run (e.g. a dataset, fold, method and search config) is a directory
+    with the indices of the original samples, the losses, iteration counts and
+    step weights of the search and the counterfactuals. Since masked timesteps
+    barely change, only the values of the timesteps a counterfactual changed
+    are stored, in CSR format over the flattened timesteps, unless they are so
+    many that storing the counterfactuals as is takes less space. Binary step
+    weights are stored as packed bitmasks.
+    """
+
+    def __init__(self, root_dir, atol=0.0):
+        """
+        Parameters
+        ----------
+        root_dir : str
+            Directory of the runs
+
+        atol : float, optional
+            Timesteps that changed by at most `atol` are restored as the original
+            sample, i.e. the counterfactuals are restored up to `atol`; with 0 the
+            restored counterfactuals equal the saved ones, in their dtype
+        """
+        self.root_dir = root_dir
+        self.atol = atol
+
+    def save(
+        self,
+        name,
+        X,
+        cf_samples,
+        sample_idx,
+        step_weights=None,
+        losses=None,
+        n_iter=None,
+        metadata=None,
+    ):
+        """Save the artifacts of a run, replacing an earlier run of the same name
+
+        X, cf_samples : array-like of shape [n_samples, n_timesteps, n_dims]
+            The original samples and their counterfactuals
+
+        sample_idx : array-like of shape [n_samples]
+            The indices of the original samples, e.g. in the test set of the fold
+
+        step_weights : array-like of shape [n_samples, ...], optional
+        losses, n_iter : array-like of shape [n_samples], optional
+
+        metadata : dict, optional
+            JSON-serializable description of the run
+
+        Returns the directory of the run
+        """
+        X, cf_samples = np.asarray(X), np.asarray(cf_samples)
+        cf_flat = cf_samples.reshape(X.shape[0], -1)
+        # the values of the changed timesteps are stored, not their difference to
+        # `X`, as `X + (cf - X)` is not exactly `cf` in floating point
+        changed = np.abs(cf_flat - X.reshape(X.shape[0], -1)) > self.atol
+
+        arrays = dict(sample_idx=np.asarray(sample_idx))
+        # CSR takes the values plus one int32 index per value, dense takes the values
+        if changed.sum() * (cf_flat.itemsize + 4) < cf_flat.size * cf_flat.itemsize:
+            arrays.update(
+                cf_indptr=np.concatenate([[0], np.cumsum(changed.sum(axis=1))]),
+                cf_indices=np.nonzero(changed)[1].astype(np.int32),
+                cf_data=cf_flat[changed],
+            )
+        else:
+            arrays.update(cf_samples=cf_samples)
+
+        if step_weights is not None:
+            step_weights = np.asarray(step_weights)
+            if np.isin(step_weights, (0, 1)).all():
+                arrays["step_weights_bits"] = np.packbits(
+                    step_weights.reshape(step_weights.shape[0], -1).astype(bool), axis=1
+                )
+            else:
+                arrays["step_weights"] = step_weights
+        if losses is not None:
+            arrays["losses"] = np.asarray(losses)
+        if n_iter is not None:
+            arrays["n_iter"] = np.asarray(n_iter)
+
+        path = os.path.join(self.root_dir, name)
+        _save_arrays(
+            path,
+            arrays,
+            dict(
+                metadata=metadata or {},
+                shape=X.shape,
+                step_weights_shape=None if step_weights is None else step_weights.shape,
+                atol=self.atol,
+            ),
+        )
+        return path
+
+    def load(self, name, X=None):
+        """Load the artifacts of a run, returns a dict of (memory-mapped) arrays
+
+        X : array-like of shape [n_samples, n_timesteps, n_dims], optional
+            The original samples; the counterfactuals are returned as
+            `cf_samples` if they were stored as is, or if `X` is given, in the
+            dtype they were saved in. If stored as CSR, the timesteps they
+            changed are returned as the boolean `changed`
+        """
+        arrays, meta = _load_arrays(os.path.join(self.root_dir, name))
+        shape = tuple(meta["shape"])
+
+        if "cf_indptr" in arrays:
+            indptr = arrays.pop("cf_indptr")
+            indices, data = arrays.pop("cf_indices"), arrays.pop("cf_data")
+            rows = np.repeat(np.arange(shape[0]), np.diff(indptr))
+            changed = np.zeros((shape[0], int(np.prod(shape[1:]))), dtype=bool)
+            changed[rows, indices] = True
+            arrays["changed"] = changed.reshape(shape)
+            if X is not None:
+                cf_samples = np.array(X, dtype=data.dtype).reshape(shape[0], -1)
+                cf_samples[rows, indices] = data
+                arrays["cf_samples"] = cf_samples.reshape(shape)
+        if "step_weights_bits" in arrays:
+            weights_shape = tuple(meta["step_weights_shape"])
+            bits = np.unpackbits(
+                arrays.pop("step_weights_bits"), axis=1, count=int(np.prod(weights_shape[1:]))
+            )
+            arrays["step_weights"] = bits.reshape(weights_shape).astype(np.float64)
+        arrays["metadata"] = meta["metadata"]
+        return arrays
+
+    def runs(self):
+        """The names of the complete runs"""
+        return sorted(
+            os.path.relpath(dirpath, self.root_dir)
+            for dirpath, _, filenames in os.walk(self.root_dir)
+            if "meta.json" in filenames
+            # the directories being written or replaced
+            and not os.path.basename(dirpath).startswith((".tmp-", ".old-"))
+        )
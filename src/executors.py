@@ -0,0 +1,205 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.utils import check_random_state
+
+# The classifier of a worker process, loaded once by `_init_local_weights_worker`
+_worker_model = None
+
+
+def _limit_tf_threads(n_threads):
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(n_threads)
+
+
+def _init_local_weights_worker(model_path, n_threads):
+    global _worker_model
+    from tensorflow import keras
+
+    _limit_tf_threads(n_threads)
+    _worker_model = keras.models.load_model(model_path, compile=False)
+
+
+def _local_weights_job(sample, pred_label, random_state, params):
+    from _guided import get_local_weights
+
+    # see `ModifiedLatentCF._get_step_weights` for the ignored warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        warnings.simplefilter("ignore", category=UserWarning)
+        return get_local_weights(
+            sample,
+            _worker_model,
+            random_state=random_state,
+            pred_label=pred_label,
+            **params,
+        )
+
+
+class LocalWeightsExecutor:
+    """Compute local step weights (LIMESegment) in a pool of worker processes
+
+    The classifier is saved once and loaded by every worker when it starts, so
+    jobs only carry the sample. Jobs are submitted without blocking, which lets
+    the caller run the gradient search while the workers compute the weights.
+    """
+
+    def __init__(self, classifier_model, n_workers=None, n_threads=1):
+        """
+        Parameters
+        ----------
+        classifier_model : keras.Model
+            The classifier explained by LIMESegment
+
+        n_workers : int, optional
+            The number of worker processes, if None `os.cpu_count()`
+
+        n_threads : int, optional
+            The number of TensorFlow threads of each worker
+        """
+        self.model_dir_ = tempfile.mkdtemp(prefix="local-weights-")
+        model_path = os.path.join(self.model_dir_, "classifier.h5")
+        classifier_model.save(model_path)
+
+        # "spawn" as TensorFlow does not survive a fork of an initialized runtime
+        self.executor_ = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_local_weights_worker,
+            initargs=(model_path, n_threads),
+        )
+
+    def submit(self, samples, pred_labels, random_state=None, **params):
+        """Submit one job per sample, returns the futures in sample order
+
+        random_state : int, RandomState instance or None
+            An int is passed unchanged to every job, as for sequential calls of
+            `get_local_weights`; a RandomState instance draws one seed per job.
+
+        **params
+            Keyword arguments of `get_local_weights`
+        """
+        if isinstance(random_state, np.random.RandomState):
+            random_states = check_random_state(random_state).randint(
+                np.iinfo(np.int32).max, size=len(samples)
+            )
+        else:
+            random_states = [random_state] * len(samples)
+
+        return [
+            self.executor_.submit(
+                _local_weights_job, sample, pred_label, seed, params
+            )
+            for sample, pred_label, seed in zip(samples, pred_labels, random_states)
+        ]
+
+    def map(self, samples, pred_labels, random_state=None, **params):
+        """Compute the weights of all samples, returns an array of shape [n_samples, 1, n_timesteps, n_dims]"""
+        futures = self.submit(samples, pred_labels, random_state=random_state, **params)
+        return np.stack([future.result() for future in futures])
+
+    def shutdown(self):
+        self.executor_.shutdown(wait=True)
+        shutil.rmtree(self.model_dir_, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+class ResultCollector:
+    """Stand-in for `ResultWriter` in a fold worker, records the rows to write
+
+    The rows are written by the main process with `replay`, in fold order.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def write_result(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+
+    def replay(self, result_writer):
+        for args, kwargs in self.calls:
+            result_writer.write_result(*args, **kwargs)
+
+
+def _init_worker(n_threads, log_format, log_level):
+    # the logging config of the script is not inherited by spawned processes
+    logging.basicConfig(format=log_format, level=log_level)
+    if n_threads:
+        _limit_tf_threads(n_threads)
+
+
+def make_worker_pool(max_workers, n_threads=None, max_tasks_per_child=None):
+    """A pool of worker processes with the logging config of the script
+
+    max_workers : int
+        The number of worker processes
+
+    n_threads : int, optional
+        The number of TensorFlow threads of each worker, if None not limited
+
+    max_tasks_per_child : int, optional
+        The number of tasks after which a worker is replaced by a new process,
+        if None workers live as long as the pool
+    """
+    root_logger = logging.getLogger()
+    log_format = (
+        root_logger.handlers[0].formatter._fmt
+        if root_logger.handlers and root_logger.handlers[0].formatter
+        else None
+    )
+    # "spawn" as TensorFlow does not survive a fork of an initialized runtime
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(n_threads, log_format, root_logger.level),
+        max_tasks_per_child=max_tasks_per_child,
+    )
+
+
+def run_folds(run_fold, fold_args, n_jobs=1, n_threads=None):
+    """Run the cross-validation folds, in worker processes if `n_jobs > 1`
+
+    run_fold : callable
+        Module-level function running one fold, called as `run_fold(*args)`
+
+    fold_args : list of tuple
+        The arguments of every fold
+
+    n_jobs : int, optional
+        The number of worker processes, -1 for one per CPU
+
+    n_threads : int, optional
+        The number of TensorFlow threads of each worker, if None the CPUs are
+        divided among the workers
+
+    Yields the results of `run_fold` in fold order, each as soon as it and all
+    earlier folds are done.
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    n_jobs = min(n_jobs, len(fold_args))
+    if n_jobs <= 1:
+        for args in fold_args:
+            yield run_fold(*args)
+        return
+
+    if n_threads is None:
+        n_threads = max(1, os.cpu_count() // n_jobs)
+    with make_worker_pool(n_jobs, n_threads) as executor:
+        futures = [executor.submit(run_fold, *args) for args in fold_args]
+        for future in futures:
+            yield future.result()
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 # coding: utf-8
+import itertools
 import logging
 import os
 from argparse import ArgumentParser
+from contextlib import nullcontext
+from types import SimpleNamespace
 
 import numpy as np
 import pandas as pd
@@ -11,29 +14,46 @@ from sklearn.metrics import balanced_accuracy_score, confusion_matrix
 from sklearn.model_selection import train_test_split, StratifiedKFold
 from tensorflow import keras
 from tensorflow.keras.utils import to_categorical
-from wildboar.datasets import load_dataset
 
 from help_functions import (
     ResultWriter,
     conditional_pad,
     remove_paddings,
     evaluate,
+    evaluate_samples,
     find_best_lr,
+    find_best_lr_batched,
     reset_seeds,
     time_series_normalize,
     upsample_minority,
     fit_evaluation_models,
 )
 from keras_models import *
-from _guided import get_global_weights
+from _guided import LatentNUNIndex, fit_nun_index, get_global_weights
+from caching import (
+    CFArtifactStore,
+    DatasetStore,
+    ModelCache,
+    StepWeightCache,
+    array_fingerprint,
+)
+from executors import LocalWeightsExecutor, ResultCollector, run_folds
+from profiling import Profiler, get_profiler, set_profiler
 
 os.environ["TF_DETERMINISTIC_OPS"] = "1"
 config = tf.compat.v1.ConfigProto()
 config.gpu_options.allow_growth = True
 session = tf.compat.v1.Session(config=config)
 
+logger = logging.getLogger(__name__)
+
+RANDOM_STATE = 39
+# prediction margin weights of the ablation study, with `--ablation`
+PRED_MARGIN_W_LIST = [1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1, 0.0]
+W_TYPES = ["local", "global", "uniform", "unconstrained"]
 
-def main():
+
+def parse_args(args=None):
     parser = ArgumentParser(description="Run this script to evaluate LatentCF method.")
     parser.add_argument(
         "--dataset", type=str, help="Dataset that the experiment is running on."
@@ -50,7 +70,17 @@ def main():
         default=0,
         help="The negative label of the dataset, e.g. 0 or -1",
     )
-    parser.add_argument("--output", type=str, help="Output file name.")
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Output file name, in Parquet (.parquet), Arrow IPC (.arrow) or CSV format; CSV rows are appended in place, not atomically.",
+    )
+    parser.add_argument(
+        "--samples-output",
+        type=str,
+        default=None,
+        help="Output file name of the per-sample results, in the same formats as `--output`, default to None (not written).",
+    )
     parser.add_argument(
         "--n-lstmcells",
         type=int,
@@ -67,45 +97,161 @@ def main():
     )
     parser.add_argument(
         "--w-type",
+        nargs="+",
         type=str,
-        default="local",
-        help="Local, global, uniform, or unconstrained.",
+        default=["local"],
+        help="Local, global, uniform, or unconstrained; several values are run one after another on the same models.",
     )
     parser.add_argument(
         "--w-value",
+        nargs="+",
         type=float,
-        default=0.5,
-        help="The weight value for prediction margin loss, ranging between [0, 1]. Equals to 1 refer to unconstrained version.",
+        default=[0.5],
+        help="The weight value for prediction margin loss, ranging between [0, 1]. Equals to 1 refer to unconstrained version. Several values are searched jointly.",
+    )
+    parser.add_argument(
+        "--ablation",
+        action="store_true",
+        help=f"Run the ablation study of the prediction margin weight, i.e. `--w-value {' '.join(map(str, PRED_MARGIN_W_LIST))}`.",
     )
     parser.add_argument(
         "--tau-value",
+        nargs="+",
         type=float,
-        default=0.5,
-        help="The threshold of decision boundary during CF search, ranging between [0.5, 1], default to 0.5.",
+        default=[0.5],
+        help="The threshold of decision boundary during CF search, ranging between [0.5, 1], default to 0.5. Several values are searched jointly.",
     )
-    A = parser.parse_args()
-
-    logger = logging.getLogger(__name__)
-    logger.info(f"Num GPUs Available: {len(tf.config.list_physical_devices('GPU'))}.")
-    numba_logger = logging.getLogger("numba")
-    numba_logger.setLevel(logging.WARNING)
-    logger.info(f"LR list: {A.lr_list}.")  # for debugging
-    logger.info(f"W type: {A.w_type}.")  # for debugging
-
-    RANDOM_STATE = 39
-    # PRED_MARGIN_W_LIST = [1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1, 0.0] # TODO: write another script for ablation study
-    pred_margin_weight = A.w_value
-    logger.info(f"W value: {pred_margin_weight}.")  # for debugging
-    logger.info(f"Tau value: {A.tau_value}.")  # for debugging
+    parser.add_argument(
+        "--batched-search",
+        action="store_true",
+        help="Search all learning rates, w-values and taus of a model in one vectorised CF search, instead of one search per combination; faster, but its CFs may differ, default False.",
+    )
+    parser.add_argument(
+        "--compile-search",
+        action="store_true",
+        help="Run the CF search of each sample as one compiled TensorFlow function; not supported with `--batched-search` or the convergence policies, default False.",
+    )
+    parser.add_argument(
+        "--jit-compile",
+        action="store_true",
+        help="Compile the CF search of each sample with XLA, implies `--compile-search`, default False.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory to cache the dataset, the preprocessed folds, the trained models and the local step weights across runs, if None the dataset is downloaded, models are always trained and step weights only cached in memory.",
+    )
+    parser.add_argument(
+        "--artifact-dir",
+        type=str,
+        default=None,
+        help="Directory to save the counterfactuals, step weights, losses and iteration counts of every CF search, default to None (not saved).",
+    )
+    parser.add_argument(
+        "--artifact-atol",
+        type=float,
+        default=0.0,
+        help="Changes of the counterfactuals up to this tolerance are restored as the original sample from `--artifact-dir`, default to 0 (exact)."
+    )
+    parser.add_argument(
+        "--rebuild-models",
+        action="store_true",
+        help="Retrain the models and overwrite the ones cached in `--cache-dir`.",
+    )
+    parser.add_argument(
+        "--n-weight-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes computing the local step weights during CF search, default to 0 (in the main process).",
+    )
+    parser.add_argument(
+        "--n-intervals",
+        type=int,
+        default=None,
+        help="Number of intervals of the global step weights (permutation importance), default to one per timestep.",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="Compute the step weights of up to N samples ahead in a background thread during CF search, default to 0 (no prefetching).",
+    )
+    parser.add_argument(
+        "--plateau-tol",
+        type=float,
+        default=None,
+        help="Stop the CF search of a sample when its loss decreased by less than this fraction over 10 iterations, default to None (disabled).",
+    )
+    parser.add_argument(
+        "--refine-iter",
+        type=int,
+        default=None,
+        help="Stop the CF search of a sample this many iterations after it first became valid, default to None (disabled).",
+    )
+    parser.add_argument(
+        "--max-total-iter",
+        type=int,
+        default=None,
+        help="The maximum number of iterations of all samples searched together, default to None (unlimited).",
+    )
+    parser.add_argument(
+        "--mp-percentage",
+        type=float,
+        default=None,
+        help="Segment the samples of the local step weights with an approximate matrix profile, computing this fraction of the distances, ranging between (0, 1], default to None (exact).",
+    )
+    parser.add_argument(
+        "--warm-start",
+        type=float,
+        default=None,
+        help="Start the CF search from this fraction of the way to the latent code of the nearest unlike neighbour, ranging between [0, 1], default to None (from the sample).",
+    )
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=1,
+        help="Number of cross-validation folds run in parallel worker processes, -1 for one per CPU, default to 1.",
+    )
+    parser.add_argument(
+        "--threads-per-job",
+        type=int,
+        default=None,
+        help="Number of TensorFlow threads of each fold worker, default to the CPUs divided by `--n-jobs`.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Write the time per phase, model call counts, gradient steps per sample and cache hit rates of the run to this JSON file, default to None (not profiled).",
+    )
+    A = parser.parse_args(args)
+
+    if A.ablation:
+        A.w_value = PRED_MARGIN_W_LIST
+    if A.jit_compile:
+        A.compile_search = True
+    if A.compile_search and (
+        A.batched_search
+        or A.plateau_tol is not None
+        or A.refine_iter is not None
+        or A.max_total_iter is not None
+    ):
+        parser.error(
+            "--compile-search is not supported with --batched-search, --plateau-tol, "
+            "--refine-iter or --max-total-iter"
+        )
+    A.w_type = [w_type.lower() for w_type in A.w_type]
+    for w_type in A.w_type:
+        if w_type not in W_TYPES:
+            raise NotImplementedError(
+                "A.w_type not implemented, please choose 'local', 'global', 'uniform', or 'unconstrained'."
+            )
+    return A
 
-    result_writer = ResultWriter(file_name=A.output, dataset_name=A.dataset)
-    logger.info(f"Result writer is ready, writing to {A.output}...")
-    # If `A.output` file already exists, no need to write head (directly append)
-    if not os.path.isfile(A.output):
-        result_writer.write_head()
 
-    # 1. Load data
-    X, y = load_dataset(A.dataset, repository="wildboar/ucr")
+def load_data(A, dataset_store):
+    X, y = dataset_store.load_dataset(A.dataset, repository="wildboar/ucr")
 
     # Convert positive and negative labels to 1 and 0
     pos_label, neg_label = 1, 0
@@ -114,407 +260,699 @@ def main():
         y_copy[y == A.pos] = pos_label  # convert/normalize positive label to 1
     if A.neg != neg_label:
         y_copy[y == A.neg] = neg_label  # convert negative label to 0
+    return X, y_copy
+
 
+def split_folds(X, y):
+    """Yield the train/test indexes of the 5-fold cross validation, with the fold ID"""
     skf = StratifiedKFold(n_splits=5, shuffle=True, random_state=RANDOM_STATE)
-    fold_idx = 0
-    for train_index, test_index in skf.split(X, y_copy):
-        X_train, X_test = X[train_index], X[test_index]
-        y_train, y_test = y_copy[train_index], y_copy[test_index]
-
-        # Get 50 samples for CF evaluation if test size larger than 50
-        test_size = len(y_test)
-        if test_size >= 50:
-            try:
-                test_indices = np.arange(test_size)
-                _, _, _, rand_test_idx = train_test_split(
-                    y_test,
-                    test_indices,
-                    test_size=50,
-                    random_state=RANDOM_STATE,
-                    stratify=y_test,
-                )
-            except ValueError:  # ValueError: The train_size = 1 should be greater or equal to the number of classes = 2
-                rand_test_idx = np.arange(test_size)
+    for fold_idx, (train_index, test_index) in enumerate(skf.split(X, y), start=1):
+        yield fold_idx, train_index, test_index
 
-        else:
+
+def preprocess_fold(X, y, fold_idx, train_index, test_index):
+    """Split, upsample, normalize and pad the data of one fold, returns a dict of arrays"""
+    pos_label, neg_label = 1, 0
+    X_train, X_test = X[train_index], X[test_index]
+    y_train, y_test = y[train_index], y[test_index]
+
+    # Get 50 samples for CF evaluation if test size larger than 50
+    test_size = len(y_test)
+    if test_size >= 50:
+        try:
+            test_indices = np.arange(test_size)
+            _, _, _, rand_test_idx = train_test_split(
+                y_test,
+                test_indices,
+                test_size=50,
+                random_state=RANDOM_STATE,
+                stratify=y_test,
+            )
+        except ValueError:  # ValueError: The train_size = 1 should be greater or equal to the number of classes = 2
             rand_test_idx = np.arange(test_size)
 
-        X_train, X_val, y_train, y_val = train_test_split(
-            X_train,
-            y_train,
-            test_size=0.125,
-            random_state=RANDOM_STATE,
-            stratify=y_train,
-        )
+    else:
+        rand_test_idx = np.arange(test_size)
 
-        fold_idx += 1
-        logger.info(
-            f"Current CV fold: [{fold_idx}], with `X_train`, `X_val` & `X_test` shape: {X_train.shape} | {X_val.shape} | {X_test.shape}."
-        )
+    X_train, X_val, y_train, y_val = train_test_split(
+        X_train,
+        y_train,
+        test_size=0.125,
+        random_state=RANDOM_STATE,
+        stratify=y_train,
+    )
 
-        # Upsample the minority class
-        y_train_copy = y_train.copy()
-        X_train, y_train = upsample_minority(
-            X_train, y_train, pos_label=pos_label, neg_label=neg_label
-        )
-        if y_train.shape != y_train_copy.shape:
-            logger.info(
-                f"Data upsampling performed, current distribution of y_train: \n{pd.value_counts(y_train)}."
-            )
-        else:
-            logger.info(
-                f"Current distribution of y_train: \n{pd.value_counts(y_train)}."
-            )
+    logger.info(
+        f"Current CV fold: [{fold_idx}], with `X_train`, `X_val` & `X_test` shape: {X_train.shape} | {X_val.shape} | {X_test.shape}."
+    )
 
-        nb_classes = len(np.unique(y_train))
-        y_train_classes, y_val_classes, y_test_classes = (
-            y_train.copy(),
-            y_val.copy(),
-            y_test.copy(),
+    # Upsample the minority class
+    y_train_copy = y_train.copy()
+    X_train, y_train = upsample_minority(
+        X_train, y_train, pos_label=pos_label, neg_label=neg_label
+    )
+    if y_train.shape != y_train_copy.shape:
+        logger.info(
+            f"Data upsampling performed, current distribution of y_train: \n{pd.value_counts(y_train)}."
         )
-        y_train, y_val, y_test = (
-            to_categorical(y_train, nb_classes),
-            to_categorical(y_val, nb_classes),
-            to_categorical(y_test, nb_classes),
+    else:
+        logger.info(
+            f"Current distribution of y_train: \n{pd.value_counts(y_train)}."
         )
 
-        # ### 1.1 Normalization - fit scaler using training data
-        n_training, n_timesteps = X_train.shape
-        n_features = 1
+    nb_classes = len(np.unique(y_train))
+    y_train_classes, y_test_classes = y_train.copy(), y_test.copy()
+    y_train, y_val = (
+        to_categorical(y_train, nb_classes),
+        to_categorical(y_val, nb_classes),
+    )
 
-        X_train_processed, trained_scaler = time_series_normalize(
-            data=X_train, n_timesteps=n_timesteps
-        )
-        X_val_processed, _ = time_series_normalize(
-            data=X_val, n_timesteps=n_timesteps, scaler=trained_scaler
-        )
-        X_test_processed, _ = time_series_normalize(
-            data=X_test, n_timesteps=n_timesteps, scaler=trained_scaler
-        )
+    # ### 1.1 Normalization - fit scaler using training data
+    n_training, n_timesteps = X_train.shape
 
-        # add extra padding zeros if n_timesteps cannot be divided by 4, required for 1dCNN autoencoder structure
-        X_train_processed_padded, padding_size = conditional_pad(X_train_processed)
-        X_val_processed_padded, _ = conditional_pad(X_val_processed)
-        X_test_processed_padded, _ = conditional_pad(X_test_processed)
-        n_timesteps_padded = X_train_processed_padded.shape[1]
-        logger.info(
-            f"Data pre-processed, original #timesteps={n_timesteps}, padded #timesteps={n_timesteps_padded}."
-        )
+    X_train_processed, trained_scaler = time_series_normalize(
+        data=X_train, n_timesteps=n_timesteps
+    )
+    X_val_processed, _ = time_series_normalize(
+        data=X_val, n_timesteps=n_timesteps, scaler=trained_scaler
+    )
+    X_test_processed, _ = time_series_normalize(
+        data=X_test, n_timesteps=n_timesteps, scaler=trained_scaler
+    )
 
-        # ### 1.2 Evaluation models
-        n_neighbors_lof = int(np.cbrt(X_train_processed.shape[0]))
-        lof_estimator_pos, nn_model_pos = fit_evaluation_models(
-            n_neighbors_lof=n_neighbors_lof,
-            n_neighbors_nn=1,
-            training_data=np.squeeze(X_train_processed[y_train_classes == pos_label]),
-        )
-        lof_estimator_neg, nn_model_neg = fit_evaluation_models(
-            n_neighbors_lof=n_neighbors_lof,
-            n_neighbors_nn=1,
-            training_data=np.squeeze(X_train_processed[y_train_classes == neg_label]),
-        )
-        logger.info(
-            f"LOF and NN estimators trained for dataset: [[{A.dataset}]], fold-ID: {fold_idx}."
-        )
+    # add extra padding zeros if n_timesteps cannot be divided by 4, required for 1dCNN autoencoder structure
+    X_train_processed_padded, padding_size = conditional_pad(X_train_processed)
+    X_val_processed_padded, _ = conditional_pad(X_val_processed)
+    X_test_processed_padded, _ = conditional_pad(X_test_processed)
+
+    return dict(
+        rand_test_idx=rand_test_idx,
+        y_train=y_train,
+        y_val=y_val,
+        y_train_classes=y_train_classes,
+        y_test_classes=y_test_classes,
+        X_train_processed=X_train_processed,
+        X_test_processed=X_test_processed,
+        X_train_processed_padded=X_train_processed_padded,
+        X_val_processed_padded=X_val_processed_padded,
+        X_test_processed_padded=X_test_processed_padded,
+        padding_size=np.array(padding_size),
+    )
 
-        # ## 2. LatentCF models
-        # reset seeds for numpy, tensorflow, python random package and python environment seed
-        reset_seeds()
 
-        ###############################################
-        # ## 2.0 LSTM-FCN classifier
-        ###############################################
-        # ### LSTM-FCN classifier
-        classifier = LSTMFCNClassifier(
-            n_timesteps_padded, n_features, n_output=2, n_LSTM_cells=A.n_lstmcells
-        )
+def prepare_fold(A, X, y, fold_idx, train_index, test_index, dataset_store):
+    """Preprocess (or load) the data of one fold, and fit the evaluation models"""
+    pos_label, neg_label = 1, 0
+    n_features = 1
+
+    # everything the preprocessed arrays depend on; bump "version" when the preprocessing changes
+    fold_spec = dict(
+        version=1,
+        dataset=A.dataset,
+        pos=A.pos,
+        neg=A.neg,
+        seed=RANDOM_STATE,
+        n_splits=5,
+        fold=fold_idx,
+        val_size=0.125,
+        n_test_samples=50,
+        upsample="minority",
+        normalize="time_series_normalize",
+        padding="conditional_pad(4)",
+    )
+    arrays = dataset_store.fold_arrays(
+        fold_spec, lambda: preprocess_fold(X, y, fold_idx, train_index, test_index)
+    )
+    X_train_processed = arrays["X_train_processed"]
+    y_train_classes = arrays["y_train_classes"]
+    padding_size = int(arrays["padding_size"])
+    n_timesteps_padded = arrays["X_train_processed_padded"].shape[1]
+    logger.info(
+        f"Data pre-processed, original #timesteps={n_timesteps_padded - padding_size}, padded #timesteps={n_timesteps_padded}."
+    )
 
-        optimizer = keras.optimizers.Adam(learning_rate=0.0001)
-        classifier.compile(
-            optimizer=optimizer, loss="binary_crossentropy", metrics=["accuracy"]
-        )
+    # ### 1.2 Evaluation models
+    n_neighbors_lof = int(np.cbrt(X_train_processed.shape[0]))
+    lof_estimator_pos, nn_model_pos = fit_evaluation_models(
+        n_neighbors_lof=n_neighbors_lof,
+        n_neighbors_nn=1,
+        training_data=np.squeeze(X_train_processed[y_train_classes == pos_label]),
+    )
+    lof_estimator_neg, nn_model_neg = fit_evaluation_models(
+        n_neighbors_lof=n_neighbors_lof,
+        n_neighbors_nn=1,
+        training_data=np.squeeze(X_train_processed[y_train_classes == neg_label]),
+    )
+    logger.info(
+        f"LOF and NN estimators trained for dataset: [[{A.dataset}]], fold-ID: {fold_idx}."
+    )
 
-        # Define the early stopping criteria
-        early_stopping_accuracy = keras.callbacks.EarlyStopping(
-            monitor="val_accuracy", patience=30, restore_best_weights=True
-        )
-        # Train the model
-        reset_seeds()
-        logger.info("Training log for LSTM-FCN classifier:")
-        classifier_history = classifier.fit(
-            X_train_processed_padded,
-            y_train,
+    return SimpleNamespace(
+        fold_idx=fold_idx,
+        rand_test_idx=arrays["rand_test_idx"],
+        y_train=arrays["y_train"],
+        y_val=arrays["y_val"],
+        y_train_classes=y_train_classes,
+        y_test_classes=arrays["y_test_classes"],
+        n_features=n_features,
+        X_test_processed=arrays["X_test_processed"],
+        X_train_processed_padded=arrays["X_train_processed_padded"],
+        X_val_processed_padded=arrays["X_val_processed_padded"],
+        X_test_processed_padded=arrays["X_test_processed_padded"],
+        padding_size=padding_size,
+        n_timesteps_padded=n_timesteps_padded,
+        lof_estimator_pos=lof_estimator_pos,
+        lof_estimator_neg=lof_estimator_neg,
+        nn_model_pos=nn_model_pos,
+        nn_model_neg=nn_model_neg,
+        # what the trained models depend on, besides their architecture and training config
+        data_spec=dict(
+            dataset=A.dataset,
+            fold=fold_idx,
+            seed=RANDOM_STATE,
+            train_data=array_fingerprint(arrays["X_train_processed_padded"]),
+            train_labels=array_fingerprint(y_train_classes),
+            val_data=array_fingerprint(arrays["X_val_processed_padded"]),
+        ),
+    )
+
+
+def train_classifier(A, fold, model_cache):
+    """Train (or load) the LSTM-FCN classifier, returns it with its test accuracy and predictions"""
+    # reset seeds for numpy, tensorflow, python random package and python environment seed
+    reset_seeds()
+
+    classifier = LSTMFCNClassifier(
+        fold.n_timesteps_padded, fold.n_features, n_output=2, n_LSTM_cells=A.n_lstmcells
+    )
+
+    optimizer = keras.optimizers.Adam(learning_rate=0.0001)
+    classifier.compile(
+        optimizer=optimizer, loss="binary_crossentropy", metrics=["accuracy"]
+    )
+
+    # Define the early stopping criteria
+    early_stopping_accuracy = keras.callbacks.EarlyStopping(
+        monitor="val_accuracy", patience=30, restore_best_weights=True
+    )
+    # Train the model
+    reset_seeds()
+    logger.info("Training log for LSTM-FCN classifier:")
+
+    def fit_classifier():
+        classifier.fit(
+            fold.X_train_processed_padded,
+            fold.y_train,
             epochs=150,
             batch_size=32,
             shuffle=True,
             verbose=True,
-            validation_data=(X_val_processed_padded, y_val),
+            validation_data=(fold.X_val_processed_padded, fold.y_val),
             callbacks=[early_stopping_accuracy],
         )
+        return {}
+
+    model_cache.fit_or_load(
+        classifier,
+        dict(
+            model="LSTMFCNClassifier",
+            n_timesteps=fold.n_timesteps_padded,
+            n_features=fold.n_features,
+            n_output=2,
+            n_LSTM_cells=A.n_lstmcells,
+            learning_rate=0.0001,
+            loss="binary_crossentropy",
+            epochs=150,
+            batch_size=32,
+            patience=30,
+            **fold.data_spec,
+        ),
+        fit_classifier,
+    )
 
-        y_pred = classifier.predict(X_test_processed_padded)
-        y_pred_classes = np.argmax(y_pred, axis=1)
-        acc = balanced_accuracy_score(y_true=y_test_classes, y_pred=y_pred_classes)
-        logger.info(f"LSTM-FCN classifier trained, with test accuracy {acc}.")
-
-        confusion_matrix_df = pd.DataFrame(
-            confusion_matrix(
-                y_true=y_test_classes, y_pred=y_pred_classes, labels=[1, 0]
-            ),
-            index=["True:pos", "True:neg"],
-            columns=["Pred:pos", "Pred:neg"],
-        )
-        logger.info(f"Confusion matrix: \n{confusion_matrix_df}.")
-
-        # ### 2.0.1 Get `step_weights` based on the input argument
-        if A.w_type == "global":
-            step_weights = get_global_weights(
-                X_train_processed_padded,
-                y_train_classes,
-                classifier,
-                random_state=RANDOM_STATE,
-            )
-        elif A.w_type == "uniform":
-            step_weights = np.ones((1, n_timesteps_padded, n_features))
-        elif A.w_type.lower() == "local":
-            step_weights = "local"
-        elif A.w_type == "unconstrained":
-            step_weights = np.zeros((1, n_timesteps_padded, n_features))
-        else:
-            raise NotImplementedError(
-                "A.w_type not implemented, please choose 'local', 'global', 'uniform', or 'unconstrained'."
-            )
+    y_pred = classifier.predict(fold.X_test_processed_padded)
+    y_pred_classes = np.argmax(y_pred, axis=1)
+    acc = balanced_accuracy_score(y_true=fold.y_test_classes, y_pred=y_pred_classes)
+    logger.info(f"LSTM-FCN classifier trained, with test accuracy {acc}.")
+
+    confusion_matrix_df = pd.DataFrame(
+        confusion_matrix(
+            y_true=fold.y_test_classes, y_pred=y_pred_classes, labels=[1, 0]
+        ),
+        index=["True:pos", "True:neg"],
+        columns=["Pred:pos", "Pred:neg"],
+    )
+    logger.info(f"Confusion matrix: \n{confusion_matrix_df}.")
+    return classifier, acc, y_pred_classes
+
+
+def train_autoencoders(A, fold, model_cache):
+    """Train (or load) the autoencoders, returns `(method_name, autoencoder, ae_val_loss, lr_list, nun_index)` per CF search model"""
+    ###############################################
+    # ## 2.1 1dCNN autoencoder
+    ###############################################
+    # the initial weights do not depend on whether the classifier was trained or loaded from the cache
+    reset_seeds()
+    autoencoder = Autoencoder(fold.n_timesteps_padded, fold.n_features)
+    optimizer = keras.optimizers.Adam(learning_rate=0.0005)
+    autoencoder.compile(optimizer=optimizer, loss="mse")
+
+    # Define the early stopping criteria
+    early_stopping = keras.callbacks.EarlyStopping(
+        monitor="val_loss", min_delta=0.0001, patience=5, restore_best_weights=True
+    )
+    # Train the model
+    reset_seeds()
+    logger.info("Training log for 1dCNN autoencoder:")
 
-        ###############################################
-        # ## 2.1 CF search with 1dCNN autoencoder
-        ###############################################
-        # ### 1dCNN autoencoder
-        autoencoder = Autoencoder(n_timesteps_padded, n_features)
-        optimizer = keras.optimizers.Adam(learning_rate=0.0005)
-        autoencoder.compile(optimizer=optimizer, loss="mse")
-
-        # Define the early stopping criteria
-        early_stopping = keras.callbacks.EarlyStopping(
-            monitor="val_loss", min_delta=0.0001, patience=5, restore_best_weights=True
-        )
-        # Train the model
-        reset_seeds()
-        logger.info("Training log for 1dCNN autoencoder:")
+    def fit_autoencoder():
         autoencoder_history = autoencoder.fit(
-            X_train_processed_padded,
-            X_train_processed_padded,
+            fold.X_train_processed_padded,
+            fold.X_train_processed_padded,
             epochs=50,
             batch_size=32,
             shuffle=True,
             verbose=True,
-            validation_data=(X_val_processed_padded, X_val_processed_padded),
+            validation_data=(fold.X_val_processed_padded, fold.X_val_processed_padded),
             callbacks=[early_stopping],
         )
+        return dict(ae_val_loss=float(np.min(autoencoder_history.history["val_loss"])))
+
+    ae_spec = dict(
+        model="Autoencoder",
+        n_timesteps=fold.n_timesteps_padded,
+        n_features=fold.n_features,
+        learning_rate=0.0005,
+        loss="mse",
+        epochs=50,
+        batch_size=32,
+        patience=5,
+        **fold.data_spec,
+    )
+    ae_val_loss = model_cache.fit_or_load(autoencoder, ae_spec, fit_autoencoder)["ae_val_loss"]
+    logger.info(f"1dCNN autoencoder trained, with validation loss: {ae_val_loss}.")
+
+    ###############################################
+    # ## 2.2 LSTM autoencoder
+    ###############################################
+    # use the padded dimension, the initial weights do not depend on whether the
+    # 1dCNN autoencoder was trained or loaded from the cache
+    reset_seeds()
+    autoencoder2 = AutoencoderLSTM(fold.n_timesteps_padded, fold.n_features)
+    optimizer = keras.optimizers.Adam(learning_rate=0.0001)
+    autoencoder2.compile(optimizer=optimizer, loss="mse")
+
+    # Define the early stopping criteria
+    early_stopping = keras.callbacks.EarlyStopping(
+        monitor="val_loss", min_delta=0.0001, patience=5, restore_best_weights=True
+    )
+    # Train the model
+    reset_seeds()
+    logger.info("Training log for LSTM autoencoder:")
 
-        ae_val_loss = np.min(autoencoder_history.history["val_loss"])
-        logger.info(f"1dCNN autoencoder trained, with validation loss: {ae_val_loss}.")
-
-        ### Evaluation metrics
-        # update: only evaluating one prediction_margin_weight in this script
-        logger.info(
-            f"The current prediction margin weight is {pred_margin_weight}, for [1dCNN autoencoder]."
-        )
-
-        # Get these instances for CF evaluation; class abnormal (0) VS normal class (1)
-        rand_X_test = X_test_processed_padded[rand_test_idx]
-        rand_y_pred = y_pred_classes[rand_test_idx]
-
-        lr_list = [A.lr_list[0]] if A.lr_list[0] is not None else [0.001, 0.0001]
-        best_lr, best_cf_model, best_cf_samples, _ = find_best_lr(
-            classifier,
-            X_samples=rand_X_test,
-            pred_labels=rand_y_pred,
-            autoencoder=autoencoder,
-            lr_list=lr_list,
-            pred_margin_weight=pred_margin_weight,
-            step_weights=step_weights,
-            random_state=RANDOM_STATE,
-            padding_size=padding_size,
-            target_prob=A.tau_value,
-        )
-        logger.info(f"The best learning rate found is {best_lr}.")
-
-        # predicted probabilities of CFs
-        z_pred = classifier.predict(best_cf_samples)
-        cf_pred_labels = np.argmax(z_pred, axis=1)
-
-        # remove extra paddings after counterfactual generation in 1dCNN autoencoder
-        best_cf_samples = remove_paddings(best_cf_samples, padding_size)
-        # use the unpadded X_test for evaluation
-        rand_X_test_original = np.squeeze(X_test_processed[rand_test_idx])
-
-        evaluate_res = evaluate(
-            rand_X_test_original,
-            best_cf_samples,
-            rand_y_pred,
-            cf_pred_labels,
-            lof_estimator_pos,
-            lof_estimator_neg,
-            nn_model_pos,
-            nn_model_neg,
-        )
-
-        result_writer.write_result(
-            fold_idx,
-            "1dCNN autoencoder",
-            acc,
-            ae_val_loss,
-            best_lr,
-            evaluate_res,
-            pred_margin_weight=pred_margin_weight,
-            step_weight_type=A.w_type.lower(),
-            threshold_tau=A.tau_value,
-        )
-        logger.info(
-            f"Done for CF search [1dCNN autoencoder], pred_margin_weight={pred_margin_weight}."
-        )
-
-        # ###############################################
-        # ## 2.2 CF search with LSTM autoencoder
-        ################################################
-        # ### LSTM autoencoder
-        # use the padded dimension
-        autoencoder2 = AutoencoderLSTM(n_timesteps_padded, n_features)
-        optimizer = keras.optimizers.Adam(learning_rate=0.0001)
-        autoencoder2.compile(optimizer=optimizer, loss="mse")
-
-        # Define the early stopping criteria
-        early_stopping = keras.callbacks.EarlyStopping(
-            monitor="val_loss", min_delta=0.0001, patience=5, restore_best_weights=True
-        )
-        # Train the model
-        reset_seeds()
-        logger.info("Training log for LSTM autoencoder:")
+    def fit_autoencoder2():
         autoencoder_history2 = autoencoder2.fit(
-            X_train_processed_padded,
-            X_train_processed_padded,
+            fold.X_train_processed_padded,
+            fold.X_train_processed_padded,
             epochs=50,
             batch_size=32,
             shuffle=True,
             verbose=True,
-            validation_data=(X_test_processed_padded, X_test_processed_padded),
+            validation_data=(fold.X_test_processed_padded, fold.X_test_processed_padded),
             callbacks=[early_stopping],
         )
+        return dict(ae_val_loss=float(np.min(autoencoder_history2.history["val_loss"])))
+
+    ae_spec2 = dict(
+        model="AutoencoderLSTM",
+        n_timesteps=fold.n_timesteps_padded,
+        n_features=fold.n_features,
+        learning_rate=0.0001,
+        loss="mse",
+        epochs=50,
+        batch_size=32,
+        patience=5,
+        # validated on the test split, unlike the 1dCNN autoencoder
+        **dict(fold.data_spec, val_data=array_fingerprint(fold.X_test_processed_padded)),
+    )
+    ae_val_loss2 = model_cache.fit_or_load(autoencoder2, ae_spec2, fit_autoencoder2)["ae_val_loss"]
+    logger.info(f"LSTM autoencoder trained, with validation loss: {ae_val_loss2}.")
 
-        ae_val_loss2 = np.min(autoencoder_history2.history["val_loss"])
-        logger.info(f"LSTM autoencoder trained, with validation loss: {ae_val_loss2}.")
-
-        logger.info(
-            f"The current prediction margin weight is {pred_margin_weight}, for [LSTM autoencoder]."
-        )
-
-        lr_list2 = [A.lr_list[1]] if A.lr_list[1] is not None else [0.001, 0.0001]
-        best_lr2, best_cf_model2, best_cf_samples2, _ = find_best_lr(
-            classifier,
-            X_samples=rand_X_test,
-            pred_labels=rand_y_pred,
-            autoencoder=autoencoder2,
-            lr_list=lr_list2,
-            pred_margin_weight=pred_margin_weight,
-            step_weights=step_weights,
-            random_state=RANDOM_STATE,
-            padding_size=padding_size,
-            target_prob=A.tau_value,
-        )
-        logger.info(f"The best learning rate found is {best_lr2}.")
-
-        # ### Evaluation metrics
-        # predicted probabilities of CFs
-        z_pred2 = classifier.predict(best_cf_samples2)
-        cf_pred_labels2 = np.argmax(z_pred2, axis=1)
-
-        # remove extra paddings after counterfactual generation in 1dCNN autoencoder
-        best_cf_samples2 = remove_paddings(best_cf_samples2, padding_size)
-
-        evaluate_res2 = evaluate(
-            rand_X_test_original,
-            best_cf_samples2,
-            rand_y_pred,
-            cf_pred_labels2,
-            lof_estimator_pos,
-            lof_estimator_neg,
-            nn_model_pos,
-            nn_model_neg,
-        )
-
-        result_writer.write_result(
-            fold_idx,
+    default_lr_list = [0.001, 0.0001]
+    return [
+        (
+            "1dCNN autoencoder",
+            autoencoder,
+            ae_val_loss,
+            [A.lr_list[0]] if A.lr_list[0] is not None else default_lr_list,
+            get_nun_index(A, fold, autoencoder, ae_spec, model_cache),
+        ),
+        (
             "LSTM autoencoder",
-            acc,
+            autoencoder2,
             ae_val_loss2,
-            best_lr2,
-            evaluate_res2,
-            pred_margin_weight=pred_margin_weight,
-            step_weight_type=A.w_type.lower(),
-            threshold_tau=A.tau_value,
-        )
-        logger.info(
-            f"Done for CF search [LSTM autoencoder], pred_margin_weight={pred_margin_weight}."
-        )
-
-        ###############################################
+            [A.lr_list[1]] if A.lr_list[1] is not None else default_lr_list,
+            get_nun_index(A, fold, autoencoder2, ae_spec2, model_cache),
+        ),
         # ## 2.3 CF search with no autoencoder
-        ###############################################
+        (
+            "No autoencoder",
+            None,
+            0,
+            [A.lr_list[2]] if A.lr_list[2] is not None else default_lr_list,
+            get_nun_index(A, fold, None, dict(model=None, **fold.data_spec), model_cache),
+        ),
+    ]
+
+
+def get_nun_index(A, fold, autoencoder, model_spec, model_cache):
+    """Build (or load) the index of the latent codes of the training samples, for `--warm-start`"""
+    if A.warm_start is None:
+        return None
+
+    # the index only depends on the autoencoder, stored next to it
+    path = model_cache.artifact_path(model_spec, "nun.npz")
+    if path is not None and os.path.isfile(path) and not A.rebuild_models:
+        return LatentNUNIndex.load(path)
+
+    nun_index = fit_nun_index(autoencoder, fold.X_train_processed_padded, fold.y_train_classes)
+    if path is not None:
+        nun_index.save(path)
+    return nun_index
+
+
+def get_step_weights(A, w_type, fold, classifier):
+    # ### 2.0.1 Get `step_weights` based on the input argument
+    if w_type == "global":
+        return get_global_weights(
+            fold.X_train_processed_padded,
+            fold.y_train_classes,
+            classifier,
+            random_state=RANDOM_STATE,
+            n_intervals=A.n_intervals,
+        )
+    elif w_type == "uniform":
+        return np.ones((1, fold.n_timesteps_padded, fold.n_features))
+    elif w_type == "local":
+        return "local"
+    elif w_type == "unconstrained":
+        return np.zeros((1, fold.n_timesteps_padded, fold.n_features))
+
+
+def run_cf_search(
+    A,
+    fold,
+    classifier,
+    acc,
+    y_pred_classes,
+    cf_models,
+    w_type,
+    result_writer,
+    step_weights_cache,
+    local_weights_executor,
+    artifact_store=None,
+):
+    """CF search of every (w-value, tau) combination with the step weights of `w_type`, one result row per combination"""
+    with get_profiler().phase("step_weights"):
+        step_weights = get_step_weights(A, w_type, fold, classifier)
+
+    # Get these instances for CF evaluation; class abnormal (0) VS normal class (1)
+    rand_X_test = fold.X_test_processed_padded[fold.rand_test_idx]
+    rand_y_pred = y_pred_classes[fold.rand_test_idx]
+    # use the unpadded X_test for evaluation
+    rand_X_test_original = np.squeeze(fold.X_test_processed[fold.rand_test_idx])
+
+    for method_name, autoencoder, ae_val_loss, lr_list, nun_index in cf_models:
         logger.info(
-            f"The current prediction margin weight is {pred_margin_weight}, for [No autoencoder]."
+            f"The current prediction margin weights are {A.w_value}, taus {A.tau_value}, for [{method_name}], W type: {w_type}."
         )
-
-        lr_list3 = [A.lr_list[2]] if A.lr_list[2] is not None else [0.001, 0.0001]
-        best_lr3, best_cf_model3, best_cf_samples3, _ = find_best_lr(
-            classifier,
+        search_params = dict(
             X_samples=rand_X_test,
             pred_labels=rand_y_pred,
-            autoencoder=None,
-            lr_list=lr_list3,
-            pred_margin_weight=pred_margin_weight,
+            autoencoder=autoencoder,
+            lr_list=lr_list,
             step_weights=step_weights,
             random_state=RANDOM_STATE,
-            padding_size=padding_size,
-            target_prob=A.tau_value,
-        )
-        logger.info(f"The best learning rate found is {best_lr3}.")
-
-        # ### Evaluation metrics
-        # predicted probabilities of CFs
-        z_pred3 = classifier.predict(best_cf_samples3)
-        cf_pred_labels3 = np.argmax(z_pred3, axis=1)
-
-        # remove extra paddings after counterfactual generation in 1dCNN autoencoder
-        best_cf_samples3 = remove_paddings(best_cf_samples3, padding_size)
-
-        evaluate_res3 = evaluate(
-            rand_X_test_original,
-            best_cf_samples3,
-            rand_y_pred,
-            cf_pred_labels3,
-            lof_estimator_pos,
-            lof_estimator_neg,
-            nn_model_pos,
-            nn_model_neg,
-        )
+            padding_size=fold.padding_size,
+            step_weights_cache=step_weights_cache,
+            local_weights_executor=local_weights_executor,
+            prefetch=A.prefetch,
+            plateau_tol=A.plateau_tol,
+            refine_iter=A.refine_iter,
+            max_total_iter=A.max_total_iter,
+            warm_start=A.warm_start,
+            nun_index=nun_index,
+            mp_percentage=A.mp_percentage,
+        )
+        if A.batched_search:
+            # all learning rates, prediction margin weights and taus in one vectorised search
+            best_results = find_best_lr_batched(
+                classifier,
+                pred_margin_weight_list=A.w_value,
+                target_prob_list=A.tau_value,
+                **search_params,
+            )
+        else:
+            best_results = {
+                (pred_margin_weight, tau_value): find_best_lr(
+                    classifier,
+                    pred_margin_weight=pred_margin_weight,
+                    target_prob=tau_value,
+                    compile_search=A.compile_search,
+                    jit_compile=A.jit_compile,
+                    return_stats=True,
+                    **search_params,
+                )
+                for pred_margin_weight, tau_value in itertools.product(A.w_value, A.tau_value)
+            }
 
-        result_writer.write_result(
-            fold_idx,
-            "No autoencoder",
-            acc,
-            0,
-            best_lr3,
-            evaluate_res3,
-            pred_margin_weight=pred_margin_weight,
-            step_weight_type=A.w_type.lower(),
-            threshold_tau=A.tau_value,
-        )
-        logger.info(
-            f"Done for CF search [No autoencoder], pred_margin_weight={pred_margin_weight}."
+        for pred_margin_weight, tau_value in itertools.product(A.w_value, A.tau_value):
+            best_lr, _, best_cf_samples, _, sample_stats = best_results[
+                (pred_margin_weight, tau_value)
+            ]
+            logger.info(
+                f"The best learning rate found is {best_lr}, pred_margin_weight={pred_margin_weight}, tau={tau_value}."
+            )
+
+            # ### Evaluation metrics
+            # predicted probabilities of CFs
+            with get_profiler().phase("evaluate"):
+                z_pred = classifier.predict(best_cf_samples)
+
+            if artifact_store is not None:
+                with get_profiler().phase("save_artifacts"):
+                    artifact_store.save(
+                        os.path.join(
+                            A.dataset,
+                            f"fold{fold.fold_idx}",
+                            method_name.replace(" ", "_"),
+                            f"{w_type}-w{pred_margin_weight}-tau{tau_value}",
+                        ),
+                        rand_X_test,
+                        best_cf_samples,
+                        sample_idx=fold.rand_test_idx,
+                        step_weights=sample_stats["step_weights"],
+                        losses=sample_stats["loss"],
+                        n_iter=sample_stats["n_iter"],
+                        metadata=dict(
+                            dataset=A.dataset,
+                            fold=fold.fold_idx,
+                            method=method_name,
+                            step_weight_type=w_type,
+                            pred_margin_weight=pred_margin_weight,
+                            threshold_tau=tau_value,
+                            best_lr=best_lr,
+                            padding_size=fold.padding_size,
+                        ),
+                    )
+
+            # remove extra paddings after counterfactual generation in 1dCNN autoencoder
+            best_cf_samples = remove_paddings(best_cf_samples, fold.padding_size)
+
+            with get_profiler().phase("evaluate"):
+                evaluate_res = evaluate(
+                    rand_X_test_original,
+                    best_cf_samples,
+                    rand_y_pred,
+                    z_pred,
+                    fold.lof_estimator_pos,
+                    fold.lof_estimator_neg,
+                    fold.nn_model_pos,
+                    fold.nn_model_neg,
+                )
+                sample_res = evaluate_samples(
+                    rand_X_test_original, best_cf_samples, rand_y_pred, z_pred
+                )
+
+            result_writer.write_result(
+                fold.fold_idx,
+                method_name,
+                acc,
+                ae_val_loss,
+                best_lr,
+                evaluate_res,
+                pred_margin_weight=pred_margin_weight,
+                step_weight_type=w_type,
+                threshold_tau=tau_value,
+                sample_res={**sample_res, **sample_stats},
+            )
+        logger.info(f"Done for CF search [{method_name}], W type: {w_type}.")
+
+
+def get_dataset_store(A):
+    # The raw dataset and the preprocessed folds, memory-mapped from `--cache-dir`
+    # so that repeated runs work offline and concurrent fold workers share the pages
+    return DatasetStore(
+        cache_dir=None if A.cache_dir is None else os.path.join(A.cache_dir, "datasets")
+    )
+
+
+def run_fold(A, X, y, fold_idx, train_index, test_index):
+    """Run all CF searches of one fold, returns the result rows, the step weights
+    cache statistics and the records of the profiler (None if not profiled)"""
+    # the fold has its own profiler, whose records are merged by the main process
+    profiler = Profiler() if A.profile is not None else None
+    previous_profiler = set_profiler(profiler)
+    try:
+        with get_profiler().phase("fold"):
+            result_collector, cache_stats = _run_fold(A, X, y, fold_idx, train_index, test_index)
+    finally:
+        set_profiler(previous_profiler)
+    return result_collector, cache_stats, None if profiler is None else profiler.state()
+
+
+def _run_fold(A, X, y, fold_idx, train_index, test_index):
+    # per-fold seeding, so that a fold gives the same results in any process
+    reset_seeds()
+
+    # Local step weights only depend on the sample and the trained classifier,
+    # share them across learning rates, autoencoders (and runs, with `--cache-dir`)
+    step_weights_cache = StepWeightCache(
+        cache_dir=None if A.cache_dir is None else os.path.join(A.cache_dir, "step_weights")
+    )
+
+    # The classifier and autoencoders only depend on the dataset, fold and training config,
+    # not on the CF search; reuse them across invocations
+    model_cache = ModelCache(
+        cache_dir=None if A.cache_dir is None else os.path.join(A.cache_dir, "models"),
+        rebuild=A.rebuild_models,
+    )
+
+    # the CFs are padded, restored with the padded `X_test` of the fold
+    artifact_store = (
+        None
+        if A.artifact_dir is None
+        else CFArtifactStore(A.artifact_dir, atol=A.artifact_atol)
+    )
+
+    # the rows are written by the main process, in fold order
+    result_collector = ResultCollector()
+
+    with get_profiler().phase("prepare_fold"):
+        fold = prepare_fold(
+            A, X, y, fold_idx, train_index, test_index, get_dataset_store(A)
         )
+
+    # ## 2. LatentCF models, trained once per fold and shared by all CF searches
+    with get_profiler().phase("train_classifier"):
+        classifier, acc, y_pred_classes = train_classifier(A, fold, model_cache)
+    with get_profiler().phase("train_autoencoders"):
+        cf_models = train_autoencoders(A, fold, model_cache)
+
+    # the pool and the saved classifier are released even if a CF search fails
+    if "local" in A.w_type and A.n_weight_workers > 0:
+        executor_context = LocalWeightsExecutor(classifier, n_workers=A.n_weight_workers)
+    else:
+        executor_context = nullcontext()
+
+    with executor_context as local_weights_executor:
+        for w_type in A.w_type:
+            run_cf_search(
+                A,
+                fold,
+                classifier,
+                acc,
+                y_pred_classes,
+                cf_models,
+                w_type,
+                result_collector,
+                step_weights_cache,
+                local_weights_executor,
+                artifact_store,
+            )
+
+    return result_collector, (step_weights_cache.hits, step_weights_cache.misses)
+
+
+def main(args=None):
+    A = parse_args(args)
+
+    logger.info(f"Num GPUs Available: {len(tf.config.list_physical_devices('GPU'))}.")
+    numba_logger = logging.getLogger("numba")
+    numba_logger.setLevel(logging.WARNING)
+    logger.info(f"LR list: {A.lr_list}.")  # for debugging
+    logger.info(f"W type: {A.w_type}.")  # for debugging
+    logger.info(f"W value: {A.w_value}.")  # for debugging
+    logger.info(f"Tau value: {A.tau_value}.")  # for debugging
+
+    profiler = Profiler() if A.profile is not None else None
+    previous_profiler = set_profiler(profiler)
+    try:
+        _main(A)
+    finally:
+        set_profiler(previous_profiler)
+
+    if profiler is not None:
+        profiler.save(
+            A.profile,
+            script="gc_latentcf_search",
+            dataset=A.dataset,
+            w_type=A.w_type,
+            n_jobs=A.n_jobs,
+        )
+        logger.info(f"Profile written to {A.profile}.")
     logger.info("Done.")
 
 
+def _main(A):
+    result_writer = ResultWriter(
+        file_name=A.output,
+        dataset_name=A.dataset,
+        samples_file_name=A.samples_output,
+    )
+    logger.info(f"Result writer is ready, writing to {result_writer.file_name}...")
+    # If `A.output` file already exists, no need to write head (directly append)
+    if os.path.exists(result_writer.file_name):
+        result_writer.check_head()
+    else:
+        result_writer.write_head()
+
+    # 1. Load data
+    with get_profiler().phase("load_data"):
+        X, y = load_data(A, get_dataset_store(A))
+
+    # the folds are independent, run them in `A.n_jobs` processes and write their rows in fold order
+    fold_args = [
+        (A, X, y, fold_idx, train_index, test_index)
+        for fold_idx, train_index, test_index in split_folds(X, y)
+    ]
+    cache_hits, cache_misses = 0, 0
+    for fold_idx, (result_collector, (hits, misses), fold_profile) in enumerate(
+        run_folds(run_fold, fold_args, n_jobs=A.n_jobs, n_threads=A.threads_per_job),
+        start=1,
+    ):
+        result_collector.replay(result_writer)
+        result_writer.flush()
+        cache_hits, cache_misses = cache_hits + hits, cache_misses + misses
+        if fold_profile is not None:
+            get_profiler().merge(fold_profile)
+        logger.info(f"Results of fold-ID {fold_idx} written.")
+
+    logger.info(
+        f"Step weights cache: {cache_hits} hits, {cache_misses} misses."
+    )
+
+
 if __name__ == "__main__":
     logging.basicConfig(
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
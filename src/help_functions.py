@@ -1,6 +1,10 @@
 import os
 import csv
+import io
+import itertools
 import random as python_random
+import tempfile
+import warnings
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -13,38 +17,100 @@ from sklearn.neighbors import LocalOutlierFactor, NearestNeighbors
 
 # from _composite import ModifiedLatentCF
 from _guided import ModifiedLatentCF
+from profiling import get_profiler
 from _vanilla import LatentCF
 
 # from keras import backend as K
 
 
+RESULT_COLUMNS = [
+    "dataset",
+    "fold_id",
+    "method",
+    "classifier_accuracy",
+    "autoencoder_loss",
+    "best_lr",
+    "proximity",
+    "validity",
+    "margin_mean",
+    "margin_std",
+    "lof_score",
+    "relative_proximity",
+    "pred_margin_weight",
+    "step_weight_type",
+    "threshold_tau",
+]
+SAMPLE_COLUMNS = [
+    "dataset",
+    "fold_id",
+    "method",
+    "best_lr",
+    "pred_margin_weight",
+    "step_weight_type",
+    "threshold_tau",
+    "sample_idx",
+    "pred_label",
+    "proximity",
+    "validity",
+    "margin",
+    "n_iter",
+    "loss",
+    "time",
+]
+
+
 class ResultWriter:
-    def __init__(self, file_name, dataset_name):
-        self.file_name = file_name
+    """Buffered writer of the result rows, one per CF search, and optionally one per sample
+
+    Rows are kept in memory until `flush`, which writes only the new rows. The
+    format follows the extension: `.parquet` (Parquet) or `.arrow`/`.feather`
+    (Arrow IPC), both requiring pyarrow, or CSV otherwise. A CSV file is
+    appended in place, which is not atomic: a crash during `flush` can leave a
+    partial last row. A columnar output is a directory with one part file per
+    `flush`, renamed into place once written, read back with `read_rows`, so
+    it only ever holds complete flushes.
+    Without pyarrow, columnar files fall back to a CSV file next to them.
+
+    Rows are only appended to an existing output with the same columns,
+    otherwise a ValueError is raised.
+    """
+
+    def __init__(self, file_name, dataset_name, samples_file_name=None):
+        """
+        Parameters
+        ----------
+        file_name : str
+            The file of the aggregate rows
+
+        dataset_name : str
+            The dataset, first column of every row
+
+        samples_file_name : str, optional
+            The file of the per-sample rows, if None they are not written
+        """
+        self.file_name = result_file_name(file_name)
         self.dataset_name = dataset_name
+        self.samples_file_name = (
+            None if samples_file_name is None else result_file_name(samples_file_name)
+        )
+        self.rows_ = []
+        self.sample_rows_ = []
 
     def write_head(self):
-        # write the head in csv file
-        with open(self.file_name, "w") as f:
-            writer = csv.writer(f)
-            writer.writerow(
-                [
-                    "dataset",
-                    "method",
-                    "classifier_accuracy",
-                    "autoencoder_loss",
-                    "best_lr",
-                    "proximity",
-                    "validity",
-                    "margin_mean",
-                    "margin_std",
-                    "pred_margin_weight",
-                    "step_weight_type",
-                ]
-            )
+        # (re)create the files with only their header
+        _write_rows(self.file_name, RESULT_COLUMNS, [], append=False)
+        if self.samples_file_name is not None:
+            _write_rows(self.samples_file_name, SAMPLE_COLUMNS, [], append=False)
+
+    def check_head(self):
+        """Raise a ValueError if an existing file has other columns than the rows"""
+        _check_columns(self.file_name, RESULT_COLUMNS)
+        if self.samples_file_name is not None and os.path.exists(self.samples_file_name):
+            _check_columns(self.samples_file_name, SAMPLE_COLUMNS)
 
     def write_result(
         self,
+        fold_idx,
         method_name,
         acc,
         ae_loss,
@@ -52,32 +118,239 @@ class ResultWriter:
         evaluate_res,
         pred_margin_weight=1.0,
         step_weight_type="",
+        threshold_tau=0.5,
+        sample_res=None,
     ):
-        (
-            proxi,
-            valid,
-            cost_mean,
-            cost_std,
-        ) = evaluate_res
-
-        with open(self.file_name, "a") as f:
-            writer = csv.writer(f)
-            writer.writerow(
+        """Buffer the rows of one CF search
+
+        evaluate_res : tuple
+            The aggregate metrics, as returned by `evaluate`
+
+        sample_res : dict of array-like, optional
+            The per-sample metrics, as returned by `evaluate_samples`, and
+            optionally the `n_iter`, `loss` and `time` of the search
+        """
+        self.rows_.append(
+            [
+                self.dataset_name,
+                fold_idx,
+                method_name,
+                acc,
+                ae_loss,
+                best_lr,
+                *evaluate_res,
+                pred_margin_weight,
+                step_weight_type,
+                threshold_tau,
+            ]
+        )
+        if self.samples_file_name is None or sample_res is None:
+            return
+
+        n_samples = len(sample_res["proximity"])
+        for i in range(n_samples):
+            self.sample_rows_.append(
                 [
                     self.dataset_name,
+                    fold_idx,
                     method_name,
-                    acc,
-                    ae_loss,
                     best_lr,
-                    proxi,
-                    valid,
-                    cost_mean,
-                    cost_std,
                     pred_margin_weight,
                     step_weight_type,
+                    threshold_tau,
+                    i,
+                    *(
+                        sample_res[k][i] if k in sample_res else np.nan
+                        for k in SAMPLE_COLUMNS[8:]
+                    ),
                 ]
             )
 
+    def flush(self):
+        """Write the buffered rows"""
+        if self.rows_:
+            _write_rows(self.file_name, RESULT_COLUMNS, self.rows_)
+            self.rows_ = []
+        if self.sample_rows_:
+            _write_rows(self.samples_file_name, SAMPLE_COLUMNS, self.sample_rows_)
+            self.sample_rows_ = []
+
+    def close(self):
+        self.flush()
+
+
+def _file_format(file_name):
+    ext = os.path.splitext(file_name)[1].lower()
+    if ext == ".parquet":
+        return "parquet"
+    if ext in (".arrow", ".feather"):
+        return "arrow"
+    return "csv"
+
+
+def result_file_name(file_name):
+    """The file written for `file_name`, a CSV file next to it for a columnar
+    format without pyarrow"""
+    if _file_format(file_name) == "csv":
+        return file_name
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        csv_file_name = os.path.splitext(file_name)[0] + ".csv"
+        warnings.warn(f"pyarrow is not installed, writing {csv_file_name} instead of {file_name}.")
+        return csv_file_name
+    return file_name
+
+
+def _write_rows(file_name, columns, rows, append=True):
+    """Append `rows` to `file_name` (or replace its content)
+
+    A CSV file is appended in place, and truncated back to its previous size
+    if the write raises. The append is not atomic, i.e. a crash of the process
+    during the write can leave a partial last row; only a new CSV file is
+    written to a temporary file and renamed into place. A columnar file is a directory of part files, one per
+    call, each written to a temporary file and renamed into place.
+    """
+    if _file_format(file_name) == "csv":
+        _write_csv_rows(file_name, columns, rows, append)
+    else:
+        _write_part(file_name, columns, rows, append)
+
+
+def _write_csv_rows(file_name, columns, rows, append):
+    if not (append and os.path.isfile(file_name) and os.path.getsize(file_name) > 0):
+        # a new file, written as a whole
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(file_name)), suffix=".csv"
+        )
+        try:
+            with os.fdopen(fd, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                writer.writerows(rows)
+            os.replace(tmp_path, file_name)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return
+
+    _check_columns(file_name, columns)
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    with open(file_name, "a", newline="") as f:
+        size = f.tell()
+        try:
+            f.write(buffer.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.truncate(size)
+            raise
+
+
+def _parts(dir_name):
+    """The part files of a columnar output, in the order they were written"""
+    if not os.path.isdir(dir_name):
+        return []
+    return sorted(
+        os.path.join(dir_name, name)
+        for name in os.listdir(dir_name)
+        if name.startswith("part-")
+    )
+
+
+def _write_part(dir_name, columns, rows, append):
+    if os.path.isfile(dir_name):
+        raise ValueError(
+            f"{dir_name} is a file, the columnar results are written as a directory "
+            "of part files; move it away or choose another output."
+        )
+    if not append:
+        for path in _parts(dir_name):
+            os.remove(path)
+    os.makedirs(dir_name, exist_ok=True)
+    parts = _parts(dir_name)
+    if parts:
+        _check_columns(dir_name, columns)
+    if not rows:
+        return
+
+    fmt, ext = _file_format(dir_name), os.path.splitext(dir_name)[1]
+    # the temporary file starts with a ".", i.e. it is ignored by readers of the directory
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix=".part-", suffix=ext)
+    os.close(fd)
+    try:
+        df = pd.DataFrame(rows, columns=columns)
+        if fmt == "parquet":
+            df.to_parquet(tmp_path, index=False)
+        else:
+            df.to_feather(tmp_path)
+        os.replace(tmp_path, os.path.join(dir_name, f"part-{len(parts):05d}{ext}"))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _read_columns(file_name):
+    """The column names of an existing output, None if it has no rows yet"""
+    fmt = _file_format(file_name)
+    if fmt == "csv":
+        with open(file_name, newline="") as f:
+            return next(csv.reader(f), None)
+    parts = _parts(file_name)
+    if not parts:
+        return None
+    if fmt == "parquet":
+        import pyarrow.parquet
+
+        return pyarrow.parquet.read_schema(parts[0]).names
+    import pyarrow.ipc
+
+    with pyarrow.ipc.open_file(parts[0]) as reader:
+        return reader.schema.names
+
+
+def _check_columns(file_name, columns):
+    existing = _read_columns(file_name)
+    if existing is not None and list(existing) != list(columns):
+        raise ValueError(
+            f"{file_name} has the columns {existing}, not {list(columns)}, "
+            "e.g. it was written by an earlier version; write to another output."
+        )
+
+
+def read_rows(file_name):
+    """Read an output of `ResultWriter` as a DataFrame"""
+    fmt = _file_format(file_name)
+    if fmt == "csv":
+        return pd.read_csv(file_name)
+    parts = _parts(file_name)
+    if not parts:
+        return pd.DataFrame()
+    if fmt == "parquet":
+        return pd.concat([pd.read_parquet(path) for path in parts], ignore_index=True)
+    return pd.concat([pd.read_feather(path) for path in parts], ignore_index=True)
+
+
+def merge_rows(file_names, file_name):
+    """Replace the content of `file_name` with the rows of the outputs `file_names`, in order"""
+    df = pd.concat(
+        [
+            # the CSV values as text, e.g. empty strings are not read as NaN
+            pd.read_csv(name, dtype=str, keep_default_na=False)
+            if _file_format(name) == "csv"
+            else read_rows(name)
+            for name in file_names
+        ],
+        ignore_index=True,
+    )
+    _write_rows(
+        file_name, list(df.columns), list(df.itertuples(index=False, name=None)), append=False
+    )
+
+
 """
 time series scaling
 """
@@ -221,17 +494,52 @@ def fit_evaluation_models(n_neighbors_lof, n_neighbors_nn, training_data):
     return lof_estimator, nn_model
 
 
-def evaluate(X_pred_neg, best_cf_samples, z_pred, n_timesteps, tree, maximum_distance=1):
-    proxi = euclidean_distance(X_pred_neg, best_cf_samples)
-    valid = validity_score(z_pred)
-    # compact = compactness_score(X_pred_neg, best_cf_samples, n_timesteps=n_timesteps)
-    cost_mean, cost_std = cost_score(z_pred)
-    
-    # neigh_count = neighbour_counts_within_radius(best_cf_samples.reshape(-1, n_timesteps), tree, radius=0.3*maximum_distance)
-    # dist_knn = distance_knn(best_cf_samples.reshape(-1, n_timesteps), tree) 
+def evaluate(
+    X_pred_neg,
+    cf_samples,
+    pred_labels,
+    z_pred,
+    lof_estimator_pos,
+    lof_estimator_neg,
+    nn_estimator_pos,
+    nn_estimator_neg,
+    decision_prob=0.5,
+):
+    """Aggregate metrics of the counterfactuals, in the column order of `ResultWriter`
+
+    z_pred : array-like of shape [n_samples, n_classes]
+        The predicted probabilities of the counterfactuals
+    """
+    sample_res = evaluate_samples(X_pred_neg, cf_samples, pred_labels, z_pred, decision_prob)
+    margin_mean, margin_std = np.mean(sample_res["margin"]), np.std(sample_res["margin"])
+    lof_score = calculate_lof(cf_samples, pred_labels, lof_estimator_pos, lof_estimator_neg)
+    rp_score = relative_proximity(
+        X_pred_neg, cf_samples, pred_labels, nn_estimator_pos, nn_estimator_neg
+    )
+    return (
+        np.mean(sample_res["proximity"]),
+        np.mean(sample_res["validity"]),
+        margin_mean,
+        margin_std,
+        lof_score,
+        rp_score,
+    )
 
-    # return proxi, valid, compact, cost_mean, cost_std, neigh_count, dist_knn     # exclude unused metrics in the final evaluation
-    return proxi, valid, cost_mean, 
+
+def evaluate_samples(X_pred_neg, cf_samples, pred_labels, z_pred, decision_prob=0.5):
+    """Per-sample metrics of the counterfactuals, returns a dict of arrays
+
+    The margin is the predicted probability of the desired label minus
+    `decision_prob`, i.e. a counterfactual is valid if its margin is positive.
+    """
+    desired_labels = 1 - np.asarray(pred_labels)  # for binary classification
+    cf_probs = np.asarray(z_pred)[np.arange(len(desired_labels)), desired_labels]
+    return dict(
+        pred_label=np.asarray(pred_labels),
+        proximity=euclidean_distance(X_pred_neg, cf_samples, average=False),
+        validity=cf_probs >= decision_prob,
+        margin=cf_probs - decision_prob,
+    )
 
 def evaluate2(X_pred_neg, best_cf_samples, z_pred, n_timesteps, maximum_distance=1):
     proxi = euclidean_distance(X_pred_neg, best_cf_samples)
@@ -403,10 +711,70 @@ def find_best_lr(
     random_state=None,
     padding_size=0,
     target_prob=0.5,
+    batched=False,
+    batch_size=None,
+    step_weights_cache=None,
+    local_weights_executor=None,
+    prefetch=0,
+    plateau_tol=None,
+    refine_iter=None,
+    max_total_iter=None,
+    warm_start=None,
+    nun_index=None,
+    mp_percentage=None,
+    compile_search=False,
+    jit_compile=False,
+    return_stats=False,
 ):
+    """Find the best learning rate of the CF search, one search per learning rate
+
+    Returns `(best_lr, best_cf_model, best_cf_samples, best_cf_embeddings)`,
+    followed by a dict of the per-sample `loss`, `n_iter` and search `time`
+    of the best learning rate, and the `step_weights`, if `return_stats`.
+
+    `compile_search` and `jit_compile` are those of `ModifiedLatentCF`, i.e.
+    of the search of one sample at a time.
+    """
+    if batched:
+        if encoder is not None or decoder is not None:
+            raise ValueError(
+                "batched=True searches in the latent space of `autoencoder`, "
+                "a separate encoder and decoder are not supported."
+            )
+        if compile_search:
+            raise ValueError(
+                "batched=True searches all learning rates jointly, compile_search "
+                "only compiles the search of one sample at a time."
+            )
+        # one vectorised search over all learning rates, instead of one pass per lr
+        best_results = find_best_lr_batched(
+            classifier,
+            X_samples,
+            pred_labels,
+            autoencoder=autoencoder,
+            lr_list=lr_list,
+            pred_margin_weight_list=[pred_margin_weight],
+            target_prob_list=[target_prob],
+            step_weights=step_weights,
+            random_state=random_state,
+            padding_size=padding_size,
+            batch_size=batch_size,
+            step_weights_cache=step_weights_cache,
+            local_weights_executor=local_weights_executor,
+            prefetch=prefetch,
+            plateau_tol=plateau_tol,
+            refine_iter=refine_iter,
+            max_total_iter=max_total_iter,
+            warm_start=warm_start,
+            nun_index=nun_index,
+            mp_percentage=mp_percentage,
+        )
+        best_result = best_results[(pred_margin_weight, target_prob)]
+        return best_result if return_stats else best_result[:4]
+
     # Find the best alpha for vanilla LatentCF
     best_cf_model, best_cf_samples, best_cf_embeddings = None, None, None
-    best_losses, best_valid_frac, best_lr = 0, -1, 0
+    best_stats, best_valid_frac, best_lr = None, -1, 0
 
     for lr in lr_list:
         print(f"======================== CF search started, with lr={lr}.")
@@ -421,6 +789,18 @@ def find_best_lr(
                 pred_margin_weight=pred_margin_weight,
                 step_weights=step_weights,
                 random_state=random_state,
+                batch_size=batch_size,
+                step_weights_cache=step_weights_cache,
+                local_weights_executor=local_weights_executor,
+                prefetch=prefetch,
+                plateau_tol=plateau_tol,
+                refine_iter=refine_iter,
+                max_total_iter=max_total_iter,
+                warm_start=warm_start,
+                nun_index=nun_index,
+                mp_percentage=mp_percentage,
+                compile_search=compile_search,
+                jit_compile=jit_compile,
             )
         else:
             cf_model = ModifiedLatentCF(
@@ -430,18 +810,32 @@ def find_best_lr(
                 pred_margin_weight=pred_margin_weight,
                 step_weights=step_weights,
                 random_state=random_state,
+                batch_size=batch_size,
+                step_weights_cache=step_weights_cache,
+                local_weights_executor=local_weights_executor,
+                prefetch=prefetch,
+                plateau_tol=plateau_tol,
+                refine_iter=refine_iter,
+                max_total_iter=max_total_iter,
+                warm_start=warm_start,
+                nun_index=nun_index,
+                mp_percentage=mp_percentage,
+                compile_search=compile_search,
+                jit_compile=jit_compile,
             )
 
         cf_model.fit(classifier)
 
         if encoder and decoder:
-            cf_embeddings, losses, _ = cf_model.transform(X_samples, pred_labels)
+            with get_profiler().phase("cf_search"):
+                cf_embeddings, losses, weights_all = cf_model.transform(X_samples, pred_labels)
             cf_samples = decoder.predict(cf_embeddings)
             # predicted probabilities of CFs
             z_pred = classifier.predict(cf_embeddings)
             cf_pred_labels = np.argmax(z_pred, axis=1)
         else:
-            cf_samples, losses, _ = cf_model.transform(X_samples, pred_labels)
+            with get_profiler().phase("cf_search"):
+                cf_samples, losses, weights_all = cf_model.transform(X_samples, pred_labels)
             # predicted probabilities of CFs
             z_pred = classifier.predict(cf_samples)
             cf_pred_labels = np.argmax(z_pred, axis=1)
@@ -469,8 +863,140 @@ def find_best_lr(
         # if valid_frac >= best_valid_frac and proxi_score <= best_proxi_score:
         if valid_frac >= best_valid_frac:
             best_cf_model, best_cf_samples = cf_model, cf_samples
-            best_losses, best_lr, best_valid_frac = losses, lr, valid_frac
+            best_lr, best_valid_frac = lr, valid_frac
+            best_stats = dict(
+                loss=losses,
+                n_iter=cf_model.n_iter_,
+                time=cf_model.search_time_,
+                step_weights=weights_all,
+            )
             if encoder and decoder:
                 best_cf_embeddings = cf_embeddings
 
+    if return_stats:
+        return best_lr, best_cf_model, best_cf_samples, best_cf_embeddings, best_stats
     return best_lr, best_cf_model, best_cf_samples, best_cf_embeddings,
+
+
+def find_best_lr_batched(
+    classifier,
+    X_samples,
+    pred_labels,
+    autoencoder=None,
+    lr_list=[0.001, 0.0001],
+    pred_margin_weight_list=[1.0],
+    target_prob_list=[0.5],
+    step_weights=None,
+    random_state=None,
+    padding_size=0,
+    batch_size=None,
+    step_weights_cache=None,
+    local_weights_executor=None,
+    prefetch=0,
+    plateau_tol=None,
+    refine_iter=None,
+    max_total_iter=None,
+    warm_start=None,
+    nun_index=None,
+    mp_percentage=None,
+):
+    """Find the best learning rate for every (pred_margin_weight, target_prob) pair
+
+    All combinations of `lr_list`, `pred_margin_weight_list` and
+    `target_prob_list` are searched in one vectorised CF search. The best
+    learning rate per pair follows the rule of `find_best_lr`.
+
+    Returns a dict keyed by `(pred_margin_weight, target_prob)`, with values
+    `(best_lr, best_cf_model, best_cf_samples, best_cf_embeddings)` as
+    returned by `find_best_lr`, followed by a dict of the per-sample `loss`,
+    `n_iter` and search `time` of the best learning rate, and the `step_weights`.
+    The `best_cf_model` is configured with the best learning rate and the
+    pair, its `n_iter_` and `search_time_` those of its search.
+    """
+    configs = list(itertools.product(lr_list, pred_margin_weight_list, target_prob_list))
+    print(f"======================== CF search started, with {len(configs)} configs.")
+
+    # the optimizer steps are scaled to the learning rate of each config
+    cf_model = ModifiedLatentCF(
+        autoencoder=autoencoder,
+        optimizer=tf.keras.optimizers.legacy.Adam(learning_rate=1.0),
+        step_weights=step_weights,
+        random_state=random_state,
+        batch_size=batch_size,
+        step_weights_cache=step_weights_cache,
+        local_weights_executor=local_weights_executor,
+        prefetch=prefetch,
+        plateau_tol=plateau_tol,
+        refine_iter=refine_iter,
+        max_total_iter=max_total_iter,
+        warm_start=warm_start,
+        nun_index=nun_index,
+        mp_percentage=mp_percentage,
+    )
+    cf_model.fit(classifier)
+    with get_profiler().phase("cf_search"):
+        cf_samples_all, losses_all, weights_all = cf_model.transform_grid(
+            X_samples, pred_labels, configs
+        )
+    if cf_model._has_convergence_policy():
+        print(f"Iterations saved by the convergence policies: {cf_model.n_iter_saved_}.")
+
+    # predicted probabilities of CFs, for all configs in one call
+    z_pred_all = classifier.predict(
+        cf_samples_all.reshape((-1,) + X_samples.shape[1:])
+    ).reshape(len(configs), X_samples.shape[0], -1)
+
+    best_configs, best_valid_fracs = {}, {}
+    for config_idx, ((lr, pred_margin_weight, target_prob), cf_samples, z_pred) in enumerate(
+        zip(configs, cf_samples_all, z_pred_all)
+    ):
+        cf_pred_labels = np.argmax(z_pred, axis=1)
+        valid_frac = validity_score(cf_pred_labels)
+        proxi_score = euclidean_distance(
+            remove_paddings(X_samples, padding_size),
+            remove_paddings(cf_samples, padding_size),
+        )
+        print(
+            f"lr={lr}, pred_margin_weight={pred_margin_weight}, target_prob={target_prob} finished. "
+            f"Validity: {valid_frac}, proximity: {proxi_score}."
+        )
+
+        key = (pred_margin_weight, target_prob)
+        if valid_frac >= best_valid_fracs.get(key, -1):
+            best_configs[key] = config_idx
+            best_valid_fracs[key] = valid_frac
+
+    best_results = {}
+    for key, config_idx in best_configs.items():
+        lr, pred_margin_weight, target_prob = configs[config_idx]
+        # the model of the best config, as `find_best_lr` returns it; `cf_model`
+        # searched all configs with its own learning rate, margin weight and tau
+        best_cf_model = ModifiedLatentCF(
+            probability=target_prob,
+            autoencoder=autoencoder,
+            optimizer=tf.keras.optimizers.legacy.Adam(learning_rate=lr),
+            pred_margin_weight=pred_margin_weight,
+            step_weights=step_weights,
+            random_state=random_state,
+            batch_size=batch_size,
+            step_weights_cache=step_weights_cache,
+            local_weights_executor=local_weights_executor,
+            prefetch=prefetch,
+            plateau_tol=plateau_tol,
+            refine_iter=refine_iter,
+            max_total_iter=max_total_iter,
+            warm_start=warm_start,
+            nun_index=cf_model.nun_index_,
+            mp_percentage=mp_percentage,
+        ).fit(classifier)
+        best_cf_model.n_iter_ = cf_model.n_iter_[config_idx]
+        best_cf_model.search_time_ = cf_model.search_time_[config_idx]
+        sample_stats = dict(
+            loss=losses_all[config_idx],
+            n_iter=best_cf_model.n_iter_,
+            time=best_cf_model.search_time_,
+            step_weights=weights_all,
+        )
+        best_results[key] = (lr, best_cf_model, cf_samples_all[config_idx], None, sample_stats)
+
+    return best_results
@@ -0,0 +1,170 @@
+"""Per-phase timing and counters of the CF pipeline
+
+The instrumented code reports to the profiler of the process, returned by
+`get_profiler()`. By default this is a `NullProfiler`, whose methods do
+nothing, so that the instrumentation costs a function call when disabled:
+
+    profiler = Profiler()
+    previous = set_profiler(profiler)
+    try:
+        with get_profiler().phase("cf_search"):
+            ...
+        get_profiler().count("classifier_calls")
+    finally:
+        set_profiler(previous)
+    profiler.save("profile.json")
+
+Phases are flat names, which may overlap: e.g. "cf_search" includes the
+"step_weights" and "gradient_search" of the samples, and "step_weights"
+computed in a prefetch thread run concurrently with "gradient_search".
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+
+class NullProfiler:
+    """The profiler when profiling is disabled, records nothing"""
+
+    enabled = False
+    _phase = nullcontext()
+
+    def phase(self, name):
+        return self._phase
+
+    def count(self, name, n=1):
+        pass
+
+    def observe(self, name, values):
+        pass
+
+
+class Profiler:
+    """Wall and CPU time per phase, counters and distributions of per-sample values
+
+    The CPU time is `time.process_time`, i.e. of all threads of the process,
+    including the thread pools of TensorFlow.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+        self.distributions = {}
+        self.start_time_ = time.perf_counter()
+        # the step weights may be computed in a prefetch thread
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            with self._lock:
+                calls, total_wall, total_cpu = self.phases.get(name, (0, 0.0, 0.0))
+                self.phases[name] = (calls + 1, total_wall + wall, total_cpu + cpu)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def observe(self, name, values):
+        """Record per-sample values, e.g. the gradient steps of every sample"""
+        values = np.asarray(values, dtype=float).ravel().tolist()
+        with self._lock:
+            self.distributions.setdefault(name, []).extend(values)
+
+    def state(self):
+        """The records, picklable, to `merge` them into the profiler of another process"""
+        with self._lock:
+            return dict(
+                phases=dict(self.phases),
+                counters=dict(self.counters),
+                distributions={name: list(v) for name, v in self.distributions.items()},
+            )
+
+    def merge(self, state):
+        with self._lock:
+            for name, (calls, wall, cpu) in state["phases"].items():
+                total_calls, total_wall, total_cpu = self.phases.get(name, (0, 0.0, 0.0))
+                self.phases[name] = (total_calls + calls, total_wall + wall, total_cpu + cpu)
+            for name, n in state["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, values in state["distributions"].items():
+                self.distributions.setdefault(name, []).extend(values)
+
+    def summary(self, **metadata):
+        """The records as a JSON-serialisable dict
+
+        Counters named `cache.<name>.hits` and `cache.<name>.misses` also give
+        the hit rate of the cache `<name>`.
+        """
+        state = self.state()
+        caches = {}
+        for name, n in state["counters"].items():
+            if name.startswith("cache.") and name.endswith((".hits", ".misses")):
+                cache, kind = name[len("cache.") :].rsplit(".", 1)
+                caches.setdefault(cache, dict(hits=0, misses=0))[kind] = n
+        for stats in caches.values():
+            total = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / total if total else 0.0
+
+        distributions = {}
+        for name, values in state["distributions"].items():
+            values = np.asarray(values)
+            distributions[name] = dict(
+                count=int(values.size),
+                total=float(values.sum()),
+                mean=float(values.mean()) if values.size else 0.0,
+                p50=float(np.percentile(values, 50)) if values.size else 0.0,
+                p95=float(np.percentile(values, 95)) if values.size else 0.0,
+                max=float(values.max()) if values.size else 0.0,
+            )
+
+        return dict(
+            run=metadata,
+            wall_time=time.perf_counter() - self.start_time_,
+            phases={
+                name: dict(calls=calls, wall_time=wall, cpu_time=cpu)
+                for name, (calls, wall, cpu) in sorted(
+                    state["phases"].items(), key=lambda item: -item[1][1]
+                )
+            },
+            counters=dict(sorted(state["counters"].items())),
+            caches=caches,
+            distributions=distributions,
+        )
+
+    def save(self, path, **metadata):
+        """Write the `summary` to a JSON file"""
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # write to a temporary file first, so that a killed run leaves no partial file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.summary(**metadata), f, indent=2)
+        os.replace(tmp_path, path)
+
+
+_profiler = NullProfiler()
+
+
+def get_profiler():
+    return _profiler
+
+
+def set_profiler(profiler):
+    """Install the profiler of the process, None to disable profiling; returns the previous one"""
+    global _profiler
+    previous = _profiler
+    _profiler = NullProfiler() if profiler is None else profiler
+    return previous
@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Resumable runner of the experiments, replaces `run_all_datasets.sh` and `run_cf_baseline.sh`
+
+The experiments are declared in a JSON spec, e.g.
+
+    {
+        "experiments": [
+            {
+                "script": "gc_latentcf_search",
+                "cpus": 1,
+                "params": {"n-lstmcells": 8, "w-value": 0.5, "tau-value": 0.5},
+                "grid": {"w-type": ["local", "global", "uniform"]},
+                "runs": [
+                    {"dataset": "TwoLeadECG", "pos": 1, "neg": 2, "output": "twoleadecg-outfile.csv"},
+                    {"dataset": "Wafer", "pos": 1, "neg": -1, "output": "wafer-outfile.csv"}
+                ]
+            }
+        ]
+    }
+
+i.e. one job per run and combination of the grid, with the arguments of the
+script's `main()`. The jobs are kept in a SQLite table, so that an interrupted
+or crashed invocation resumes where it stopped: jobs that are done (and whose
+output exists) are skipped, failed jobs are retried.
+
+Every job writes its `output` (and `samples-output`) to a file of its own,
+`<output>.jobs/<job id><ext>`, which a rerun of the job replaces. Once all jobs
+of an output are done, their rows are merged into it, in the order of the spec.
+So the jobs sharing an output, e.g. the ones of the shell scripts, never
+duplicate rows when retried.
+
+A spec of the existing shell scripts is written by
+
+    python src/run_experiments.py --convert run_all_datasets.sh run_cf_baseline.sh > experiments.json
+"""
+import importlib
+import itertools
+import json
+import hashlib
+import logging
+import os
+import shlex
+import shutil
+import sqlite3
+import time
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+
+from executors import _limit_tf_threads, make_worker_pool
+from help_functions import merge_rows, result_file_name
+
+logger = logging.getLogger(__name__)
+
+SCRIPTS = ["gc_latentcf_search", "generate_cfs_baseline"]
+# the arguments of the output files of the scripts
+OUTPUTS = ["output", "samples-output"]
+
+
+def parse_args(args=None):
+    parser = ArgumentParser(description="Run the experiments of a JSON spec, resumable and in parallel.")
+    parser.add_argument("spec", type=str, nargs="?", help="The JSON spec of the experiments.")
+    parser.add_argument(
+        "--db",
+        type=str,
+        default="experiments.sqlite",
+        help="The SQLite file of the job table, default to experiments.sqlite.",
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=os.cpu_count(),
+        help="The CPU budget shared by the running jobs, default to all CPUs.",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=1,
+        help="Number of TensorFlow threads per CPU of a job, i.e. a job of `cpus` CPUs runs with "
+        "`cpus` times as many threads, default to 1.",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=1,
+        help="Number of times a failed job is retried, default to 1.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rerun the jobs that are done.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="List the jobs to run without running them.",
+    )
+    parser.add_argument(
+        "--convert",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Print the spec of the commands of these shell scripts and exit.",
+    )
+    A = parser.parse_args(args)
+    if A.spec is None and A.convert is None:
+        parser.error("either a spec or --convert is required")
+    return A
+
+
+def to_argv(args):
+    """Command line arguments of a dict, lists give several values and booleans flags"""
+    argv = []
+    for name, value in args.items():
+        if value is None or value is False:
+            continue
+        argv.append(f"--{name}")
+        if value is True:
+            continue
+        values = value if isinstance(value, list) else [value]
+        argv.extend(str(v) for v in values)
+    return argv
+
+
+def expand_spec(spec):
+    """The jobs of a spec, one per run and combination of the grid"""
+    jobs = []
+    for experiment in spec["experiments"]:
+        script = experiment["script"]
+        if script not in SCRIPTS:
+            raise ValueError(f"Unknown script '{script}', choose one of {SCRIPTS}.")
+        grid = experiment.get("grid", {})
+        for run in experiment.get("runs", [{}]):
+            for values in itertools.product(*grid.values()):
+                args = {**experiment.get("params", {}), **run, **dict(zip(grid, values))}
+                argv = to_argv(args)
+                job_id = hashlib.sha1(json.dumps([script, argv]).encode()).hexdigest()
+                # the job writes files of its own, merged into the outputs by `merge_outputs`
+                job_files = {
+                    name: _job_file_name(args[name], job_id)
+                    for name in OUTPUTS
+                    if args.get(name) is not None
+                }
+                jobs.append(
+                    SimpleNamespace(
+                        id=job_id,
+                        script=script,
+                        argv=argv,
+                        run_argv=to_argv({**args, **job_files}),
+                        output=args.get("output"),
+                        outputs={args[name]: job_file for name, job_file in job_files.items()},
+                        cpus=experiment.get("cpus", 1),
+                        isolated=False,
+                    )
+                )
+    return jobs
+
+
+def _job_file_name(file_name, job_id):
+    return os.path.join(f"{file_name}.jobs", job_id[:16] + os.path.splitext(file_name)[1])
+
+
+def _reset_job_files(job):
+    # a rerun replaces the rows of the earlier attempts of the job
+    for job_file in job.outputs.values():
+        os.makedirs(os.path.dirname(job_file), exist_ok=True)
+        path = result_file_name(job_file)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def merge_outputs(table, jobs):
+    """Merge the files of the jobs into their outputs, once all jobs of an output are done"""
+    job_files = {}
+    for job in jobs:
+        for output, job_file in job.outputs.items():
+            job_files.setdefault(output, []).append((job, job_file))
+
+    for output, files in job_files.items():
+        n_pending = sum(table.status(job) != "done" for job, _ in files)
+        if n_pending:
+            logger.warning(f"{output} not merged, {n_pending} of its {len(files)} jobs are not done.")
+            continue
+        merge_rows([result_file_name(job_file) for _, job_file in files], result_file_name(output))
+        logger.info(f"The rows of {len(files)} jobs merged into {output}.")
+
+
+def convert_scripts(paths):
+    """Spec of the (uncommented) `python src/<script>.py ...` commands of shell scripts"""
+    experiments = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip().rstrip(";").strip()
+                if not line.startswith("python "):
+                    continue
+                tokens = shlex.split(line)
+                script = os.path.splitext(os.path.basename(tokens[1]))[0]
+                run, name = {}, None
+                for token in tokens[2:]:
+                    if token.startswith("--"):
+                        name = token[2:]
+                        run[name] = True
+                    elif run[name] is True:
+                        run[name] = _parse_value(token)
+                    elif isinstance(run[name], list):
+                        run[name].append(_parse_value(token))
+                    else:
+                        run[name] = [run[name], _parse_value(token)]
+                experiments.setdefault(script, []).append(run)
+    return dict(
+        experiments=[
+            dict(script=script, cpus=1, runs=runs) for script, runs in experiments.items()
+        ]
+    )
+
+
+def _parse_value(token):
+    for parse in (int, float):
+        try:
+            return parse(token)
+        except ValueError:
+            pass
+    return token
+
+
+class JobTable:
+    """The state of the jobs, in a SQLite table only accessed by the main process"""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                script TEXT,
+                argv TEXT,
+                output TEXT,
+                status TEXT,
+                attempts INTEGER,
+                error TEXT,
+                started REAL,
+                finished REAL
+            )"""
+        )
+        # jobs left running by a crashed or interrupted invocation
+        self.connection.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+        self.connection.commit()
+
+    def add(self, job):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO jobs (id, script, argv, output, status, attempts) VALUES (?, ?, ?, ?, 'pending', 0)",
+            (job.id, job.script, json.dumps(job.argv), job.output),
+        )
+        self.connection.commit()
+
+    def status(self, job):
+        return self.connection.execute(
+            "SELECT status FROM jobs WHERE id = ?", (job.id,)
+        ).fetchone()[0]
+
+    def update(self, job, **columns):
+        assignments = ", ".join(f"{name} = ?" for name in columns)
+        self.connection.execute(
+            f"UPDATE jobs SET {assignments} WHERE id = ?", (*columns.values(), job.id)
+        )
+        self.connection.commit()
+
+    def start(self, job):
+        self.connection.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, started = ? WHERE id = ?",
+            (time.time(), job.id),
+        )
+        self.connection.commit()
+
+    def attempts(self, job):
+        return self.connection.execute(
+            "SELECT attempts FROM jobs WHERE id = ?", (job.id,)
+        ).fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+def _run_job(script, argv, n_threads):
+    # every job runs in a new worker process (see `_make_executor`), as the
+    # TensorFlow threads can only be set before the runtime is initialized
+    _limit_tf_threads(n_threads)
+    main = importlib.import_module(script).main
+    try:
+        main(argv)
+    finally:
+        from tensorflow import keras
+
+        keras.backend.clear_session()
+
+
+def _make_executor(A):
+    # the threads are set per job by `_run_job`
+    return make_worker_pool(A.cpus, max_tasks_per_child=1)
+
+
+def run_jobs(A, table, jobs):
+    """Run the jobs within the CPU budget, returns the number of failed jobs
+
+    A job runs when its CPUs fit in the budget (a job larger than the budget runs
+    alone).
+
+    A worker killed e.g. by running out of memory breaks the whole pool, failing
+    all running jobs. These are rerun one at a time, so that only the job that
+    crashes on its own is charged a retry.
+    """
+    pending = deque(jobs)
+    running = {}
+    used_cpus = 0
+    n_failed = 0
+    executor, broken = _make_executor(A), False
+
+    while pending or running:
+        for job in list(pending):
+            if broken or any(other.isolated for other in running.values()):
+                break
+            if job.isolated and running:
+                continue
+            cpus = min(job.cpus, A.cpus)
+            if running and used_cpus + cpus > A.cpus:
+                continue
+            pending.remove(job)
+            table.start(job)
+            _reset_job_files(job)
+            logger.info(f"Starting {job.script} {' '.join(job.argv)}.")
+            running[
+                executor.submit(_run_job, job.script, job.run_argv, cpus * A.threads_per_worker)
+            ] = job
+            used_cpus += cpus
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            job = running.pop(future)
+            used_cpus -= min(job.cpus, A.cpus)
+            exc = future.exception()
+            if exc is None:
+                table.update(job, status="done", error=None, finished=time.time())
+                logger.info(f"Done: {job.script} {' '.join(job.argv)}.")
+                continue
+
+            if isinstance(exc, BrokenProcessPool):
+                broken = True
+                if not job.isolated:
+                    # not known to be the job that crashed, rerun it alone without charging a retry
+                    job.isolated = True
+                    table.update(job, status="pending", attempts=table.attempts(job) - 1)
+                    pending.appendleft(job)
+                    continue
+            if table.attempts(job) <= A.retries:
+                table.update(job, status="pending", error=repr(exc))
+                pending.append(job)
+                logger.warning(f"Failed, retrying: {job.script} {' '.join(job.argv)}: {exc!r}.")
+            else:
+                table.update(job, status="failed", error=repr(exc), finished=time.time())
+                n_failed += 1
+                logger.error(f"Failed: {job.script} {' '.join(job.argv)}: {exc!r}.")
+
+        if broken and not running:
+            executor.shutdown(wait=False)
+            executor, broken = _make_executor(A), False
+
+    executor.shutdown(wait=True)
+    return n_failed
+
+
+def main(args=None):
+    A = parse_args(args)
+
+    if A.convert is not None:
+        print(json.dumps(convert_scripts(A.convert), indent=2))
+        return
+
+    with open(A.spec) as f:
+        jobs = expand_spec(json.load(f))
+
+    table = JobTable(A.db)
+    to_run = []
+    for job in jobs:
+        table.add(job)
+        if A.force or table.status(job) != "done":
+            to_run.append(job)
+        elif any(
+            not os.path.exists(result_file_name(job_file)) for job_file in job.outputs.values()
+        ):
+            logger.info(f"Output of {job.script} {' '.join(job.argv)} missing, rerunning.")
+            to_run.append(job)
+    logger.info(f"{len(jobs)} jobs, {len(jobs) - len(to_run)} already done, {len(to_run)} to run.")
+
+    if A.dry_run:
+        for job in to_run:
+            print(job.script, " ".join(job.argv))
+        table.close()
+        return
+
+    for job in to_run:
+        # failed jobs of earlier invocations get a fresh set of retries
+        table.update(job, status="pending", attempts=0)
+
+    n_failed = run_jobs(A, table, to_run)
+    merge_outputs(table, jobs)
+    table.close()
+    logger.info(f"Done, {n_failed} failed jobs.")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    main()
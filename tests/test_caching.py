@@ -0,0 +1,123 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from caching import CFArtifactStore, DatasetStore, StepWeightCache  # noqa: E402
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+@pytest.mark.parametrize("n_changed", [5, 100])
+def test_artifact_round_trip_is_exact(tmp_path, dtype, n_changed):
+    rng = np.random.RandomState(0)
+    X = (1e3 * rng.randn(4, 25, 4)).astype(dtype)
+    cf_samples = X.copy()
+    # few changed timesteps are stored as CSR, many as is
+    changed = rng.rand(*X.shape) < n_changed / 100
+    cf_samples[changed] = (1e-3 * rng.randn(changed.sum())).astype(dtype)
+
+    store = CFArtifactStore(str(tmp_path))
+    store.save("run", X, cf_samples, sample_idx=np.arange(4), losses=np.ones(4))
+    arrays = store.load("run", X=X.astype(np.float64))
+
+    assert arrays["cf_samples"].dtype == dtype
+    np.testing.assert_array_equal(arrays["cf_samples"], cf_samples)
+    np.testing.assert_array_equal(arrays["sample_idx"], np.arange(4))
+    if "changed" in arrays:
+        np.testing.assert_array_equal(arrays["changed"], changed)
+
+
+def test_artifact_atol(tmp_path):
+    rng = np.random.RandomState(0)
+    X = rng.randn(3, 20, 1)
+    cf_samples = X + 1e-6 * rng.randn(*X.shape)
+    cf_samples[:, 5] += 1.0
+
+    store = CFArtifactStore(str(tmp_path), atol=1e-3)
+    store.save("run", X, cf_samples, sample_idx=np.arange(3))
+    arrays = store.load("run", X=X)
+
+    np.testing.assert_allclose(arrays["cf_samples"], cf_samples, atol=1e-3)
+    np.testing.assert_array_equal(arrays["cf_samples"][:, 5], cf_samples[:, 5])
+    assert arrays["changed"].sum() == 3
+
+
+def test_artifact_replace(tmp_path):
+    rng = np.random.RandomState(0)
+    X = rng.randn(3, 20, 1)
+    store = CFArtifactStore(str(tmp_path))
+    # few changes are stored as CSR, then replaced by a run stored as is
+    sparse_cf = X.copy()
+    sparse_cf[:, 0] += 1.0
+    store.save("run", X, sparse_cf, sample_idx=np.arange(3), metadata=dict(attempt=1))
+    dense_cf = X + 1.0
+    store.save("run", X, dense_cf, sample_idx=np.arange(3), metadata=dict(attempt=2))
+
+    assert sorted(os.listdir(tmp_path / "run")) == ["cf_samples.npy", "meta.json", "sample_idx.npy"]
+    assert os.listdir(tmp_path) == ["run"]
+    assert store.runs() == ["run"]
+    arrays = store.load("run", X=X)
+    assert arrays["metadata"] == dict(attempt=2)
+    np.testing.assert_array_equal(arrays["cf_samples"], dense_cf)
+
+
+def test_step_weights_read_back_memory_mapped(tmp_path):
+    weights = np.random.RandomState(0).rand(1, 20, 1)
+    StepWeightCache(str(tmp_path)).put("key", weights)
+
+    cache = StepWeightCache(str(tmp_path))
+    cached = cache.get("key")
+    assert isinstance(cached, np.memmap)
+    assert not cached.flags.writeable
+    np.testing.assert_array_equal(cached, weights)
+    assert cache.get("key") is cached
+    assert (cache.hits, cache.misses) == (2, 0)
+
+
+def test_fold_arrays_memory_mapped(tmp_path):
+    rng = np.random.RandomState(0)
+    fold = dict(X_train=rng.randn(8, 20, 1).astype(np.float32), y_train=np.arange(8))
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return fold
+
+    store = DatasetStore(str(tmp_path))
+    spec = dict(dataset="TwoLeadECG", fold=0, seed=39)
+    for _ in range(2):
+        arrays = store.fold_arrays(spec, compute)
+        assert len(calls) == 1
+        assert isinstance(arrays["X_train"], np.memmap) and not arrays["X_train"].flags.writeable
+        for k, arr in fold.items():
+            np.testing.assert_array_equal(arrays[k], arr)
+            assert arrays[k].dtype == arr.dtype
+
+    # another spec, e.g. fold, is another entry
+    store.fold_arrays(dict(spec, fold=1), compute)
+    assert len(calls) == 2
+    # without a directory nothing is stored
+    assert DatasetStore().fold_arrays(spec, compute) is fold
+    assert len(calls) == 3
+
+
+def test_dataset_downloaded_once(tmp_path, monkeypatch):
+    import wildboar.datasets
+
+    X, y = np.random.RandomState(0).randn(6, 20), np.array(["1", "2"] * 3)
+    downloads = []
+
+    def load_dataset(name, repository):
+        downloads.append((name, repository))
+        return X, y
+
+    monkeypatch.setattr(wildboar.datasets, "load_dataset", load_dataset)
+    store = DatasetStore(str(tmp_path))
+    for _ in range(2):
+        X_stored, y_stored = store.load_dataset("TwoLeadECG")
+        np.testing.assert_array_equal(X_stored, X)
+        np.testing.assert_array_equal(y_stored, y)
+    assert downloads == [("TwoLeadECG", "wildboar/ucr")]
@@ -0,0 +1,105 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from _guided import ModifiedLatentCF, _ConvergenceTracker  # noqa: E402
+from help_functions import reset_seeds  # noqa: E402
+from keras_models import Autoencoder, Classifier_FCN  # noqa: E402
+
+
+def tracker(n_samples, plateau_tol=None, refine_iter=None, max_total_iter=None):
+    cf_model = SimpleNamespace(
+        plateau_tol=plateau_tol,
+        plateau_patience=2,
+        refine_iter=refine_iter,
+        max_total_iter=max_total_iter,
+        max_iter=100,
+    )
+    return _ConvergenceTracker(cf_model, n_samples, dict(plateau=0, refine=0, budget=0))
+
+
+def test_plateau_stops_flat_losses():
+    t = tracker(2, plateau_tol=0.01)
+    active, valid = np.ones(2, dtype=bool), np.zeros(2, dtype=bool)
+    # the first sample keeps improving, the second is flat
+    for it, losses in enumerate([[8.0, 1.0], [4.0, 1.0], [2.0, 1.0]]):
+        stop, restore = t.check(it, np.array(losses), valid, active)
+    np.testing.assert_array_equal(stop, [False, True])
+    assert not restore.any()
+    assert t.n_iter_saved == dict(plateau=98, refine=0, budget=0)
+
+
+def test_refine_stops_and_restores():
+    t = tracker(3, refine_iter=2)
+    active, losses = np.ones(3, dtype=bool), np.ones(3)
+    # valid from iteration 0; from iteration 1 then invalid again; never valid
+    stop, _ = t.check(0, losses, np.array([True, False, False]), active)
+    assert not stop.any()
+    stop, _ = t.check(1, losses, np.array([True, True, False]), active)
+    assert not stop.any()
+    stop, restore = t.check(2, losses, np.array([True, False, False]), active)
+    np.testing.assert_array_equal(stop, [True, True, False])
+    np.testing.assert_array_equal(restore, [False, True, False])
+    assert t.n_iter_saved["refine"] == 2 * 98
+
+
+def test_budget_is_shared_across_blocks():
+    t = tracker(2, max_total_iter=5)
+    active, valid, losses = np.ones(2, dtype=bool), np.zeros(2, dtype=bool), np.ones(2)
+    for it in range(2):
+        stop, _ = t.check(it, losses, valid, active)
+        assert not stop.any()
+    assert t.budget == 1
+    # a new block keeps the remaining budget, one more update of one sample
+    t.reset(1)
+    stop, _ = t.check(0, losses[:1], valid[:1], active[:1])
+    assert not stop.any()
+    stop, _ = t.check(1, losses[:1], valid[:1], active[:1])
+    np.testing.assert_array_equal(stop, [True])
+    assert t.n_iter_saved["budget"] == 99
+
+
+@pytest.fixture(scope="module")
+def models():
+    reset_seeds()
+    X = np.random.RandomState(0).randn(6, 16, 1)
+    classifier = Classifier_FCN(X.shape[1:], 2)
+    autoencoder = Autoencoder(*X.shape[1:])
+    pred_labels = np.argmax(classifier.predict(X, verbose=0), axis=1)
+    return X, pred_labels, classifier, autoencoder
+
+
+def search(models, **params):
+    X, pred_labels, classifier, autoencoder = models
+    cf_model = ModifiedLatentCF(
+        autoencoder=autoencoder,
+        optimizer=tf.keras.optimizers.legacy.Adam(learning_rate=0.001),
+        step_weights=np.ones((1,) + X.shape[1:]),
+        **params,
+    ).fit(classifier)
+    cf_samples, losses, _ = cf_model.transform(X, pred_labels)
+    return cf_model, cf_samples
+
+
+@pytest.mark.parametrize("batch_size", [None, 3])
+def test_policies_bound_the_iterations(models, batch_size):
+    default, _ = search(models, batch_size=batch_size)
+    assert default.n_iter_saved_ == dict(plateau=0, refine=0, budget=0)
+
+    # shared by the samples searched together, i.e. per block of `batch_size` samples
+    budget = 60
+    cf_model, cf_samples = search(models, batch_size=batch_size, max_total_iter=budget)
+    block_size = batch_size or len(cf_model.n_iter_)
+    assert cf_model.n_iter_.reshape(-1, block_size).sum(axis=1).max() <= budget
+    assert cf_model.n_iter_saved_["budget"] > 0
+    assert np.all(np.isfinite(cf_samples))
+
+    # stopped as soon as they are valid, never later than the default criterion
+    cf_model, _ = search(models, batch_size=batch_size, refine_iter=0)
+    assert np.all(cf_model.n_iter_ <= default.n_iter_)
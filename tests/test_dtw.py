@@ -0,0 +1,52 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from LIMESegment.Utils.dtw import dtw_distances  # noqa: E402
+
+
+def reference_dtw(query, candidate, window=None):
+    # the textbook recursion, with the L1 cost of `fastdtw` and a Sakoe-Chiba band
+    query, candidate = query.reshape(len(query), -1), candidate.reshape(len(candidate), -1)
+    n, m = len(query), len(candidate)
+    window = max(n, m) if window is None else max(window, abs(n - m))
+    D = np.full((n + 1, m + 1), np.inf)
+    D[0, 0] = 0.0
+    for i in range(1, n + 1):
+        for j in range(max(1, i - window), min(m, i + window) + 1):
+            cost = np.abs(query[i - 1] - candidate[j - 1]).sum()
+            D[i, j] = cost + min(D[i - 1, j - 1], D[i - 1, j], D[i, j - 1])
+    return D[n, m]
+
+
+@pytest.mark.parametrize("n_features", [None, 2])
+@pytest.mark.parametrize("window", [None, 3])
+def test_dtw_matches_reference(n_features, window):
+    rng = np.random.RandomState(0)
+    shape = (30,) if n_features is None else (30, n_features)
+    query = rng.randn(*shape)
+    candidates = rng.randn(8, *shape)
+    expected = [reference_dtw(query, c, window) for c in candidates]
+    np.testing.assert_allclose(dtw_distances(query, candidates, window=window), expected)
+
+
+def test_dtw_unequal_lengths():
+    rng = np.random.RandomState(1)
+    query, candidates = rng.randn(20), rng.randn(4, 26)
+    # the band is widened to the difference of the lengths
+    expected = [reference_dtw(query, c, 6) for c in candidates]
+    np.testing.assert_allclose(dtw_distances(query, candidates, window=2), expected)
+
+
+def test_dtw_early_abandoning():
+    rng = np.random.RandomState(2)
+    query, candidates = rng.randn(25), rng.randn(10, 25)
+    exact = dtw_distances(query, candidates)
+    max_dist = np.median(exact)
+    abandoned = dtw_distances(query, candidates, max_dist=max_dist)
+    np.testing.assert_array_equal(abandoned[exact <= max_dist], exact[exact <= max_dist])
+    assert np.all(np.isinf(abandoned[exact > max_dist]))
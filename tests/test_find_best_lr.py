@@ -0,0 +1,103 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from help_functions import find_best_lr, find_best_lr_batched, reset_seeds  # noqa: E402
+from keras_models import Autoencoder, Classifier_FCN  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def models():
+    reset_seeds()
+    X = np.random.RandomState(0).randn(6, 16, 1)
+    classifier = Classifier_FCN(X.shape[1:], 2)
+    autoencoder = Autoencoder(*X.shape[1:])
+    pred_labels = np.argmax(classifier.predict(X, verbose=0), axis=1)
+    return X, pred_labels, classifier, autoencoder
+
+
+def test_batched_models_are_configured(models):
+    X, pred_labels, classifier, autoencoder = models
+    best_results = find_best_lr_batched(
+        classifier,
+        X,
+        pred_labels,
+        autoencoder=autoencoder,
+        lr_list=[0.001, 0.0001],
+        pred_margin_weight_list=[1.0, 0.9],
+        target_prob_list=[0.5, 0.7],
+        step_weights=np.ones((1, X.shape[1], X.shape[2])),
+    )
+    models_seen = set()
+    for (pred_margin_weight, target_prob), (lr, cf_model, *_, stats) in best_results.items():
+        assert cf_model.pred_margin_weight == pred_margin_weight
+        np.testing.assert_allclose(cf_model.probability_.numpy(), [target_prob])
+        np.testing.assert_allclose(
+            tf.keras.backend.get_value(cf_model.optimizer_.learning_rate), lr
+        )
+        np.testing.assert_array_equal(cf_model.n_iter_, stats["n_iter"])
+        models_seen.add(id(cf_model))
+    assert len(models_seen) == len(best_results)
+
+
+def test_batched_rejects_encoder_decoder(models):
+    X, pred_labels, classifier, autoencoder = models
+    with pytest.raises(ValueError):
+        find_best_lr(
+            classifier, X, pred_labels, encoder=autoencoder, decoder=autoencoder, batched=True
+        )
+
+
+def test_sequential_returns_stats(models):
+    X, pred_labels, classifier, autoencoder = models
+    best_lr, cf_model, cf_samples, _, stats = find_best_lr(
+        classifier,
+        X,
+        pred_labels,
+        autoencoder=autoencoder,
+        lr_list=[0.001, 0.0001],
+        step_weights=np.ones((1, X.shape[1], X.shape[2])),
+        return_stats=True,
+    )
+    assert best_lr in (0.001, 0.0001)
+    assert cf_samples.shape == X.shape
+    assert stats["loss"].shape == stats["n_iter"].shape == stats["time"].shape == (X.shape[0],)
+    np.testing.assert_array_equal(cf_model.n_iter_, stats["n_iter"])
+
+
+@pytest.mark.parametrize("jit_compile", [False, True])
+def test_compiled_search_matches_sequential(models, jit_compile):
+    X, pred_labels, classifier, autoencoder = models
+    results = [
+        find_best_lr(
+            classifier,
+            X,
+            pred_labels,
+            autoencoder=autoencoder,
+            lr_list=[0.001],
+            step_weights=np.ones((1, X.shape[1], X.shape[2])),
+            compile_search=compile_search,
+            jit_compile=jit_compile and compile_search,
+            return_stats=True,
+        )
+        for compile_search in (False, True)
+    ]
+    (_, _, cf_samples, _, stats), (_, _, compiled_cf_samples, _, compiled_stats) = results
+    np.testing.assert_array_equal(compiled_stats["n_iter"], stats["n_iter"])
+    # XLA fuses and reorders the float32 operations of the search
+    atol = 1e-3 if jit_compile else 1e-5
+    np.testing.assert_allclose(compiled_cf_samples, cf_samples, rtol=1e-4, atol=atol)
+    np.testing.assert_allclose(compiled_stats["loss"], stats["loss"], rtol=1e-3, atol=atol)
+
+
+def test_compiled_search_rejects_batched(models):
+    X, pred_labels, classifier, autoencoder = models
+    with pytest.raises(ValueError):
+        find_best_lr(
+            classifier, X, pred_labels, autoencoder=autoencoder, batched=True, compile_search=True
+        )
@@ -0,0 +1,96 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from _guided import get_global_weights, interval_importance  # noqa: E402
+
+
+class ThresholdModel:
+    """A classifier of the mean of some timesteps, with the `predict` of keras"""
+
+    def __init__(self, start=4, end=8):
+        self.start, self.end = start, end
+        self.n_calls = 0
+
+    def predict(self, samples, batch_size=None, verbose=0):
+        self.n_calls += 1
+        score = np.asarray(samples)[:, self.start : self.end].mean(axis=(1, 2))
+        return np.stack([score <= 0, score > 0], axis=1).astype(np.float32)
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    X = rng.randn(40, 16, 2).astype(np.float32)
+    return X, np.argmax(ThresholdModel().predict(X), axis=1)
+
+
+def naive_importance(X, y, model, n_intervals, n_repeat=5, random_state=0):
+    # one classifier call per (interval, repeat), as `IntervalImportance`
+    rng = np.random.RandomState(random_state)
+    length, n_longer = divmod(X.shape[1], n_intervals)
+    baseline = np.mean(np.argmax(model.predict(X), axis=1) == y)
+    importances = []
+    for i in range(n_intervals):
+        start = i * length + min(i, n_longer)
+        end = start + length + (1 if i < n_longer else 0)
+        scores = []
+        for _ in range(n_repeat):
+            permuted = X.copy()
+            permuted[:, start:end] = X[rng.permutation(len(X)), start:end]
+            scores.append(np.mean(np.argmax(model.predict(permuted), axis=1) == y))
+        importances.append(baseline - np.mean(scores))
+    return np.array(importances)
+
+
+@pytest.mark.parametrize("n_intervals", [None, 5])
+def test_importance_matches_naive(data, n_intervals):
+    X, y = data
+    model = ThresholdModel()
+    # small chunks, several classifier calls
+    importances, components = interval_importance(
+        X, y, model, n_intervals=n_intervals, random_state=0, max_batch_samples=200
+    )
+    expected = naive_importance(X, y, ThresholdModel(), n_intervals or X.shape[1])
+    np.testing.assert_allclose(importances, expected)
+    assert components[0, 0] == 0 and components[-1, 1] == X.shape[1]
+    # 5 repeats of every interval, 5 per call, and the baseline
+    assert model.n_calls == len(components) + 1
+
+
+def test_importance_matches_wildboar(data):
+    from wildboar.explain import IntervalImportance
+
+    X, y = data
+    X = X[:, :, :1]
+    model = ThresholdModel()
+
+    class Flattened:
+        # the wrapper of the former `get_global_weights`
+        def __init__(self):
+            self.fitted_, self.n_timesteps_in_, self.n_features_in_ = True, X.shape[1], X.shape[1]
+
+        def predict(self, X_flat):
+            return np.argmax(model.predict(X_flat.reshape(X.shape)), axis=1)
+
+        def fit(self, X, y):
+            return self
+
+    i = IntervalImportance(scoring="accuracy", n_intervals=X.shape[1], random_state=0)
+    i.fit(Flattened(), X.reshape(len(X), -1), y)
+    importances, components = interval_importance(X, y, model, random_state=0)
+    np.testing.assert_allclose(importances, i.importances_.mean)
+    np.testing.assert_array_equal(components, i.components_)
+
+
+def test_global_weights_mask_the_important_intervals(data):
+    X, y = data
+    weights = get_global_weights(X, y, ThresholdModel(), random_state=0)
+    assert weights.shape == (1,) + X.shape[1:]
+    # the classifier only reads timesteps 4 to 7, the top quarter, masked for all features
+    assert np.all(weights[0, 4:8] == 0)
+    assert np.all(weights[0, :4] == 1) and np.all(weights[0, 8:] == 1)
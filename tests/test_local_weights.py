@@ -0,0 +1,62 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from _guided import ModifiedLatentCF  # noqa: E402
+from caching import StepWeightCache  # noqa: E402
+from executors import LocalWeightsExecutor  # noqa: E402
+from help_functions import reset_seeds  # noqa: E402
+from keras_models import Classifier_FCN  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def samples():
+    reset_seeds()
+    rng = np.random.RandomState(0)
+    t = np.linspace(0, 4 * np.pi, 48)
+    X = np.stack([np.sin(t + phase) for phase in rng.uniform(0, np.pi, 4)])[:, :, np.newaxis]
+    X += 0.1 * rng.randn(*X.shape)
+    model = Classifier_FCN(X.shape[1:], 2)
+    pred_labels = np.argmax(model.predict(X, verbose=0), axis=1)
+    return X, pred_labels, model
+
+
+def test_executor_matches_in_process(samples):
+    X, pred_labels, model = samples
+    expected = ModifiedLatentCF(random_state=39).fit(model)._get_local_weights_batch(X, pred_labels)
+
+    cache = StepWeightCache(maxsize=16)
+    with LocalWeightsExecutor(model, n_workers=1) as executor:
+        cf_model = ModifiedLatentCF(
+            random_state=39, step_weights_cache=cache, local_weights_executor=executor
+        ).fit(model)
+        weights = cf_model._get_local_weights_batch(X, pred_labels)
+
+    np.testing.assert_allclose(weights, expected)
+    # the weights of the workers are cached, a second call computes none
+    cf_model.local_weights_executor = None
+    np.testing.assert_allclose(cf_model._get_local_weights_batch(X, pred_labels), expected)
+    assert cache.misses == X.shape[0]
+
+
+@pytest.mark.parametrize("batch_size", [None, 2])
+def test_prefetch_matches_sequential(samples, batch_size):
+    X, pred_labels, model = samples
+    results = []
+    for prefetch in (0, 2):
+        reset_seeds()
+        cf_model = ModifiedLatentCF(
+            optimizer=tf.keras.optimizers.legacy.Adam(learning_rate=1e-3),
+            random_state=39,
+            max_iter=5,
+            batch_size=batch_size,
+            prefetch=prefetch,
+        ).fit(model)
+        results.append(cf_model.transform(X, pred_labels))
+    for expected, result in zip(*results):
+        np.testing.assert_allclose(result, expected, rtol=1e-5)
@@ -0,0 +1,116 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import stumpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from LIMESegment.Utils.explanations import (  # noqa: E402
+    NNSegment,
+    _change_scores,
+    matrix_profile_cache,
+    matrix_profile_index,
+)
+
+
+def series(n_timesteps=120, n_features=1, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.linspace(0, 6 * np.pi, n_timesteps)
+    return np.stack([np.sin(t * (d + 1)) for d in range(n_features)], axis=1) + 0.1 * rng.randn(
+        n_timesteps, n_features
+    )
+
+
+def test_exact_index_is_cached():
+    x = series()
+    matrix_profile_cache.clear()
+    nn_idx = matrix_profile_index(x, 10)
+    _, mp_idx = stumpy.mstump(x.T, m=10)
+    np.testing.assert_array_equal(nn_idx, mp_idx[0])
+    assert matrix_profile_index(x, 10) is nn_idx
+    assert (matrix_profile_cache.hits, matrix_profile_cache.misses) == (1, 1)
+
+
+def test_approximate_index_keeps_the_global_rng():
+    x = series(seed=1)
+    matrix_profile_cache.clear()
+    np.random.seed(123)
+    state = np.random.get_state()
+    nn_idx = matrix_profile_index(x, 10, percentage=0.2)
+    after = np.random.get_state()
+    assert state[0] == after[0] and state[2:] == after[2:]
+    np.testing.assert_array_equal(state[1], after[1])
+
+    # reseeded, so a fresh computation equals the cached one
+    matrix_profile_cache.clear()
+    np.testing.assert_array_equal(matrix_profile_index(x, 10, percentage=0.2), nn_idx)
+    assert len(nn_idx) == len(x) - 10 + 1
+
+
+def test_multivariate_ignores_percentage():
+    x = series(n_features=2, seed=2)
+    matrix_profile_cache.clear()
+    np.testing.assert_array_equal(
+        matrix_profile_index(x, 10, percentage=0.2), matrix_profile_index(x, 10)
+    )
+    assert matrix_profile_cache.hits == 1
+
+
+def test_nnsegment_approximate():
+    x = series(seed=3)
+    change_points = NNSegment(x, 12, 3, mp_percentage=0.5)
+    assert len(change_points) <= 3
+    assert all(0 < cp < len(x) for cp in change_points)
+
+
+def loop_scores(t, proposed_cp, tolerance):
+    # the original, one change point at a time
+    variances = []
+    for idx in proposed_cp:
+        before, after = t[idx - tolerance : idx, :], t[idx : idx + tolerance, :]
+        mean_change = np.abs(np.mean(before, axis=0) - np.mean(after, axis=0))
+        std_change = np.abs(np.std(before, axis=0) - np.std(after, axis=0))
+        std_mean = np.mean(
+            [np.linalg.norm(np.std(before, axis=0)), np.linalg.norm(np.std(after, axis=0))]
+        )
+        variances.append(np.linalg.norm(mean_change) * np.linalg.norm(std_change) / std_mean)
+    return np.array(variances)
+
+
+def loop_select(proposed_cp, variances, tolerance, change_points):
+    # the original selection, with the list of covered timesteps
+    sorted_cp = [proposed_cp[idx] for idx in np.flip(variances.argsort())]
+    selected_cp, covered = [], list(np.arange(0, tolerance))
+    for cp in sorted_cp:
+        if len(selected_cp) == change_points:
+            break
+        if cp not in covered:
+            selected_cp.append(cp)
+            covered += list(np.arange(cp - tolerance, cp + tolerance))
+    return list(np.sort(selected_cp))
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")  # the empty windows of the loop
+def test_change_scores_match_loop():
+    window_size, tolerance = 12, 6
+    for n_features in (1, 3):
+        x = series(n_features=n_features, seed=4)
+        # every end of a matrix profile window, including the first ones with empty windows before them
+        proposed_cp = np.arange(len(x) - window_size + 1)
+        np.testing.assert_allclose(
+            _change_scores(x, proposed_cp, tolerance), loop_scores(x, proposed_cp, tolerance)
+        )
+    assert len(_change_scores(x, proposed_cp[:0], tolerance)) == 0
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")  # the empty windows of the loop
+def test_nnsegment_matches_loop():
+    window_size, tolerance = 12, 6
+    for seed in range(3):
+        x = series(n_features=2, seed=seed)
+        nn_idx = matrix_profile_index(x, window_size)
+        proposed_cp = np.flatnonzero(nn_idx[1:] != nn_idx[:-1] + 1)
+        expected = loop_select(proposed_cp, loop_scores(x, proposed_cp, tolerance), tolerance, 3)
+        assert NNSegment(x, window_size, 3) == expected
@@ -0,0 +1,82 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from _guided import LatentNUNIndex, ModifiedLatentCF, fit_nun_index  # noqa: E402
+from help_functions import reset_seeds  # noqa: E402
+from keras_models import Autoencoder, Classifier_FCN  # noqa: E402
+
+
+def brute_force_nun(codes, labels, queries, target_labels):
+    # the nearest code of the target label, by the euclidean distance of the flattened codes
+    flat_codes, flat_queries = codes.reshape(len(codes), -1), queries.reshape(len(queries), -1)
+    nun = []
+    for query, target in zip(flat_queries, target_labels):
+        members = np.flatnonzero(labels == target)
+        nun.append(codes[members[np.argmin(((flat_codes[members] - query) ** 2).sum(axis=1))]])
+    return np.array(nun)
+
+
+@pytest.fixture
+def codes():
+    rng = np.random.RandomState(0)
+    return rng.randn(50, 4, 3).astype(np.float32), rng.randint(0, 2, 50), rng.randn(10, 4, 3)
+
+
+@pytest.mark.parametrize("algorithm", ["auto", "kd_tree", "brute"])
+def test_query_matches_brute_force(codes, algorithm):
+    train_codes, labels, queries = codes
+    target_labels = np.arange(10) % 2
+    index = LatentNUNIndex(algorithm=algorithm).fit(train_codes, labels)
+    np.testing.assert_array_equal(
+        index.query(queries, target_labels),
+        brute_force_nun(train_codes, labels, queries, target_labels),
+    )
+    # a single target label for all queries
+    np.testing.assert_array_equal(
+        index.query(queries, 1), brute_force_nun(train_codes, labels, queries, [1] * 10)
+    )
+
+
+def test_query_unknown_label(codes):
+    train_codes, labels, queries = codes
+    index = LatentNUNIndex().fit(train_codes, labels)
+    with pytest.raises(ValueError):
+        index.query(queries, 2)
+
+
+def test_save_load(codes, tmp_path):
+    train_codes, labels, queries = codes
+    index = LatentNUNIndex().fit(train_codes, labels)
+    index.save(str(tmp_path / "nun.npz"))
+    loaded = LatentNUNIndex.load(str(tmp_path / "nun.npz"))
+    np.testing.assert_array_equal(loaded.query(queries, 0), index.query(queries, 0))
+
+
+def test_warm_start_interpolates_towards_the_nun():
+    reset_seeds()
+    rng = np.random.RandomState(1)
+    X = rng.randn(12, 16, 1)
+    y = np.arange(12) % 2
+    classifier = Classifier_FCN(X.shape[1:], 2)
+    autoencoder = Autoencoder(*X.shape[1:])
+    nun_index = fit_nun_index(autoencoder, X, y)
+
+    cf_model = ModifiedLatentCF(autoencoder=autoencoder, warm_start=0.25, nun_index=nun_index)
+    cf_model.fit(classifier)
+    x, pred_labels = X[:3], np.array([0, 1, 0])
+    z = cf_model.encoder_(x).numpy()
+    z_nun = brute_force_nun(nun_index.codes_, y, z, 1 - pred_labels)
+    np.testing.assert_allclose(
+        cf_model._initial_z(x, pred_labels).numpy(), 0.75 * z + 0.25 * z_nun, rtol=1e-5, atol=1e-6
+    )
+
+    # without an index, `fit` builds it from the training samples
+    cf_model = ModifiedLatentCF(autoencoder=autoencoder, warm_start=1.0).fit(classifier, X, y)
+    np.testing.assert_allclose(cf_model._initial_z(x, pred_labels).numpy(), z_nun, rtol=1e-5, atol=1e-6)
+    with pytest.raises(ValueError):
+        ModifiedLatentCF(warm_start=1.0).fit(classifier)
@@ -0,0 +1,77 @@
+import os
+import sys
+
+import numpy as np
+from scipy import signal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from LIMESegment.Utils import explanations, perturbations  # noqa: E402
+from LIMESegment.Utils.perturbations import (  # noqa: E402
+    backgroundIdentification,
+    backgroundIdentification_batch,
+)
+
+
+def loop_background(original_signal, nperseg=40):
+    # the original, one frequency band at a time
+    f, t, Zxx = signal.stft(original_signal, 1, nperseg=nperseg)
+    frequency_composition_abs = np.abs(Zxx)
+    measures = []
+    for freq, freq_composition in zip(f, frequency_composition_abs):
+        measures.append(np.mean(freq_composition) / np.std(freq_composition))
+    selected_frequency = measures.index(max(measures))
+    dummymatrix = np.zeros((len(f), len(t)))
+    dummymatrix[selected_frequency, :] = 1
+    _, xrec = signal.istft(Zxx * dummymatrix, 1)
+    return xrec[: len(original_signal)]
+
+
+def test_background_matches_loop():
+    X = np.random.RandomState(0).randn(4, 100)
+    for x in X:
+        np.testing.assert_allclose(backgroundIdentification(x), loop_background(x), atol=1e-12)
+
+
+def test_background_batch_per_feature():
+    X = np.random.RandomState(1).randn(3, 100, 2)
+    backgrounds = backgroundIdentification_batch(X, use_cache=False)
+    assert backgrounds.shape == X.shape
+    for x, background in zip(X, backgrounds):
+        for d in range(X.shape[2]):
+            np.testing.assert_allclose(background[:, d], loop_background(x[:, d]), atol=1e-12)
+    # the cached backgrounds are the same
+    np.testing.assert_array_equal(backgroundIdentification_batch(X), backgrounds)
+    np.testing.assert_array_equal(backgroundIdentification_batch(X), backgrounds)
+
+
+def loop_rbp(generated_samples_interpretable, original_signal, segment_indexes, xrec):
+    # the original, one perturbed sample and segment at a time
+    generated_samples_raw = []
+    for sample_interpretable in generated_samples_interpretable:
+        raw_signal = original_signal.copy()
+        for index in range(len(sample_interpretable) - 1):
+            if sample_interpretable[index] == 0:
+                index0 = segment_indexes[index]
+                index1 = segment_indexes[index + 1]
+                raw_signal[index0:index1] = xrec[index0:index1]
+        generated_samples_raw.append(raw_signal)
+    return np.asarray(generated_samples_raw)
+
+
+def test_rbp_matches_loop():
+    rng = np.random.RandomState(2)
+    x = rng.randn(100, 2)
+    # as in `LIMESegment`, the last segment ends at -1
+    segment_indexes = [0, 20, 45, 70, -1]
+    interpretable = rng.binomial(1, 0.5, (50, len(segment_indexes) - 1))
+    xrec = backgroundIdentification_batch(x[np.newaxis], use_cache=False)[0]
+
+    expected = loop_rbp(interpretable, x, segment_indexes, xrec)
+    np.testing.assert_array_equal(explanations.RBP(interpretable, x, segment_indexes), expected)
+    out = np.empty_like(expected)
+    assert explanations.RBP(interpretable, x, segment_indexes, out=out) is out
+    np.testing.assert_array_equal(out, expected)
+
+    expected = loop_rbp(interpretable, x[:, 0], segment_indexes, xrec[:, 0])
+    np.testing.assert_array_equal(perturbations.RBP(interpretable, x[:, 0], segment_indexes), expected)
@@ -0,0 +1,92 @@
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from profiling import NullProfiler, Profiler, get_profiler, set_profiler  # noqa: E402
+
+
+def test_phases_and_counters():
+    profiler = Profiler()
+    with profiler.phase("search"):
+        time.sleep(0.01)
+    with pytest.raises(RuntimeError):
+        with profiler.phase("search"):
+            raise RuntimeError
+    profiler.count("classifier_calls")
+    profiler.count("classifier_calls", 3)
+    profiler.observe("gradient_steps", np.array([[1, 2], [3, 4]]))
+
+    calls, wall, cpu = profiler.phases["search"]
+    assert calls == 2 and wall >= 0.01 and cpu >= 0
+    assert profiler.counters == {"classifier_calls": 4}
+    assert profiler.distributions == {"gradient_steps": [1.0, 2.0, 3.0, 4.0]}
+
+
+def test_merge_and_summary(tmp_path):
+    profiler, worker = Profiler(), Profiler()
+    for p, hits in ((profiler, 3), (worker, 1)):
+        with p.phase("step_weights"):
+            pass
+        p.count("cache.step_weights.hits", hits)
+        p.count("cache.step_weights.misses")
+        p.observe("gradient_steps", [hits, 10])
+    profiler.merge(worker.state())
+
+    summary = profiler.summary(dataset="TwoLeadECG")
+    assert summary["run"] == {"dataset": "TwoLeadECG"}
+    assert summary["phases"]["step_weights"]["calls"] == 2
+    assert summary["counters"] == {"cache.step_weights.hits": 4, "cache.step_weights.misses": 2}
+    assert summary["caches"]["step_weights"] == dict(hits=4, misses=2, hit_rate=4 / 6)
+    assert summary["distributions"]["gradient_steps"] == dict(
+        count=4, total=24.0, mean=6.0, p50=6.5, p95=10.0, max=10.0
+    )
+
+    profiler.save(str(tmp_path / "profile.json"), dataset="TwoLeadECG")
+    with open(tmp_path / "profile.json") as f:
+        assert json.load(f)["counters"] == summary["counters"]
+    assert os.listdir(tmp_path) == ["profile.json"]
+
+
+def test_set_profiler():
+    assert isinstance(get_profiler(), NullProfiler)
+    profiler = Profiler()
+    previous = set_profiler(profiler)
+    try:
+        assert get_profiler() is profiler
+    finally:
+        assert set_profiler(previous) is profiler
+    assert set_profiler(None) is previous
+    assert isinstance(get_profiler(), NullProfiler)
+
+
+def test_cf_search_is_profiled():
+    from _guided import ModifiedLatentCF
+    from help_functions import reset_seeds
+    from keras_models import Classifier_FCN
+
+    reset_seeds()
+    X = np.random.RandomState(0).randn(3, 16, 1)
+    classifier = Classifier_FCN(X.shape[1:], 2)
+    pred_labels = np.argmax(classifier.predict(X, verbose=0), axis=1)
+    cf_model = ModifiedLatentCF(
+        optimizer=tf.keras.optimizers.legacy.Adam(learning_rate=0.001),
+        step_weights=np.ones((1,) + X.shape[1:]),
+        max_iter=20,
+    ).fit(classifier)
+
+    profiler = Profiler()
+    previous = set_profiler(profiler)
+    try:
+        cf_model.transform(X, pred_labels)
+    finally:
+        set_profiler(previous)
+    assert profiler.distributions["gradient_steps"] == cf_model.n_iter_.tolist()
+    assert profiler.phases["gradient_search"][0] == len(X)
+    assert profiler.counters["classifier_calls"] > cf_model.n_iter_.sum()
@@ -0,0 +1,68 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from help_functions import RESULT_COLUMNS, ResultWriter, merge_rows, read_rows  # noqa: E402
+
+EVALUATE_RES = (0.1, 1.0, 0.2, 0.05, 0.3, 1.1)
+
+
+def write_fold(result_writer, fold_idx):
+    result_writer.write_result(fold_idx, "method", 0.9, 0.01, 0.001, EVALUATE_RES)
+    result_writer.flush()
+
+
+@pytest.mark.parametrize("ext", [".csv", ".parquet", ".arrow"])
+def test_flush_appends(tmp_path, ext):
+    if ext != ".csv":
+        pytest.importorskip("pyarrow")
+    file_name = str(tmp_path / f"results{ext}")
+    result_writer = ResultWriter(file_name, "dataset")
+    result_writer.write_head()
+    for fold_idx in range(3):
+        write_fold(result_writer, fold_idx)
+
+    # a second run appends to the existing rows
+    result_writer = ResultWriter(file_name, "dataset")
+    result_writer.check_head()
+    write_fold(result_writer, 3)
+
+    df = read_rows(file_name)
+    assert list(df.columns) == RESULT_COLUMNS
+    np.testing.assert_array_equal(df["fold_id"], [0, 1, 2, 3])
+
+
+def test_other_header_is_rejected(tmp_path):
+    file_name = str(tmp_path / "results.csv")
+    with open(file_name, "w") as f:
+        f.write("dataset,method,classifier_accuracy\n")
+    result_writer = ResultWriter(file_name, "dataset")
+    with pytest.raises(ValueError):
+        result_writer.check_head()
+    with pytest.raises(ValueError):
+        write_fold(result_writer, 0)
+    with open(file_name) as f:
+        assert f.read() == "dataset,method,classifier_accuracy\n"
+
+
+def test_merge_rows(tmp_path):
+    file_names = [str(tmp_path / f"job{i}.csv") for i in range(2)]
+    for i, file_name in enumerate(file_names):
+        result_writer = ResultWriter(file_name, "dataset")
+        result_writer.write_head()
+        write_fold(result_writer, i)
+
+    output = str(tmp_path / "results.csv")
+    merge_rows(file_names, output)
+    # merging again replaces the rows, e.g. after a job was rerun
+    merge_rows(file_names, output)
+
+    df = read_rows(output)
+    np.testing.assert_array_equal(df["fold_id"], [0, 1])
+    with open(output) as f, open(file_names[0]) as job:
+        assert f.readline() == job.readline()
+        assert f.readline() == job.readline()